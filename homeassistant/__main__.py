@@ -6,6 +6,7 @@ import os
 import argparse
 
 from homeassistant import bootstrap
+import homeassistant.core as core
 import homeassistant.config as config_util
 from homeassistant.const import __version__, EVENT_HOMEASSISTANT_START
 
@@ -85,6 +86,10 @@ def get_arguments():
         '-v', '--verbose',
         action='store_true',
         help="Enable verbose logging to file.")
+    parser.add_argument(
+        '--asyncio',
+        action='store_true',
+        help='Run the event bus, services and timer on an asyncio event loop')
     parser.add_argument(
         '--pid-file',
         metavar='path_to_pid_file',
@@ -233,20 +238,22 @@ def main():
     if args.pid_file:
         write_pid(args.pid_file)
 
+    hass = core.HomeAssistant(use_asyncio=args.asyncio)
+
     if args.demo_mode:
         config = {
             'frontend': {},
             'demo': {}
         }
         hass = bootstrap.from_config_dict(
-            config, config_dir=config_dir, daemon=args.daemon,
+            config, hass, config_dir=config_dir, daemon=args.daemon,
             verbose=args.verbose, skip_pip=args.skip_pip,
             log_rotate_days=args.log_rotate_days)
     else:
         config_file = ensure_config_file(config_dir)
         print('Config directory:', config_dir)
         hass = bootstrap.from_config_file(
-            config_file, daemon=args.daemon, verbose=args.verbose,
+            config_file, hass, daemon=args.daemon, verbose=args.verbose,
             skip_pip=args.skip_pip, log_rotate_days=args.log_rotate_days)
 
     if args.open_ui:
@@ -22,7 +22,6 @@ import homeassistant.util.location as loc_util
 import homeassistant.config as config_util
 import homeassistant.loader as loader
 import homeassistant.components as core_components
-import homeassistant.components.group as group
 from homeassistant.helpers.entity import Entity
 from homeassistant.const import (
     EVENT_COMPONENT_LOADED, CONF_LATITUDE, CONF_LONGITUDE,
@@ -102,11 +101,6 @@ def _setup_component(hass, domain, config):
 
     hass.config.components.append(component.DOMAIN)
 
-    # Assumption: if a component does not depend on groups
-    # it communicates with devices
-    if group.DOMAIN not in component.DEPENDENCIES:
-        hass.pool.add_worker()
-
     hass.bus.fire(
         EVENT_COMPONENT_LOADED, {ATTR_COMPONENT: component.DOMAIN})
 
@@ -162,10 +156,11 @@ def from_config_dict(config, hass=None, config_dir=None, enable_log=True,
     """
     if hass is None:
         hass = core.HomeAssistant()
-        if config_dir is not None:
-            config_dir = os.path.abspath(config_dir)
-            hass.config.config_dir = config_dir
-            mount_local_lib_path(config_dir)
+
+    if config_dir is not None:
+        config_dir = os.path.abspath(config_dir)
+        hass.config.config_dir = config_dir
+        mount_local_lib_path(config_dir)
 
     process_ha_core_config(hass, config.get(core.DOMAIN, {}))
 
@@ -179,6 +174,9 @@ def from_config_dict(config, hass=None, config_dir=None, enable_log=True,
 
     _ensure_loader_prepared(hass)
 
+    # Start with the states from before the restart
+    hass.persist_states()
+
     # Make a copy because we are mutating it.
     # Convert it to defaultdict so components can always have config dict
     # Convert values to dictionaries if they are None
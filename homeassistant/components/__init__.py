@@ -16,6 +16,7 @@ Each component should publish services only under its own domain.
 """
 import itertools as it
 import logging
+import concurrent.futures
 
 import homeassistant.core as ha
 import homeassistant.util as util
@@ -88,6 +89,8 @@ def setup(hass, config):
         by_domain = it.groupby(sorted(entity_ids),
                                lambda item: util.split_entity_id(item)[0])
 
+        futures = []
+
         for domain, ent_ids in by_domain:
             # Create a new dict for this call
             data = dict(service.data)
@@ -95,7 +98,16 @@ def setup(hass, config):
             # ent_ids is a generator, convert it to a list.
             data[ATTR_ENTITY_ID] = list(ent_ids)
 
-            hass.services.call(domain, service.service, data, True)
+            futures.append(
+                hass.services.call_future(domain, service.service, data))
+
+        # Wait for the domains together. Failing services are logged by the
+        # worker pool.
+        _, not_done = concurrent.futures.wait(
+            futures, ha.SERVICE_CALL_LIMIT)
+
+        for future in not_done:
+            future.cancel()
 
     hass.services.register(ha.DOMAIN, SERVICE_TURN_OFF, handle_turn_service)
     hass.services.register(ha.DOMAIN, SERVICE_TURN_ON, handle_turn_service)
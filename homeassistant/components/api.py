@@ -9,7 +9,6 @@ https://home-assistant.io/developers/api.html
 import re
 import logging
 import threading
-import json
 
 import homeassistant.core as ha
 from homeassistant.helpers.state import TrackStates
@@ -17,10 +16,12 @@ import homeassistant.remote as rem
 from homeassistant.const import (
     URL_API, URL_API_STATES, URL_API_EVENTS, URL_API_SERVICES, URL_API_STREAM,
     URL_API_EVENT_FORWARD, URL_API_STATES_ENTITY, URL_API_COMPONENTS,
-    URL_API_CONFIG, URL_API_BOOTSTRAP,
+    URL_API_CONFIG, URL_API_BOOTSTRAP, URL_API_METRICS,
     EVENT_TIME_CHANGED, EVENT_HOMEASSISTANT_STOP, MATCH_ALL,
     HTTP_OK, HTTP_CREATED, HTTP_BAD_REQUEST, HTTP_NOT_FOUND,
-    HTTP_UNPROCESSABLE_ENTITY)
+    HTTP_UNPROCESSABLE_ENTITY, HTTP_INTERNAL_SERVER_ERROR,
+    HTTP_HEADER_CONTENT_TYPE,
+    CONTENT_TYPE_TEXT_PLAIN)
 
 
 DOMAIN = 'api'
@@ -29,6 +30,8 @@ DEPENDENCIES = ['http']
 STREAM_PING_PAYLOAD = "ping"
 STREAM_PING_INTERVAL = 50  # seconds
 
+METRICS_FORMAT_PROMETHEUS = 'prometheus'
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -89,6 +92,9 @@ def setup(hass, config):
     hass.http.register_path(
         'GET', URL_API_COMPONENTS, _handle_get_api_components)
 
+    # /metrics
+    hass.http.register_path('GET', URL_API_METRICS, _handle_get_api_metrics)
+
     return True
 
 
@@ -132,7 +138,7 @@ def _handle_get_api_stream(handler, path_match, data):
             block.set()
             return
 
-        write_message(json.dumps(event, cls=rem.JSONEncoder))
+        write_message(event.as_json())
 
     handler.send_response(HTTP_OK)
     handler.send_header('Content-type', 'text/event-stream')
@@ -174,7 +180,7 @@ def _handle_get_api_bootstrap(handler, path_match, data):
 
 def _handle_get_api_states(handler, path_match, data):
     """ Returns a dict containing all entity ids and their state. """
-    handler.write_json(handler.server.hass.states.all())
+    handler.write_json_stream(handler.server.hass.states.all())
 
 
 def _handle_get_api_states_entity(handler, path_match, data):
@@ -184,7 +190,7 @@ def _handle_get_api_states_entity(handler, path_match, data):
     state = handler.server.hass.states.get(entity_id)
 
     if state:
-        handler.write_json(state)
+        handler.write_json_stream(state)
     else:
         handler.write_json_message("State does not exist.", HTTP_NOT_FOUND)
 
@@ -270,8 +276,15 @@ def _handle_post_api_services_domain_service(handler, path_match, data):
     domain = path_match.group('domain')
     service = path_match.group('service')
 
-    with TrackStates(handler.server.hass) as changed_states:
-        handler.server.hass.services.call(domain, service, data, True)
+    try:
+        with TrackStates(handler.server.hass) as changed_states:
+            handler.server.hass.services.call(domain, service, data, True)
+    except Exception:  # pylint: disable=broad-except
+        # The service raised, the worker pool has logged the exception
+        handler.write_json_message(
+            "Service {}/{} failed.".format(domain, service),
+            HTTP_INTERNAL_SERVER_ERROR)
+        return
 
     handler.write_json(changed_states)
 
@@ -341,6 +354,135 @@ def _handle_get_api_components(handler, path_match, data):
     handler.write_json(handler.server.hass.config.components)
 
 
+def _handle_get_api_metrics(handler, path_match, data):
+    """ Returns the runtime statistics of jobs, listeners and services and
+    of the history cache if it is enabled.
+
+    Pass format=prometheus to get them in the Prometheus text format.
+    """
+    metrics = _metrics_json(handler.server.hass)
+
+    if data.get('format') != METRICS_FORMAT_PROMETHEUS:
+        handler.write_json(metrics)
+        return
+
+    handler.send_response(HTTP_OK)
+    handler.send_header(HTTP_HEADER_CONTENT_TYPE,
+                        CONTENT_TYPE_TEXT_PLAIN + '; version=0.0.4')
+    handler.end_headers()
+    handler.wfile.write(_metrics_prometheus(metrics).encode('UTF-8'))
+
+
+def _metrics_json(hass):
+    """ Generate metrics data to JSONify. """
+    pools = {'core': hass.pool}
+    pools.update(hass.executors)
+
+    if 'history' in hass.config.components:
+        from homeassistant.components import history
+        history_cache = history.cache_stats()
+    else:
+        history_cache = None
+
+    return {
+        'pools': {
+            name: {
+                'workers': pool.worker_count,
+                'pending': pool.queue_size,
+                'jobs': pool.job_stats.as_dict(),
+                'queue_wait': {
+                    getattr(priority, 'name', str(priority)): stats
+                    for priority, stats in pool.wait_stats.as_dict().items()},
+            } for name, pool in pools.items()},
+        'services': hass.services.stats.as_dict(),
+        'history_cache': history_cache,
+    }
+
+
+def _metrics_prometheus(metrics):
+    """ Renders metrics data in the Prometheus text format. """
+    lines = []
+
+    def add(name, metric_type, doc, samples):
+        """ Adds a metric with samples of (labels, value). """
+        lines.append('# HELP homeassistant_{} {}'.format(name, doc))
+        lines.append('# TYPE homeassistant_{} {}'.format(name, metric_type))
+
+        for labels, value in samples:
+            lines.append('homeassistant_{}{{{}}} {}'.format(
+                name,
+                ','.join('{}="{}"'.format(key, _prometheus_escape(val))
+                         for key, val in sorted(labels.items())),
+                repr(float(value))))
+
+    def stat_samples(label, group, field):
+        """ Returns samples for field of stats per pool in group. """
+        return [(dict(pool=pool_name, **{label: key}), stats[field])
+                for pool_name, pool in sorted(metrics['pools'].items())
+                for key, stats in sorted(pool[group].items())]
+
+    pools = sorted(metrics['pools'].items())
+
+    add('worker_threads', 'gauge', 'Number of worker threads.',
+        [({'pool': name}, pool['workers']) for name, pool in pools])
+    add('pending_jobs', 'gauge', 'Number of jobs waiting for a worker.',
+        [({'pool': name}, pool['pending']) for name, pool in pools])
+
+    add('job_calls_total', 'counter', 'Number of calls of a job or listener.',
+        stat_samples('job', 'jobs', 'count'))
+    add('job_seconds_total', 'counter',
+        'Total runtime of a job or listener in seconds.',
+        stat_samples('job', 'jobs', 'total'))
+    add('job_seconds_max', 'gauge',
+        'Longest runtime of a job or listener in seconds.',
+        stat_samples('job', 'jobs', 'max'))
+
+    add('queue_wait_jobs_total', 'counter',
+        'Number of jobs that waited in the queue.',
+        stat_samples('priority', 'queue_wait', 'count'))
+    add('queue_wait_seconds_total', 'counter',
+        'Total time jobs waited in the queue in seconds.',
+        stat_samples('priority', 'queue_wait', 'total'))
+    add('queue_wait_seconds_max', 'gauge',
+        'Longest time a job waited in the queue in seconds.',
+        stat_samples('priority', 'queue_wait', 'max'))
+
+    services = sorted(metrics['services'].items())
+
+    add('service_calls_total', 'counter', 'Number of calls of a service.',
+        [({'service': name}, stats['count']) for name, stats in services])
+    add('service_seconds_total', 'counter',
+        'Total runtime of a service in seconds.',
+        [({'service': name}, stats['total']) for name, stats in services])
+    add('service_seconds_max', 'gauge',
+        'Longest runtime of a service in seconds.',
+        [({'service': name}, stats['max']) for name, stats in services])
+
+    cache = metrics['history_cache']
+
+    if cache is not None:
+        add('history_cache_hits_total', 'counter',
+            'Number of history queries answered from memory.',
+            [({}, cache['hits'])])
+        add('history_cache_misses_total', 'counter',
+            'Number of history queries answered by the recorder.',
+            [({}, cache['misses'])])
+        add('history_cache_entities', 'gauge',
+            'Number of entities in the history cache.',
+            [({}, cache['entities'])])
+        add('history_cache_states', 'gauge',
+            'Number of states in the history cache.',
+            [({}, cache['states'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+def _prometheus_escape(value):
+    """ Escapes a Prometheus label value. """
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
 def _services_json(hass):
     """ Generate services data to JSONify. """
     return [{"domain": key, "services": value}
@@ -53,10 +53,11 @@ def listen(hass, service, callback):
 
     def discovery_event_listener(event):
         """ Listens for discovery events. """
-        if event.data[ATTR_SERVICE] in service:
-            callback(event.data[ATTR_SERVICE], event.data[ATTR_DISCOVERED])
+        callback(event.data[ATTR_SERVICE], event.data[ATTR_DISCOVERED])
 
-    hass.bus.listen(EVENT_PLATFORM_DISCOVERED, discovery_event_listener)
+    # The bus only calls the listener for discoveries of service
+    hass.bus.listen(EVENT_PLATFORM_DISCOVERED, discovery_event_listener,
+                    data_key=ATTR_SERVICE, values=service)
 
 
 def setup(hass, config):
@@ -7,17 +7,36 @@ For more details about this component, please refer to the documentation at
 https://home-assistant.io/components/history.html
 """
 import re
+import math
+import threading
 from datetime import timedelta
 from itertools import groupby
-from collections import defaultdict
+from operator import itemgetter
+from collections import defaultdict, deque
 
+import homeassistant.util as util
 import homeassistant.util.dt as dt_util
 import homeassistant.components.recorder as recorder
-from homeassistant.const import HTTP_BAD_REQUEST
+from homeassistant.core import State
+from homeassistant.const import HTTP_BAD_REQUEST, EVENT_STATE_CHANGED
 
 DOMAIN = 'history'
 DEPENDENCIES = ['recorder', 'http']
 
+# Keep recent states in memory to answer history queries without the database
+CONF_CACHE_HOURS = 'cache_hours'
+CONF_CACHE_STATES_PER_ENTITY = 'cache_states_per_entity'
+
+DEFAULT_CACHE_STATES_PER_ENTITY = 1000
+
+# Values of the statistics parameter of the history period API
+STATISTICS_PERIODS = {
+    '5minute': recorder.STATISTICS_5MINUTE,
+    'hour': recorder.STATISTICS_HOUR,
+}
+
+_CACHE = None
+
 URL_HISTORY_PERIOD = re.compile(
     r'/api/history/period(?:/(?P<date>\d{4}-\d{1,2}-\d{1,2})|)')
 
@@ -26,9 +45,14 @@ def last_5_states(entity_id):
     """ Return the last 5 states for entity_id. """
     entity_id = entity_id.lower()
 
-    query = """
-        SELECT * FROM states WHERE entity_id=? AND
-        last_changed=last_updated
+    if _CACHE is not None:
+        states = _CACHE.last_states(entity_id, 5)
+
+        if states is not None:
+            return states
+
+    query = recorder.STATES_QUERY + """
+        WHERE entity_id=? AND last_changed=last_updated
         ORDER BY state_id DESC LIMIT 0, 5
     """
 
@@ -39,6 +63,34 @@ def state_changes_during_period(start_time, end_time=None, entity_id=None):
     """
     Return states changes during UTC period start_time - end_time.
     """
+    result = defaultdict(list)
+
+    for cur_id, states in iter_state_changes_during_period(
+            start_time, end_time, entity_id):
+        result[cur_id].extend(states)
+
+    return result
+
+
+def iter_state_changes_during_period(start_time, end_time=None,
+                                     entity_id=None):
+    """
+    Generator that yields (entity_id, states) per entity for state changes
+    during UTC period start_time - end_time, ordered by entity_id. The states
+    are streamed from the database and have to be consumed before moving on
+    to the next entity.
+    """
+    if entity_id is not None:
+        entity_id = entity_id.lower()
+
+    if _CACHE is not None:
+        result = _CACHE.state_changes_during_period(
+            start_time, end_time, entity_id)
+
+        if result is not None:
+            yield from result.items()
+            return
+
     where = "last_changed=last_updated AND last_changed > ? "
     data = [start_time]
 
@@ -48,31 +100,158 @@ def state_changes_during_period(start_time, end_time=None, entity_id=None):
 
     if entity_id is not None:
         where += "AND entity_id = ? "
-        data.append(entity_id.lower())
-
-    query = ("SELECT * FROM states WHERE {} "
-             "ORDER BY entity_id, last_changed ASC").format(where)
-
-    states = recorder.query_states(query, data)
+        data.append(entity_id)
 
-    result = defaultdict(list)
+    query = recorder.STATES_QUERY + (
+        "WHERE {} ORDER BY entity_id, last_changed ASC").format(where)
 
     entity_ids = [entity_id] if entity_id is not None else None
 
     # Get the states at the start time
+    start_states = {}
+
     for state in get_states(start_time, entity_ids):
-        state.last_changed = start_time
-        result[state.entity_id].append(state)
+        start_states[state.entity_id] = State(
+            state.entity_id, state.state, state.attributes, start_time,
+            state.last_updated)
+
+    def with_start_state(cur_id, states):
+        """ Prepend the start state of cur_id to states. """
+        if cur_id in start_states:
+            yield start_states.pop(cur_id)
+
+        yield from states
+
+    def start_states_before(cur_id=None):
+        """ Yield entities that only have a start state up to cur_id. """
+        for start_id in sorted(start_states):
+            if cur_id is not None and start_id >= cur_id:
+                break
+
+            yield start_id, [start_states.pop(start_id)]
 
     # Append all changes to it
-    for entity_id, group in groupby(states, lambda state: state.entity_id):
-        result[entity_id].extend(group)
+    for cur_id, group in groupby(recorder.iter_states(query, data),
+                                 lambda state: state.entity_id):
+        yield from start_states_before(cur_id)
+        yield cur_id, with_start_state(cur_id, group)
+
+    yield from start_states_before()
+
+
+def statistics_during_period(start_time, end_time=None, entity_id=None,
+                             period=recorder.STATISTICS_HOUR):
+    """
+    Return the statistics of numeric entities per period seconds during UTC
+    period start_time - end_time. Returns a dict of entity_id to a list of
+    dicts with start, min, max, mean and last, ordered by start.
+    """
+    # Include the period that contains start_time
+    where = "period = ? AND start > ? "
+    data = [period, start_time - timedelta(seconds=period)]
+
+    if end_time is not None:
+        where += "AND start < ? "
+        data.append(end_time)
+
+    if entity_id is not None:
+        where += "AND entity_id = ? "
+        data.append(entity_id.lower())
+
+    query = ("SELECT entity_id, start, min, max, mean, last FROM statistics "
+             "WHERE {} ORDER BY entity_id, start").format(where)
+
+    result = defaultdict(list)
+
+    for row in recorder.query(query, data):
+        result[row[0]].append({
+            'start': dt_util.utc_from_timestamp(row[1]),
+            'min': row[2],
+            'max': row[3],
+            'mean': row[4],
+            'last': row[5],
+        })
 
     return result
 
 
+def downsample_states(states, start_time, resolution):
+    """
+    Generator that thins out the state changes of one entity for a graph.
+    The states are reduced to the first and the last state plus the lowest
+    and the highest numeric state per resolution seconds after start_time,
+    in the order they occurred. Peaks and the state a period ends with are
+    kept and no period holds more than four states, numeric or not. A
+    non-numeric state that repeats the state kept before it is left out.
+    """
+    period = None
+    # The first, lowest, highest and last state of the period as
+    # (value, sequence number, state) tuples
+    first = low = high = last = None
+    previous = None
+
+    def period_states():
+        """ Yield the states kept of the period in order. """
+        nonlocal previous
+
+        if first is None:
+            return
+
+        kept = {item[1]: item for item in (first, low, high, last)
+                if item is not None}
+
+        for sequence in sorted(kept):
+            value, _, state = kept[sequence]
+
+            if value is None and previous is not None and \
+               previous.state == state.state:
+                continue
+
+            previous = state
+            yield state
+
+    for sequence, state in enumerate(states):
+        value = _numeric_state(state)
+        index = int((state.last_changed - start_time).total_seconds() //
+                    resolution)
+        item = (value, sequence, state)
+
+        if index != period:
+            yield from period_states()
+            period = index
+            first = item
+            low = high = None
+
+        if value is not None:
+            low = min(low or item, item, key=itemgetter(0))
+            high = max(high or item, item, key=itemgetter(0))
+
+        last = item
+
+    yield from period_states()
+
+
+def _numeric_state(state):
+    """ Return the state as a float or None if it is not a number. """
+    try:
+        value = float(state.state)
+    except ValueError:
+        return None
+
+    return value if math.isfinite(value) else None
+
+
 def get_states(utc_point_in_time, entity_ids=None, run=None):
     """ Returns the states at a specific point in time. """
+    if entity_ids is not None:
+        entity_ids = [entity_id.lower() for entity_id in entity_ids]
+
+    if _CACHE is not None and run is None:
+        states = _CACHE.get_states(utc_point_in_time, entity_ids)
+
+        if states is not None:
+            return states
+
     if run is None:
         run = recorder.run_information(utc_point_in_time)
 
@@ -88,8 +267,7 @@ def get_states(utc_point_in_time, entity_ids=None, run=None):
             ",".join(['?'] * len(entity_ids)))
         where_data.extend(entity_ids)
 
-    query = """
-        SELECT * FROM states
+    query = recorder.STATES_QUERY + """
         INNER JOIN (
             SELECT max(state_id) AS max_state_id
             FROM states WHERE {}
@@ -107,9 +285,27 @@ def get_state(utc_point_in_time, entity_id, run=None):
     return states[0] if states else None
 
 
-# pylint: disable=unused-argument
+def cache_stats():
+    """ Return hit and miss counts of the recent states cache. """
+    return _CACHE.stats if _CACHE is not None else None
+
+
 def setup(hass, config):
     """ Setup history hooks. """
+    # pylint: disable=global-statement
+    global _CACHE
+
+    conf = config.get(DOMAIN, {})
+    cache_hours = util.convert(conf.get(CONF_CACHE_HOURS), float)
+
+    if cache_hours:
+        _CACHE = RecentStateCache(
+            hass, timedelta(hours=cache_hours),
+            util.convert(conf.get(CONF_CACHE_STATES_PER_ENTITY), int,
+                         DEFAULT_CACHE_STATES_PER_ENTITY))
+    else:
+        _CACHE = None
+
     hass.http.register_path(
         'GET',
         re.compile(
@@ -132,8 +328,28 @@ def _api_last_5_states(handler, path_match, data):
 
 
 def _api_history_period(handler, path_match, data):
-    """ Return history over a period of time. """
+    """ Return history over a period of time. Pass days for periods longer
+        than a day and statistics to return the statistics per 5minute or
+        hour instead of every state change.
+
+        Pass resolution in seconds or max_points per entity to downsample
+        the state changes with downsample_states. """
     date_str = path_match.group('date')
+    days = util.convert(data.get('days'), int, 1)
+    period = STATISTICS_PERIODS.get(data.get('statistics'))
+    resolution = util.convert(data.get('resolution'), float)
+    max_points = util.convert(data.get('max_points'), int)
+
+    downsample_valid = (resolution is None or resolution > 0) and \
+        (max_points is None or max_points >= 4)
+
+    if days < 1 or (period is None and 'statistics' in data) or \
+       not downsample_valid:
+        handler.write_json_message(
+            "Invalid days, statistics, resolution or max_points",
+            HTTP_BAD_REQUEST)
+        return
+
     one_day = timedelta(seconds=86400)
 
     if date_str:
@@ -145,11 +361,238 @@ def _api_history_period(handler, path_match, data):
 
         start_time = dt_util.as_utc(dt_util.start_of_local_day(start_date))
     else:
-        start_time = dt_util.utcnow() - one_day
+        start_time = dt_util.utcnow() - days * one_day
 
-    end_time = start_time + one_day
+    end_time = start_time + days * one_day
 
     entity_id = data.get('filter_entity_id')
 
-    handler.write_json(
-        state_changes_during_period(start_time, end_time, entity_id).values())
+    if period is not None:
+        handler.write_json({
+            cur_id: [dict(stats, start=dt_util.datetime_to_str(stats['start']))
+                     for stats in statistics]
+            for cur_id, statistics in statistics_during_period(
+                start_time, end_time, entity_id, period).items()})
+        return
+
+    if max_points is not None:
+        # Every period holds up to four states
+        resolution = max(resolution or 0, (end_time - start_time).
+                         total_seconds() / (max_points // 4))
+
+    if resolution is None:
+        handler.write_json_stream(
+            states for _, states
+            in iter_state_changes_during_period(
+                start_time, end_time, entity_id))
+    else:
+        handler.write_json_stream(
+            downsample_states(states, start_time, resolution) for _, states
+            in iter_state_changes_during_period(
+                start_time, end_time, entity_id))
+
+
+class RecentStateCache(object):
+    """
+    Keeps the states of the last window per entity in memory, up to
+    max_states per entity. Entities the recorder does not record are not
+    kept, so the cache answers like the recorder would. Neither are entities
+    the recorder throttles with a min_interval or deadband, queries that
+    involve them are left to the recorder.
+
+    The query methods return None if the cache does not hold all the states
+    needed to answer a query. The caller should then ask the recorder.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, hass, window, max_states):
+        self.window = window
+        self.max_states = max_states
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._states = {}
+        # Entities that lost states because of max_states or the window
+        self._truncated = set()
+        # Entities the recorder throttles, which are not kept
+        self._throttled = set()
+        # History before this point is not in the cache
+        self._start = dt_util.utcnow()
+
+        for state in hass.states.all():
+            if self._keeps(state.entity_id):
+                self._states[state.entity_id] = deque([state], max_states)
+
+        hass.bus.listen(EVENT_STATE_CHANGED, self._state_changed)
+
+    @property
+    def stats(self):
+        """ Return a dict with the cache statistics. """
+        with self._lock:
+            total = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else None,
+                'entities': len(self._states),
+                'states': sum(len(states) for states
+                              in self._states.values()),
+            }
+
+    def last_states(self, entity_id, count):
+        """ Return the last count state changes of entity_id, newest
+            first. """
+        with self._lock:
+            states = [state for state
+                      in reversed(self._states.get(entity_id, ()))
+                      if state.last_changed == state.last_updated][:count]
+
+            return self._hit(states if len(states) == count else None)
+
+    def state_changes_during_period(self, start_time, end_time=None,
+                                    entity_id=None):
+        """ Return state changes like history.state_changes_during_period. """
+        if entity_id is not None:
+            entity_id = entity_id.lower()
+
+        with self._lock:
+            if not self._covers(start_time, entity_id):
+                return self._hit(None)
+
+            result = defaultdict(list)
+
+            for state in self._states_at(start_time, entity_id):
+                # Report the start time as last change like the recorder
+                result[state.entity_id].append(State(
+                    state.entity_id, state.state, state.attributes,
+                    start_time, state.last_updated))
+
+            for cur_id in sorted(self._entity_ids(entity_id)):
+                result[cur_id].extend(sorted(
+                    (state for state in self._states[cur_id]
+                     if state.last_changed == state.last_updated and
+                     state.last_changed > start_time and
+                     (end_time is None or state.last_changed < end_time)),
+                    key=lambda state: state.last_changed))
+
+                if not result[cur_id]:
+                    del result[cur_id]
+
+            return self._hit(result)
+
+    def get_states(self, utc_point_in_time, entity_ids=None):
+        """ Return the states at a point in time like history.get_states. """
+        if entity_ids is not None:
+            entity_ids = [entity_id.lower() for entity_id in entity_ids]
+
+        with self._lock:
+            if entity_ids is None:
+                covered = self._covers(utc_point_in_time)
+            else:
+                covered = all(self._covers(utc_point_in_time, entity_id)
+                              for entity_id in entity_ids)
+
+            if not covered:
+                return self._hit(None)
+
+            return self._hit(
+                self._states_at(utc_point_in_time, entity_ids))
+
+    def _hit(self, result):
+        """ Count a cache hit if there is a result. """
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return result
+
+    def _entity_ids(self, entity_id=None):
+        """ Return entity ids to look at. """
+        if entity_id is None:
+            return list(self._states)
+
+        return [entity_id] if entity_id in self._states else []
+
+    def _covers(self, point_in_time, entity_id=None):
+        """ Return if the cache knows the state of the entity, or all
+            entities, at point_in_time and all changes after. """
+        if entity_id in self._throttled or \
+           entity_id is None and self._throttled:
+            return False
+
+        if entity_id is None:
+            return all(self._covers(point_in_time, cur_id)
+                       for cur_id in self._states) and \
+                self._start <= point_in_time
+
+        if entity_id not in self._truncated:
+            return self._start <= point_in_time
+
+        states = self._states[entity_id]
+
+        return bool(states) and states[0].last_updated < point_in_time
+
+    def _states_at(self, point_in_time, entity_ids=None):
+        """ Return the last state before point_in_time per entity. """
+        if entity_ids is None:
+            entity_ids = self._entity_ids()
+
+        result = []
+
+        for entity_id in entity_ids:
+            found = None
+
+            # Of states with the same time, the last added one wins
+            for state in self._states.get(entity_id, ()):
+                if state.last_updated < point_in_time and \
+                   (found is None or state.last_updated >= found.last_updated):
+                    found = state
+
+            if found is not None:
+                result.append(found)
+
+        return result
+
+    def _keeps(self, entity_id):
+        """ Return if the states of entity_id are kept. Remembers the
+            throttled entities the recorder has to answer for. """
+        if not recorder.records_entity(entity_id):
+            return False
+
+        if recorder.throttles_entity(entity_id):
+            self._throttled.add(entity_id)
+            return False
+
+        return True
+
+    def _state_changed(self, event):
+        """ Add a new state to the cache. """
+        state = event.data.get('new_state')
+
+        if state is None:
+            return
+
+        with self._lock:
+            if not self._keeps(state.entity_id):
+                return
+
+            states = self._states.get(state.entity_id)
+
+            if states is None:
+                states = self._states[state.entity_id] = deque(
+                    maxlen=self.max_states)
+
+            elif len(states) == self.max_states:
+                self._truncated.add(state.entity_id)
+
+            states.append(state)
+
+            # Keep the last state before the window so the state at the
+            # start of the window is known.
+            window_start = dt_util.utcnow() - self.window
+
+            while len(states) > 1 and states[1].last_updated < window_start:
+                states.popleft()
+                self._truncated.add(state.entity_id)
@@ -14,6 +14,7 @@ import gzip
 import os
 import random
 import string
+from collections.abc import Iterable
 from datetime import timedelta
 from homeassistant.util import Throttle
 from http.server import SimpleHTTPRequestHandler, HTTPServer
@@ -49,6 +50,9 @@ MIN_SEC_SESSION_CLEARING = timedelta(seconds=20)
 SESSION_TIMEOUT_SECONDS = 1800
 SESSION_KEY = 'sessionId'
 
+# Size in bytes at which streamed responses are written to the socket
+STREAM_BUFFER_SIZE = 65536
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -308,6 +312,31 @@ class RequestHandler(SimpleHTTPRequestHandler):
                 json.dumps(data, indent=4, sort_keys=True,
                            cls=rem.JSONEncoder).encode("UTF-8"))
 
+    def write_json_stream(self, data, status_code=HTTP_OK):
+        """
+        Helper method to return JSON to the caller without building the
+        whole document in memory. Generators inside data are written as
+        JSON arrays while they are iterated. The output is not indented.
+        """
+        self.send_response(status_code)
+        self.send_header(HTTP_HEADER_CONTENT_TYPE, CONTENT_TYPE_JSON)
+        self.set_session_cookie_header()
+        self.end_headers()
+
+        buffer = []
+        buffer_size = 0
+
+        for fragment in iter_json(data):
+            buffer.append(fragment)
+            buffer_size += len(fragment)
+
+            if buffer_size >= STREAM_BUFFER_SIZE:
+                self.wfile.write(''.join(buffer).encode("UTF-8"))
+                buffer = []
+                buffer_size = 0
+
+        self.wfile.write(''.join(buffer).encode("UTF-8"))
+
     def write_file(self, path):
         """ Returns a file to the user. """
         try:
@@ -407,6 +436,37 @@ class RequestHandler(SimpleHTTPRequestHandler):
         return None
 
 
+def iter_json(data, encoder=None):
+    """
+    Generator that yields the compact JSON representation of data in
+    fragments. Iterables that are not dicts or strings, like generators,
+    are consumed lazily and written as JSON arrays. Objects with an
+    as_json method, like states and events, write their cached JSON.
+    """
+    if encoder is None:
+        encoder = rem.JSONEncoder(separators=(',', ':'), sort_keys=True)
+
+    if hasattr(data, 'as_json'):
+        yield data.as_json()
+        return
+
+    if hasattr(data, 'as_dict') or \
+       isinstance(data, (str, bytes, dict)) or \
+       not isinstance(data, Iterable):
+        yield from encoder.iterencode(data)
+        return
+
+    yield '['
+
+    for index, item in enumerate(data):
+        if index:
+            yield ','
+
+        yield from iter_json(item, encoder)
+
+    yield ']'
+
+
 class ServerSession:
     """ A very simple session class """
     def __init__(self, session_id):
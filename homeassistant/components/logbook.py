@@ -6,11 +6,12 @@ Parses events and generates a human log.
 For more details about this component, please refer to the documentation at
 https://home-assistant.io/components/logbook.html
 """
+import logging
 from datetime import timedelta
-from itertools import groupby
+from functools import partial
 import re
 
-from homeassistant.core import State, DOMAIN as HA_DOMAIN
+from homeassistant.core import State, JobPriority, DOMAIN as HA_DOMAIN
 from homeassistant.const import (
     EVENT_STATE_CHANGED, STATE_NOT_HOME, STATE_ON, STATE_OFF,
     EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP, HTTP_BAD_REQUEST)
@@ -24,11 +25,23 @@ DEPENDENCIES = ['recorder', 'http']
 
 URL_LOGBOOK = re.compile(r'/api/logbook(?:/(?P<date>\d{4}-\d{1,2}-\d{1,2})|)')
 
-QUERY_EVENTS_BETWEEN = """
-    SELECT * FROM events WHERE time_fired > ? AND time_fired < ?
+EVENT_LOGBOOK_ENTRY = 'LOGBOOK_ENTRY'
+
+# The event types that have logbook entries
+LOGBOOK_EVENT_TYPES = (EVENT_STATE_CHANGED, EVENT_HOMEASSISTANT_START,
+                       EVENT_HOMEASSISTANT_STOP, EVENT_LOGBOOK_ENTRY)
+
+QUERY_ENTRIES = """
+    SELECT time_fired, name, message, domain, entity_id, event_id
+    FROM logbook_entries WHERE time_fired > ? AND time_fired < ? {}
+    ORDER BY time_fired, event_id
 """
 
-EVENT_LOGBOOK_ENTRY = 'LOGBOOK_ENTRY'
+QUERY_ENTRIES_BETWEEN = QUERY_ENTRIES.format('')
+
+# Events written per transaction while catching up with events recorded
+# before the logbook entries were written
+CATCH_UP_FETCH_SIZE = 500
 
 GROUP_BY_MINUTES = 15
 
@@ -37,6 +50,8 @@ ATTR_MESSAGE = 'message'
 ATTR_DOMAIN = 'domain'
 ATTR_ENTITY_ID = 'entity_id'
 
+_LOGGER = logging.getLogger(__name__)
+
 
 def log_entry(hass, name, message, domain=None, entity_id=None):
     """ Adds an entry to the logbook. """
@@ -53,15 +68,91 @@ def log_entry(hass, name, message, domain=None, entity_id=None):
 
 
 def setup(hass, config):
-    """ Listens for download events to download files. """
+    """ Writes logbook entries as events are recorded and serves them. """
+    catching_up = []
+
+    def write_entries(cur, events):
+        """ Writes the entries of recorded events. The first batch starts a
+            job that catches up with the events recorded before it. """
+        if not catching_up:
+            catching_up.append(True)
+            hass.get_executor(DOMAIN, 1).add_job(
+                JobPriority.EVENT_DEFAULT, (_catch_up, events[0][0]))
+
+        _write_entries(cur, events)
+
+    try:
+        recorder.register_processor(write_entries)
+    except RuntimeError:
+        _LOGGER.error("Recorder not set up, logbook entries are not written")
+
     hass.http.register_path('GET', URL_LOGBOOK, _handle_get_logbook)
 
     return True
 
 
+# pylint: disable=too-many-arguments
+def iter_entries(start_time, end_time, entity_id=None, domain=None,
+                 after=None, limit=None):
+    """
+    Generator that yields the (cursor, entry) tuples of the entries between
+    UTC start_time and end_time, optionally only of entity_id or domain.
+    Pass the cursor of the last entry as after to continue after it and
+    limit to return at most limit entries.
+    """
+    where = ""
+    data = [start_time, end_time]
+
+    if entity_id is not None:
+        where += "AND entity_id = ? "
+        data.append(entity_id.lower())
+
+    if domain is not None:
+        where += "AND domain = ? "
+        data.append(domain.lower())
+
+    if after is not None:
+        where += "AND time_fired >= ? AND (time_fired > ? OR event_id > ?) "
+        data.extend((after[0], after[0], after[1]))
+
+    query = QUERY_ENTRIES.format(where)
+
+    if limit is not None:
+        query += "LIMIT ?"
+        data.append(limit)
+
+    for row in recorder.iter_query(query, data):
+        yield (int(row[0]), row[5]), Entry(
+            dt_util.utc_from_timestamp(row[0]), row[1], row[2], row[3],
+            row[4])
+
+
 def _handle_get_logbook(handler, path_match, data):
-    """ Return logbook entries. """
+    """
+    Return logbook entries. Pass entity_id or domain to only return their
+    entries.
+
+    Pass limit to get at most limit entries as a dict with the entries and
+    next, the value of after to get the following entries or None if there
+    are no more.
+    """
     date_str = path_match.group('date')
+    limit = util.convert(data.get('limit'), int)
+    after = data.get('after')
+
+    try:
+        if after is not None:
+            after = tuple(int(value) for value in str(after).split(','))
+
+            if len(after) != 2:
+                raise ValueError(after)
+
+        if limit is not None and limit < 1:
+            raise ValueError(limit)
+
+    except ValueError:
+        handler.write_json_message("Invalid after or limit", HTTP_BAD_REQUEST)
+        return
 
     if date_str:
         start_date = dt_util.date_str_to_date(date_str)
@@ -76,11 +167,26 @@ def _handle_get_logbook(handler, path_match, data):
 
     end_day = start_day + timedelta(days=1)
 
-    events = recorder.query_events(
-        QUERY_EVENTS_BETWEEN,
-        (dt_util.as_utc(start_day), dt_util.as_utc(end_day)))
+    entries = iter_entries(
+        dt_util.as_utc(start_day), dt_util.as_utc(end_day),
+        data.get('entity_id'), data.get('domain'), after,
+        None if limit is None else limit + 1)
+
+    if limit is None:
+        handler.write_json_stream(entry for _, entry in entries)
+        return
 
-    handler.write_json(humanify(events))
+    page = list(entries)
+    next_cursor = None
+
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = '{},{}'.format(*page[-1][0])
+
+    handler.write_json({
+        'entries': [entry for _, entry in page],
+        'next': next_cursor,
+    })
 
 
 class Entry(object):
@@ -107,116 +213,156 @@ class Entry(object):
         }
 
 
-def humanify(events):
-    """
-    Generator that converts a list of events into Entry objects.
-
-    Will try to group events if possible:
-     - if 2+ sensor updates in GROUP_BY_MINUTES, show last
-     - if home assistant stop and start happen in same minute call it restarted
-    """
-    # pylint: disable=too-many-branches
-
-    # Group events in batches of GROUP_BY_MINUTES
-    for _, g_events in groupby(
-            events,
-            lambda event: event.time_fired.minute // GROUP_BY_MINUTES):
+def _state_changed_entry(event):
+    """ Returns the entry for a state changed event or None if the change
+        is not reported. The new state is a State for events that are
+        fired and a dict for events read from the database. """
+    # Do not report on new entities
+    if 'old_state' not in event.data:
+        return None
 
-        events_batch = list(g_events)
+    to_state = event.data.get('new_state')
 
-        # Keep track of last sensor states
-        last_sensor_event = {}
+    if not isinstance(to_state, State):
+        to_state = State.from_dict(to_state)
 
-        # group HA start/stop events
-        # Maps minute of event to 1: stop, 2: stop + start
-        start_stop_events = {}
+    # if last_changed != last_updated only attributes have changed
+    # we do not report on that yet. Also filter auto groups.
+    if not to_state or \
+       to_state.last_changed != to_state.last_updated or \
+       to_state.domain == 'group' and \
+       to_state.attributes.get('auto', False):
+        return None
 
-        # Process events
-        for event in events_batch:
-            if event.event_type == EVENT_STATE_CHANGED:
-                entity_id = event.data.get('entity_id')
+    domain = to_state.domain
 
-                if entity_id is None:
-                    continue
+    return Entry(
+        event.time_fired,
+        name=to_state.name,
+        message=_entry_message_from_state(domain, to_state),
+        domain=domain,
+        entity_id=to_state.entity_id)
 
-                if entity_id.startswith('sensor.'):
-                    last_sensor_event[entity_id] = event
 
-            elif event.event_type == EVENT_HOMEASSISTANT_STOP:
-                if event.time_fired.minute in start_stop_events:
-                    continue
+def _logbook_entry(event):
+    """ Returns the entry of a custom logbook entry event. """
+    domain = event.data.get(ATTR_DOMAIN)
+    entity_id = event.data.get(ATTR_ENTITY_ID)
+    if domain is None and entity_id is not None:
+        try:
+            domain = util.split_entity_id(str(entity_id))[0]
+        except IndexError:
+            pass
 
-                start_stop_events[event.time_fired.minute] = 1
+    return Entry(
+        event.time_fired, event.data.get(ATTR_NAME),
+        event.data.get(ATTR_MESSAGE), domain, entity_id)
 
-            elif event.event_type == EVENT_HOMEASSISTANT_START:
-                if event.time_fired.minute not in start_stop_events:
-                    continue
 
-                start_stop_events[event.time_fired.minute] = 2
-
-        # Yield entries
-        for event in events_batch:
-            if event.event_type == EVENT_STATE_CHANGED:
-
-                # Do not report on new entities
-                if 'old_state' not in event.data:
-                    continue
-
-                to_state = State.from_dict(event.data.get('new_state'))
-
-                # if last_changed != last_updated only attributes have changed
-                # we do not report on that yet. Also filter auto groups.
-                if not to_state or \
-                   to_state.last_changed != to_state.last_updated or \
-                   to_state.domain == 'group' and \
-                   to_state.attributes.get('auto', False):
-                    continue
-
-                domain = to_state.domain
-
-                # Skip all but the last sensor state
-                if domain == 'sensor' and \
-                   event != last_sensor_event[to_state.entity_id]:
-                    continue
-
-                yield Entry(
-                    event.time_fired,
-                    name=to_state.name,
-                    message=_entry_message_from_state(domain, to_state),
-                    domain=domain,
-                    entity_id=to_state.entity_id)
-
-            elif event.event_type == EVENT_HOMEASSISTANT_START:
-                if start_stop_events.get(event.time_fired.minute) == 2:
-                    continue
-
-                yield Entry(
+def _write_entries(cur, events):
+    """
+    Writes the entries of (event_id, event) tuples to the logbook_entries
+    table, grouped the way they are shown:
+     - the entry of a sensor replaces the older entry of the same sensor in
+       the same GROUP_BY_MINUTES
+     - a start in the same minute as a stop turns the stop into a restart
+    """
+    rows = []
+
+    for event_id, event in events:
+        if event.event_type == EVENT_STATE_CHANGED:
+            entry = _state_changed_entry(event)
+
+            if entry is None:
+                continue
+
+            if entry.domain == 'sensor':
+                group_key = '{}:{}'.format(
+                    entry.entity_id,
+                    int(entry.when.timestamp()) // (GROUP_BY_MINUTES * 60))
+            else:
+                group_key = None
+
+            rows.append((event_id, entry, group_key))
+
+        elif event.event_type == EVENT_HOMEASSISTANT_STOP:
+            rows.append((event_id, Entry(
+                event.time_fired, "Home Assistant", "stopped",
+                domain=HA_DOMAIN), None))
+
+        elif event.event_type == EVENT_HOMEASSISTANT_START:
+            # The stop may be in this batch
+            _insert_entries(cur, rows)
+            rows = []
+
+            minute = event.time_fired.replace(second=0, microsecond=0)
+            cur.execute(
+                "UPDATE logbook_entries SET message='restarted', event_id=? "
+                "WHERE time_fired >= ? AND time_fired < ? AND domain=? AND "
+                "message IN ('stopped', 'restarted')",
+                (event_id, minute, minute + timedelta(minutes=1), HA_DOMAIN))
+
+            if not cur.rowcount:
+                rows.append((event_id, Entry(
                     event.time_fired, "Home Assistant", "started",
-                    domain=HA_DOMAIN)
-
-            elif event.event_type == EVENT_HOMEASSISTANT_STOP:
-                if start_stop_events.get(event.time_fired.minute) == 2:
-                    action = "restarted"
-                else:
-                    action = "stopped"
-
-                yield Entry(
-                    event.time_fired, "Home Assistant", action,
-                    domain=HA_DOMAIN)
-
-            elif event.event_type == EVENT_LOGBOOK_ENTRY:
-                domain = event.data.get(ATTR_DOMAIN)
-                entity_id = event.data.get(ATTR_ENTITY_ID)
-                if domain is None and entity_id is not None:
-                    try:
-                        domain = util.split_entity_id(str(entity_id))[0]
-                    except IndexError:
-                        pass
-
-                yield Entry(
-                    event.time_fired, event.data.get(ATTR_NAME),
-                    event.data.get(ATTR_MESSAGE), domain,
-                    entity_id)
+                    domain=HA_DOMAIN), None))
+
+        elif event.event_type == EVENT_LOGBOOK_ENTRY:
+            rows.append((event_id, _logbook_entry(event), None))
+
+    _insert_entries(cur, rows)
+
+
+def _insert_entries(cur, rows):
+    """ Inserts (event_id, entry, group_key) tuples. An entry replaces the
+        entry with the same group key unless that one is of a newer event,
+        so the entries of older events can be written afterwards. """
+    cur.executemany(
+        "INSERT OR REPLACE INTO logbook_entries (event_id, time_fired, name,"
+        "message, domain, entity_id, group_key) SELECT ?, ?, ?, ?, ?, ?, ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM logbook_entries "
+        "WHERE group_key = ? AND event_id > ?)",
+        [(event_id, entry.when, entry.name, entry.message, entry.domain,
+          entry.entity_id, group_key, group_key, event_id)
+         for event_id, entry, group_key in rows])
+
+
+def _catch_up(before_event_id):
+    """ Writes the entries of the events recorded before before_event_id
+        that are newer than the newest entry before it, like all events the
+        first time the logbook runs. Every CATCH_UP_FETCH_SIZE events are
+        written in a transaction of their own so recording does not wait
+        for the whole backlog. """
+    after_event_id = recorder.query(
+        "SELECT max(event_id) FROM logbook_entries WHERE event_id < ?",
+        (before_event_id,))[0][0] or 0
+
+    while after_event_id is not None:
+        after_event_id = recorder.run_in_transaction(partial(
+            _catch_up_events, after_event_id=after_event_id,
+            before_event_id=before_event_id))
+
+
+def _catch_up_events(cur, after_event_id, before_event_id):
+    """ Writes the entries of up to CATCH_UP_FETCH_SIZE events between the
+        event ids. Returns the id of the last event or None if there were
+        no events left. """
+    cur.execute(
+        "SELECT * FROM events WHERE event_id > ? AND event_id < ? "
+        "AND event_type IN ({}) ORDER BY event_id LIMIT ?".format(
+            ", ".join("?" * len(LOGBOOK_EVENT_TYPES))),
+        (after_event_id, before_event_id) + LOGBOOK_EVENT_TYPES +
+        (CATCH_UP_FETCH_SIZE,))
+    rows = cur.fetchall()
+
+    if not rows:
+        return None
+
+    events = [(row[0], recorder.row_to_event(row)) for row in rows]
+    _write_entries(cur, [(event_id, event) for event_id, event in events
+                         if event is not None])
+
+    return rows[-1][0]
 
 
 def _entry_message_from_state(domain, state):
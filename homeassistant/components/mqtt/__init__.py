@@ -59,12 +59,19 @@ def publish(hass, topic, payload, qos=None):
 def subscribe(hass, topic, callback, qos=DEFAULT_QOS):
     """ Subscribe to a topic. """
     def mqtt_topic_subscriber(event):
-        """ Match subscribed MQTT topic. """
-        if _match_topic(topic, event.data[ATTR_TOPIC]):
-            callback(event.data[ATTR_TOPIC], event.data[ATTR_PAYLOAD],
-                     event.data[ATTR_QOS])
-
-    hass.bus.listen(EVENT_MQTT_MESSAGE_RECEIVED, mqtt_topic_subscriber)
+        """ Calls callback for a message of the subscribed MQTT topic. """
+        callback(event.data[ATTR_TOPIC], event.data[ATTR_PAYLOAD],
+                 event.data[ATTR_QOS])
+
+    # The bus only calls the subscriber for matching topics. Topics without
+    # wildcards are looked up directly.
+    if '+' in topic or '#' in topic:
+        hass.bus.listen(
+            EVENT_MQTT_MESSAGE_RECEIVED, mqtt_topic_subscriber,
+            predicate=lambda data: _match_topic(topic, data[ATTR_TOPIC]))
+    else:
+        hass.bus.listen(EVENT_MQTT_MESSAGE_RECEIVED, mqtt_topic_subscriber,
+                        data_key=ATTR_TOPIC, values=(topic,))
 
     if topic not in MQTT_CLIENT.topics:
         MQTT_CLIENT.subscribe(topic, qos)
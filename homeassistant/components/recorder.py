@@ -1,3 +1,4 @@
+# pylint: disable=too-many-lines
 """
 homeassistant.components.recorder
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -8,38 +9,124 @@ For more details about this component, please refer to the documentation at
 https://home-assistant.io/components/recorder.html
 """
 import logging
+import math
 import threading
 import queue
+import time
 import sqlite3
-from datetime import datetime, date
+from collections import namedtuple
+from datetime import datetime, date, timedelta
 import json
 import atexit
+import zlib
+from urllib.request import pathname2url
 
 from homeassistant.core import Event, EventOrigin, State
+import homeassistant.util as util
 import homeassistant.util.dt as date_util
-from homeassistant.remote import JSONEncoder
 from homeassistant.const import (
     MATCH_ALL, EVENT_TIME_CHANGED, EVENT_STATE_CHANGED,
-    EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP)
+    EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP,
+    ATTR_UNIT_OF_MEASUREMENT, ATTR_NOW)
 
 DOMAIN = "recorder"
 DEPENDENCIES = []
 
 DB_FILE = 'home-assistant.db'
 
+CONF_COMMIT_INTERVAL = 'commit_interval'
+CONF_COMMIT_MAX_EVENTS = 'commit_max_events'
+
+# Seconds to wait for more events before committing a batch. The default of
+# 0 only batches events that are already queued, adding no latency.
+DEFAULT_COMMIT_INTERVAL = 0
+DEFAULT_COMMIT_MAX_EVENTS = 500
+
+# Write-ahead logging lets readers run concurrently with the writer
+CONF_WAL = 'wal'
+CONF_READ_CONNECTIONS = 'read_connections'
+CONF_SYNCHRONOUS = 'synchronous'
+CONF_CACHE_SIZE = 'cache_size'
+CONF_MMAP_SIZE = 'mmap_size'
+
+DEFAULT_READ_CONNECTIONS = 2
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Record only the included and none of the excluded domains and entities,
+# for state changed events, and event types
+CONF_INCLUDE = 'include'
+CONF_EXCLUDE = 'exclude'
+CONF_DOMAINS = 'domains'
+CONF_ENTITIES = 'entities'
+CONF_EVENT_TYPES = 'event_types'
+
+# Per entity id, the minimum number of seconds between recorded states and
+# the minimum change of a numeric state to be recorded
+CONF_MIN_INTERVAL = 'min_interval'
+CONF_DEADBAND = 'deadband'
+
+CONF_PURGE_DAYS = 'purge_days'
+CONF_PURGE_STATISTICS_DAYS = 'purge_statistics_days'
+CONF_PURGE_VACUUM = 'purge_vacuum'
+
+# Statistics are small and cover long periods, they are kept longer
+DEFAULT_PURGE_STATISTICS_DAYS = 365
+
+SERVICE_PURGE = 'purge'
+ATTR_KEEP_DAYS = 'keep_days'
+
+# How often the recorder purges when purge_days is set
+PURGE_INTERVAL = timedelta(hours=1)
+# Rows deleted per transaction while purging
+PURGE_CHUNK_SIZE = 1000
+# Pages released per incremental vacuum step
+PURGE_VACUUM_PAGES = 1000
+
 RETURN_ROWCOUNT = "rowcount"
 RETURN_LASTROWID = "lastrowid"
 RETURN_ONE_ROW = "one_row"
 
+# Rows fetched at once when iterating over query results
+ITER_FETCH_SIZE = 500
+
+# Periods in seconds that numeric states are rolled up into statistics
+STATISTICS_5MINUTE = 300
+STATISTICS_HOUR = 3600
+STATISTICS_PERIODS = (STATISTICS_5MINUTE, STATISTICS_HOUR)
+
+# Number of distinct attribute sets kept parsed in memory
+ATTRIBUTES_CACHE_SIZE = 2048
+
+# Queued to have the recorder thread purge rows recorded before purge_before
+# and statistics of periods that started before statistics_purge_before
+PurgeTask = namedtuple('PurgeTask',
+                       ['purge_before', 'statistics_purge_before'])
+
+# The domains, entity ids and event types of an include or exclude config
+RecordFilter = namedtuple('RecordFilter',
+                          ['domains', 'entity_ids', 'event_types'])
+
+# Selects the states with their attributes for query_states and iter_states,
+# append the WHERE clause
+STATES_QUERY = """
+    SELECT states.*, state_attributes.shared_attrs FROM states
+    LEFT JOIN state_attributes
+    ON states.attributes_id = state_attributes.attributes_id
+"""
+
 _INSTANCE = None
 _LOGGER = logging.getLogger(__name__)
+# Parsed attributes per attributes_id, so states share them
+_ATTRIBUTES = {}
 
 
 def query(sql_query, arguments=None):
-    """ Query the database. """
+    """ Query the database. Queries are executed using a read-only
+        connection if the recorder runs in WAL mode. """
     _verify_instance()
 
-    return _INSTANCE.query(sql_query, arguments)
+    return _INSTANCE.read_query(sql_query, arguments)
 
 
 def query_states(state_query, arguments=None):
@@ -58,11 +145,90 @@ def query_events(event_query, arguments=None):
         if row is not None]
 
 
+def iter_states(state_query, arguments=None):
+    """ Generator that yields states while they are read from the database.
+        Uses a read-only connection if the recorder runs in WAL mode. """
+    _verify_instance()
+
+    for row in _INSTANCE.iter_query(state_query, arguments):
+        state = row_to_state(row)
+
+        if state is not None:
+            yield state
+
+
+def iter_events(event_query, arguments=None):
+    """ Generator that yields events while they are read from the database.
+        Uses a read-only connection if the recorder runs in WAL mode. """
+    _verify_instance()
+
+    for row in _INSTANCE.iter_query(event_query, arguments):
+        event = row_to_event(row)
+
+        if event is not None:
+            yield event
+
+
+def iter_query(sql_query, arguments=None):
+    """ Generator that yields the rows of a query while they are read from
+        the database. Uses a read-only connection if the recorder runs in
+        WAL mode. """
+    _verify_instance()
+
+    yield from _INSTANCE.iter_query(sql_query, arguments)
+
+
+def register_processor(processor):
+    """ Have processor(cursor, events) called with the recorded events as
+        (event_id, event) tuples after every batch is written. It runs in
+        the recorder thread and in the transaction that records the batch,
+        so it can store data derived from the events. """
+    _verify_instance()
+
+    _INSTANCE.processors.append(processor)
+
+
+def records_entity(entity_id):
+    """ Returns if the state changes of entity_id pass the include and
+        exclude filters of the recorder. """
+    _verify_instance()
+
+    return _INSTANCE.records_entity(entity_id)
+
+
+def throttles_entity(entity_id):
+    """ Returns if the recorder drops or holds back some state changes of
+        entity_id because of a min_interval or deadband. """
+    _verify_instance()
+
+    return _INSTANCE.throttles_entity(entity_id)
+
+
+def run_in_transaction(func):
+    """ Calls func(cursor) in a transaction of its own and returns the
+        result. Recording waits for it, so keep it short. """
+    _verify_instance()
+
+    return _INSTANCE.run_in_transaction(func)
+
+
 def row_to_state(row):
-    """ Convert a databsae row to a state. """
+    """ Convert a databsae row to a state. Rows of STATES_QUERY come with
+        their attributes, others have them looked up. """
     try:
+        try:
+            attributes_id = row['attributes_id']
+        except IndexError:
+            # Query did not select the attributes_id column
+            attributes_id = None
+
+        if attributes_id is None:
+            attributes = json.loads(row[3])
+        else:
+            attributes = dict(_shared_attributes(attributes_id, row))
+
         return State(
-            row[1], row[2], json.loads(row[3]),
+            row[1], row[2], attributes,
             date_util.utc_from_timestamp(row[4]),
             date_util.utc_from_timestamp(row[5]))
     except ValueError:
@@ -71,6 +237,34 @@ def row_to_state(row):
         return None
 
 
+def _shared_attributes(attributes_id, row):
+    """ Returns the parsed attributes stored with attributes_id, read from
+        the shared_attrs column of row if the query joined it. Attribute
+        ids are never reused so the result is kept to share it. """
+    attributes = _ATTRIBUTES.get(attributes_id)
+
+    if attributes is not None:
+        return attributes
+
+    try:
+        shared_attrs = row['shared_attrs']
+    except IndexError:
+        # Query did not join the state_attributes table
+        found = _INSTANCE.read_query(
+            "SELECT shared_attrs FROM state_attributes WHERE attributes_id=?",
+            (attributes_id,), RETURN_ONE_ROW)
+        shared_attrs = found[0] if found else None
+
+    attributes = json.loads(shared_attrs) if shared_attrs else {}
+
+    if len(_ATTRIBUTES) >= ATTRIBUTES_CACHE_SIZE:
+        _ATTRIBUTES.clear()
+
+    _ATTRIBUTES[attributes_id] = attributes
+
+    return attributes
+
+
 def row_to_event(row):
     """ Convert a databse row to an event. """
     try:
@@ -90,7 +284,7 @@ def run_information(point_in_time=None):
     if point_in_time is None or point_in_time > _INSTANCE.recording_start:
         return RecorderRun()
 
-    run = _INSTANCE.query(
+    run = _INSTANCE.read_query(
         "SELECT * FROM recorder_runs WHERE start<? AND END>?",
         (point_in_time, point_in_time), return_value=RETURN_ONE_ROW)
 
@@ -102,11 +296,100 @@ def setup(hass, config):
     # pylint: disable=global-statement
     global _INSTANCE
 
-    _INSTANCE = Recorder(hass)
+    conf = config.get(DOMAIN, {})
+
+    commit_interval = util.convert(conf.get(CONF_COMMIT_INTERVAL), float,
+                                   DEFAULT_COMMIT_INTERVAL)
+    commit_max_events = util.convert(conf.get(CONF_COMMIT_MAX_EVENTS), int,
+                                     DEFAULT_COMMIT_MAX_EVENTS)
+
+    pragmas = {
+        'cache_size': util.convert(conf.get(CONF_CACHE_SIZE), int),
+        'mmap_size': util.convert(conf.get(CONF_MMAP_SIZE), int),
+    }
+
+    synchronous = conf.get(CONF_SYNCHRONOUS)
+
+    if synchronous is not None:
+        synchronous = str(synchronous).upper()
+
+        if synchronous not in SYNCHRONOUS_MODES:
+            _LOGGER.error("Invalid value for %s: %s. Valid values: %s",
+                          CONF_SYNCHRONOUS, synchronous,
+                          ", ".join(SYNCHRONOUS_MODES))
+            return False
+
+        pragmas['synchronous'] = synchronous
+
+    purge_days = util.convert(conf.get(CONF_PURGE_DAYS), int)
+
+    throttles = {}
+
+    for key in (CONF_MIN_INTERVAL, CONF_DEADBAND):
+        values = conf.get(key) or {}
+        throttles[key] = {
+            str(entity_id).lower(): util.convert(value, float)
+            for entity_id, value in values.items()} \
+            if isinstance(values, dict) else None
+
+        if throttles[key] is None or None in throttles[key].values():
+            _LOGGER.error("Invalid value for %s: %s. Specify a number per "
+                          "entity id", key, values)
+            return False
+
+    _INSTANCE = Recorder(
+        hass, commit_interval, max(1, commit_max_events),
+        wal=util.convert(conf.get(CONF_WAL), bool, False),
+        read_connections=util.convert(conf.get(CONF_READ_CONNECTIONS), int,
+                                      DEFAULT_READ_CONNECTIONS),
+        pragmas={key: value for key, value in pragmas.items()
+                 if value is not None},
+        purge_days=purge_days,
+        purge_statistics_days=util.convert(
+            conf.get(CONF_PURGE_STATISTICS_DAYS), int,
+            DEFAULT_PURGE_STATISTICS_DAYS),
+        purge_vacuum=util.convert(conf.get(CONF_PURGE_VACUUM), bool, False),
+        include=_record_filter(conf.get(CONF_INCLUDE)),
+        exclude=_record_filter(conf.get(CONF_EXCLUDE)),
+        min_intervals=throttles[CONF_MIN_INTERVAL],
+        deadbands=throttles[CONF_DEADBAND])
+
+    def purge_service(call):
+        """ Purge rows older than keep_days, defaults to purge_days. """
+        keep_days = util.convert(call.data.get(ATTR_KEEP_DAYS), int,
+                                 purge_days)
+
+        if keep_days is None:
+            _LOGGER.error("Specify %s to purge the recorder database",
+                          ATTR_KEEP_DAYS)
+            return
+
+        _INSTANCE.purge(keep_days)
+
+    hass.services.register(DOMAIN, SERVICE_PURGE, purge_service)
 
     return True
 
 
+def _record_filter(conf):
+    """ Returns the RecordFilter of an include or exclude config. Values
+        are lists or comma separated strings. """
+    conf = conf if isinstance(conf, dict) else {}
+
+    def values(key, lower=True):
+        """ Returns the set of values of key. """
+        value = conf.get(key) or []
+
+        if isinstance(value, str):
+            value = value.split(',')
+
+        return set(str(item).strip().lower() if lower else str(item).strip()
+                   for item in value)
+
+    return RecordFilter(values(CONF_DOMAINS), values(CONF_ENTITIES),
+                        values(CONF_EVENT_TYPES, False))
+
+
 class RecorderRun(object):
     """ Represents a recorder run. """
     def __init__(self, row=None):
@@ -160,104 +443,571 @@ class RecorderRun(object):
 class Recorder(threading.Thread):
     """
     Threaded recorder
+
+    States with a numeric value and a unit of measurement are also rolled
+    up into the statistics table: the min, max, mean and last value per
+    entity for every period in STATISTICS_PERIODS. The rollups are updated
+    in the transaction that records the states. Components can store more
+    derived data the same way with register_processor.
+
+    Events are written in batches: everything that is queued, up to
+    commit_max_events, is stored using a single transaction. Specify a
+    commit_interval to wait that many seconds for more events to arrive
+    before committing.
+
+    With wal=True the database uses write-ahead logging and read_query
+    uses a pool of read_connections read-only connections, so readers
+    do not have to wait for the writer or for each other.
+
+    With purge_days set, rows older than that are deleted every
+    PURGE_INTERVAL. Statistics are kept for purge_statistics_days, or as
+    long as the other rows if that is longer. Purging happens in chunks of
+    PURGE_CHUNK_SIZE rows in between recording events.
+
+    The include and exclude RecordFilters, min_intervals and deadbands are
+    applied by the event listener so filtered events are never queued.
+    A state of an entity in min_intervals is held back if it is less than
+    that many seconds newer than the last recorded state, the last held
+    back state is recorded once the interval has passed. A numeric state
+    of an entity in deadbands is not recorded if it differs less than that
+    from the last recorded state.
     """
-    def __init__(self, hass):
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, hass, commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 commit_max_events=DEFAULT_COMMIT_MAX_EVENTS, wal=False,
+                 read_connections=DEFAULT_READ_CONNECTIONS, pragmas=None,
+                 purge_days=None, purge_vacuum=False, include=None,
+                 exclude=None, min_intervals=None, deadbands=None,
+                 purge_statistics_days=DEFAULT_PURGE_STATISTICS_DAYS):
         threading.Thread.__init__(self)
 
         self.hass = hass
         self.conn = None
         self.queue = queue.Queue()
         self.quit_object = object()
+        self._quit_queued = False
+        self._queue_lock = threading.Lock()
         self.lock = threading.Lock()
         self.recording_start = date_util.utcnow()
         self.utc_offset = date_util.now().utcoffset().total_seconds()
+        self.commit_interval = commit_interval
+        self.commit_max_events = commit_max_events
+        self.wal = wal
+        self.read_connections = read_connections
+        self.pragmas = pragmas or {}
+        self._read_pool = None
+        self._last_event_id = 0
+        self.purge_days = purge_days
+        self.purge_statistics_days = purge_statistics_days
+        self.purge_vacuum = purge_vacuum
+        # Maps serialized attributes to their row in state_attributes
+        self._attributes_ids = {}
+        # Maps (entity_id, period) to the statistics of the current period
+        self._statistics = {}
+        self.processors = []
+        self.include = include or RecordFilter(set(), set(), set())
+        self.exclude = exclude or RecordFilter(set(), set(), set())
+        self.min_intervals = min_intervals or {}
+        self.deadbands = deadbands or {}
+        # Maps entity ids that are throttled to the time and numeric value
+        # of their last recorded state
+        self._last_recorded = {}
+        # Maps entity ids to the event and numeric value of their last state
+        # that came too soon after the last recorded state
+        self._pending = {}
+        self._purge_task = None
+        self._next_purge = None
 
         def start_recording(event):
             """ Start recording. """
             self.start()
 
         hass.bus.listen_once(EVENT_HOMEASSISTANT_START, start_recording)
-        hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, self.shutdown)
         hass.bus.listen(MATCH_ALL, self.event_listener)
 
+    # pylint: disable=too-many-branches
     def run(self):
         """ Start processing events to save. """
         self._setup_connection()
         self._setup_run()
 
         while True:
-            event = self.queue.get()
+            # Do not wait for events while there is purging left to do
+            batch = self._get_batch(self._purge_task is None)
+            quit_requested = bool(batch) and batch[-1] is self.quit_object
+            events = []
+
+            for item in batch:
+                if isinstance(item, PurgeTask):
+                    # A newer purge request replaces the one in progress
+                    if self._purge_task is not None:
+                        self.queue.task_done()
+                    self._purge_task = item
 
-            if event == self.quit_object:
+                elif item is not self.quit_object:
+                    events.append(item)
+
+            if events:
+                self.record_events(events)
+
+            if quit_requested:
                 self._close_run()
                 self._close_connection()
+
+            elif self._purge_task is not None and \
+                    self._purge(*self._purge_task):
+                self._purge_task = None
                 self.queue.task_done()
+
+            # Pending purge tasks are marked done when they finish
+            for item in batch:
+                if not isinstance(item, PurgeTask):
+                    self.queue.task_done()
+
+            if quit_requested:
+                if self._purge_task is not None:
+                    self.queue.task_done()
                 return
 
-            elif event.event_type == EVENT_TIME_CHANGED:
-                self.queue.task_done()
-                continue
+            if self.purge_days is not None and \
+                    date_util.utcnow() >= self._next_purge:
+                self._next_purge = date_util.utcnow() + PURGE_INTERVAL
+                self.purge(self.purge_days)
+
+    def _get_batch(self, block=True):
+        """ Wait till an event is queued, then collect more events till the
+            queue is empty, commit_max_events is reached or commit_interval
+            has passed. The quit object is always the last item.
+            Returns an empty list if block is False and the queue is empty.
+        """
+        try:
+            batch = [self.queue.get(block)]
+        except queue.Empty:
+            return []
 
-            event_id = self.record_event(event)
+        deadline = time.monotonic() + self.commit_interval
 
-            if event.event_type == EVENT_STATE_CHANGED:
-                self.record_state(
-                    event.data['entity_id'], event.data.get('new_state'),
-                    event_id)
+        while len(batch) < self.commit_max_events and \
+                batch[-1] is not self.quit_object:
+            timeout = deadline - time.monotonic()
+
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
 
-            self.queue.task_done()
+        return batch
 
     def event_listener(self, event):
-        """ Listens for new events on the EventBus and puts them
-            in the process queue. """
-        self.queue.put(event)
+        """ Listens for new events on the EventBus and puts the events
+            that are recorded in the process queue. """
+        with self._queue_lock:
+            # Events queued after the quit object would never be processed
+            # and block_till_done would wait forever.
+            if not self._quit_queued:
+                if event.event_type == EVENT_TIME_CHANGED and self._pending:
+                    self._queue_pending(event.data.get(ATTR_NOW))
+
+                if self._should_record(event):
+                    self.queue.put(event)
+
+        # Shut down from this listener so the stop event itself is recorded
+        # before the quit object is processed.
+        if event.event_type == EVENT_HOMEASSISTANT_STOP:
+            self.shutdown(event)
+
+    def _should_record(self, event):
+        """ Returns if an event passes the filters. Call with the queue lock
+            held. """
+        event_type = event.event_type
+
+        if event_type == EVENT_TIME_CHANGED or \
+           event_type in self.exclude.event_types or \
+           self.include.event_types and \
+           event_type not in self.include.event_types:
+            return False
+
+        entity_id = event.data.get('entity_id')
+
+        if event_type != EVENT_STATE_CHANGED or entity_id is None:
+            return True
+
+        if not self.records_entity(entity_id):
+            return False
+
+        if self.throttles_entity(entity_id):
+            return not self._throttled(entity_id, event)
+
+        return True
+
+    def records_entity(self, entity_id):
+        """ Returns if the state changes of entity_id pass the filters. """
+        if EVENT_STATE_CHANGED in self.exclude.event_types or \
+           self.include.event_types and \
+           EVENT_STATE_CHANGED not in self.include.event_types:
+            return False
+
+        domain = util.split_entity_id(entity_id)[0]
+
+        if domain in self.exclude.domains or \
+           entity_id in self.exclude.entity_ids:
+            return False
+
+        return not (self.include.domains or self.include.entity_ids) or \
+            domain in self.include.domains or \
+            entity_id in self.include.entity_ids
+
+    def throttles_entity(self, entity_id):
+        """ Returns if entity_id has a min_interval or deadband. """
+        return entity_id in self.min_intervals or entity_id in self.deadbands
+
+    def _throttled(self, entity_id, event):
+        """ Returns if the state of the state changed event is too close to
+            or too soon after the last recorded state of entity_id. The last
+            state that is only too soon is recorded when min_interval has
+            passed, unless a newer state is recorded or dropped first. Call
+            with the queue lock held. """
+        state = event.data.get('new_state')
+
+        if state is None:
+            self._last_recorded.pop(entity_id, None)
+            self._pending.pop(entity_id, None)
+            return False
+
+        try:
+            value = float(state.state)
+        except ValueError:
+            value = None
+
+        last = self._last_recorded.get(entity_id)
+
+        if last is not None:
+            last_updated, last_value = last
+            min_interval = self.min_intervals.get(entity_id)
+            deadband = self.deadbands.get(entity_id)
+
+            if deadband is not None and None not in (value, last_value) and \
+               abs(value - last_value) < deadband:
+                # The held back state is older, recording it would record
+                # a state the entity no longer has
+                self._pending.pop(entity_id, None)
+                return True
+
+            if min_interval is not None and \
+               (state.last_updated - last_updated).total_seconds() < \
+               min_interval:
+                self._pending[entity_id] = (event, value)
+                return True
+
+        self._pending.pop(entity_id, None)
+        self._last_recorded[entity_id] = (state.last_updated, value)
+        return False
+
+    def _queue_pending(self, now=None):
+        """ Queues the held back states of entities whose min_interval since
+            the last recorded state has passed at now, or all of them. Call
+            with the queue lock held. """
+        for entity_id, (event, value) in list(self._pending.items()):
+            state = event.data['new_state']
+
+            if now is not None and \
+               (now - self._last_recorded[entity_id][0]).total_seconds() < \
+               self.min_intervals[entity_id]:
+                continue
+
+            del self._pending[entity_id]
+            self._last_recorded[entity_id] = (state.last_updated, value)
+            self.queue.put(event)
 
     def shutdown(self, event):
         """ Tells the recorder to shut down. """
-        self.queue.put(self.quit_object)
+        with self._queue_lock:
+            if not self._quit_queued:
+                # Record the held back states before quitting
+                self._queue_pending()
+                self._quit_queued = True
+                self.queue.put(self.quit_object)
+
+    def purge(self, keep_days):
+        """ Have the recorder thread delete rows older than keep_days. """
+        now = date_util.utcnow()
+        purge_before = now - timedelta(days=keep_days)
+        statistics_purge_before = now - timedelta(
+            days=max(keep_days, self.purge_statistics_days))
+
+        with self._queue_lock:
+            if not self._quit_queued:
+                self.queue.put(
+                    PurgeTask(purge_before, statistics_purge_before))
+
+    def record_events(self, events):
+        """ Save a batch of events, and the states they carry, to the database
+            using a single transaction. If the batch violates a constraint,
+            the events are saved one at a time and only the events that
+            violate it are skipped. """
+        try:
+            self._record_events(events)
+            return
+        except sqlite3.IntegrityError:
+            if len(events) == 1:
+                _LOGGER.exception("Error recording event %s", events[0])
+                return
+
+        _LOGGER.warning("Error recording %d events, recording them one at a "
+                        "time", len(events))
+
+        for event in events:
+            try:
+                self._record_events([event])
+            except sqlite3.IntegrityError:
+                _LOGGER.exception("Error recording event %s", event)
 
-    def record_state(self, entity_id, state, event_id):
-        """ Save a state to the database. """
+    def _record_events(self, events):
+        """ Save events in a transaction. Raises sqlite3.IntegrityError if
+            nothing was saved because the events violate a constraint. """
         now = date_util.utcnow()
+        event_rows = []
+        state_rows = []
+        statistic_values = []
+        recorded = []
+
+        for event in events:
+            self._last_event_id += 1
+            recorded.append((self._last_event_id, event))
+
+            event_rows.append((
+                self._last_event_id, event.event_type,
+                event.data_json(), str(event.origin),
+                now, event.time_fired, self.utc_offset))
+
+            if event.event_type == EVENT_STATE_CHANGED:
+                new_state = event.data.get('new_state')
+                state_rows.append(self._state_row(
+                    event.data['entity_id'], new_state,
+                    self._last_event_id, now))
+
+                value = _statistic_value(new_state)
+
+                if value is not None:
+                    statistic_values.append(
+                        (new_state.entity_id, new_state.last_updated, value))
 
+        try:
+            with self.lock, self.conn:
+                _LOGGER.debug("Recording %d events and %d states",
+                              len(event_rows), len(state_rows))
+
+                cur = self.conn.cursor()
+
+                cur.executemany(
+                    "INSERT INTO events ("
+                    "event_id, event_type, event_data, origin, created,"
+                    "time_fired, utc_offset) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    event_rows)
+
+                if state_rows:
+                    cur.executemany(
+                        "INSERT INTO states ("
+                        "entity_id, state, attributes_id, last_changed,"
+                        "last_updated, created, utc_offset, event_id"
+                        ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [row[:2] + (self._attributes_id(cur, row[2]),) +
+                         row[3:] for row in state_rows])
+
+                if statistic_values:
+                    self._update_statistics(cur, statistic_values)
+
+                for processor in self.processors:
+                    try:
+                        processor(cur, recorded)
+                    except Exception:  # pylint: disable=broad-except
+                        # Do not lose the events
+                        _LOGGER.exception("Error in recorder processor %s",
+                                          processor)
+
+        except sqlite3.IntegrityError:
+            self._last_event_id = self._fetch_last_event_id()
+            # Rows added by the failed transaction are gone
+            self._attributes_ids.clear()
+            self._statistics.clear()
+            raise
+
+    def _state_row(self, entity_id, state, event_id, now):
+        """ Returns the values to insert into the states table, with the
+            serialized attributes in place of the attributes id. """
         # State got deleted
         if state is None:
             state_state = ''
-            state_attr = '{}'
+            shared_attrs = '{}'
             last_changed = last_updated = now
         else:
             state_state = state.state
-            state_attr = json.dumps(state.attributes)
+            shared_attrs = state.attributes_json()
             last_changed = state.last_changed
             last_updated = state.last_updated
 
-        info = (
-            entity_id, state_state, state_attr, last_changed, last_updated,
+        return (
+            entity_id, state_state, shared_attrs, last_changed, last_updated,
             now, self.utc_offset, event_id)
 
-        self.query(
-            "INSERT INTO states ("
-            "entity_id, state, attributes, last_changed, last_updated,"
-            "created, utc_offset, event_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            info)
-
-    def record_event(self, event):
-        """ Save an event to the database. """
-        info = (
-            event.event_type, json.dumps(event.data, cls=JSONEncoder),
-            str(event.origin), date_util.utcnow(), event.time_fired,
-            self.utc_offset
-        )
-
-        return self.query(
-            "INSERT INTO events ("
-            "event_type, event_data, origin, created, time_fired, utc_offset"
-            ") VALUES (?, ?, ?, ?, ?, ?)", info, RETURN_LASTROWID)
+    def _attributes_id(self, cur, shared_attrs):
+        """ Returns the id of the serialized attributes, storing them if they
+            are not in the database yet. """
+        attributes_id = self._attributes_ids.get(shared_attrs)
+
+        if attributes_id is not None:
+            return attributes_id
+
+        attributes_hash = zlib.crc32(shared_attrs.encode('utf-8'))
+
+        cur.execute(
+            "SELECT attributes_id FROM state_attributes "
+            "WHERE hash=? AND shared_attrs=?", (attributes_hash, shared_attrs))
+        row = cur.fetchone()
+
+        if row is not None:
+            attributes_id = row[0]
+        else:
+            cur.execute(
+                "INSERT INTO state_attributes (hash, shared_attrs) "
+                "VALUES (?, ?)", (attributes_hash, shared_attrs))
+            attributes_id = cur.lastrowid
+
+        if len(self._attributes_ids) >= ATTRIBUTES_CACHE_SIZE:
+            self._attributes_ids.clear()
+
+        self._attributes_ids[shared_attrs] = attributes_id
+
+        return attributes_id
+
+    def _update_statistics(self, cur, values):
+        """ Adds (entity_id, time, value) tuples to the statistics of the
+            periods they fall in. A period that is not in memory, like the
+            current one after a restart, is continued from the database. """
+        changed = {}
+
+        for entity_id, value_time, value in values:
+            timestamp = int(_adapt_datetime(value_time))
+
+            for period in STATISTICS_PERIODS:
+                start = timestamp - timestamp % period
+                key = (entity_id, period, start)
+                stats = self._statistics.get(key[:2])
+
+                if stats is None or stats[0] != start:
+                    cur.execute(
+                        "SELECT start, min, max, mean, last, count "
+                        "FROM statistics WHERE entity_id=? AND period=? "
+                        "AND start=?", key)
+                    row = cur.fetchone()
+                    stats = list(row) if row else [start, value, value, 0,
+                                                   value, 0]
+                    self._statistics[key[:2]] = stats
+
+                stats[1] = min(stats[1], value)
+                stats[2] = max(stats[2], value)
+                stats[5] += 1
+                stats[3] += (value - stats[3]) / stats[5]
+                stats[4] = value
+
+                changed[key] = stats
+
+        cur.executemany(
+            "INSERT OR REPLACE INTO statistics (entity_id, period, start,"
+            "min, max, mean, last, count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [key + tuple(stats[1:]) for key, stats in changed.items()])
+
+    # pylint: disable=too-many-return-statements
+    def _purge(self, purge_before, statistics_purge_before):
+        """ Delete up to PURGE_CHUNK_SIZE rows recorded before purge_before
+            or statistics of periods that started before
+            statistics_purge_before. States are deleted before the
+            attributes and events they refer to.
+            Returns True when there is nothing left to purge. """
+        if self.query(
+                """DELETE FROM states WHERE state_id IN (
+                   SELECT state_id FROM states WHERE created < ? LIMIT ?)""",
+                (purge_before, PURGE_CHUNK_SIZE), RETURN_ROWCOUNT):
+            return False
+
+        if self.query(
+                """DELETE FROM state_attributes WHERE attributes_id IN (
+                   SELECT attributes_id FROM state_attributes
+                   WHERE NOT EXISTS (
+                       SELECT 1 FROM states WHERE
+                       states.attributes_id = state_attributes.attributes_id)
+                   LIMIT ?)""", (PURGE_CHUNK_SIZE,), RETURN_ROWCOUNT):
+            self._attributes_ids.clear()
+            return False
+
+        if self.query(
+                """DELETE FROM logbook_entries WHERE entry_id IN (
+                   SELECT entry_id FROM logbook_entries
+                   WHERE time_fired < ? LIMIT ?)""",
+                (purge_before, PURGE_CHUNK_SIZE), RETURN_ROWCOUNT):
+            return False
+
+        # Keep events that are still referenced by a state
+        oldest_state = self.query(
+            """SELECT event_id FROM states WHERE event_id IS NOT NULL
+               ORDER BY state_id LIMIT 1""", return_value=RETURN_ONE_ROW)
+        keep_from = (oldest_state[0] if oldest_state
+                     else self._last_event_id + 1)
+
+        if self.query(
+                """DELETE FROM events WHERE event_id IN (
+                   SELECT event_id FROM events
+                   WHERE time_fired < ? AND event_id < ? LIMIT ?)""",
+                (purge_before, keep_from, PURGE_CHUNK_SIZE), RETURN_ROWCOUNT):
+            return False
+
+        if self.query(
+                """DELETE FROM statistics WHERE statistic_id IN (
+                   SELECT statistic_id FROM statistics
+                   WHERE period IN ({}) AND start < ? LIMIT ?)""".format(
+                       ", ".join("?" * len(STATISTICS_PERIODS))),
+                STATISTICS_PERIODS +
+                (statistics_purge_before, PURGE_CHUNK_SIZE), RETURN_ROWCOUNT):
+            return False
+
+        self.query("DELETE FROM recorder_runs WHERE end < ?", (purge_before,))
+
+        if self.purge_vacuum:
+            free_pages = self._freelist_count()
+
+            self.query("PRAGMA incremental_vacuum({})".format(
+                PURGE_VACUUM_PAGES))
+
+            # Continue while the vacuum makes progress
+            if 0 < self._freelist_count() < free_pages:
+                return False
+
+        _LOGGER.info("Purged recorder data from before %s",
+                     date_util.datetime_to_local_str(purge_before))
+        return True
+
+    def _freelist_count(self):
+        """ Returns the number of unused pages in the database file. """
+        return self.query("PRAGMA freelist_count",
+                          return_value=RETURN_ONE_ROW)[0]
+
+    def _fetch_last_event_id(self):
+        """ Returns the highest event id stored in the database. """
+        return self.query("SELECT max(event_id) FROM events",
+                          return_value=RETURN_ONE_ROW)[0] or 0
+
+    def run_in_transaction(self, func):
+        """ Calls func(cursor) in a transaction and returns the result. """
+        with self.lock, self.conn:
+            return func(self.conn.cursor())
 
     def query(self, sql_query, data=None, return_value=None):
         """ Query the database. """
         try:
-            with self.conn, self.lock:
+            with self.lock, self.conn:
                 _LOGGER.debug("Running query %s", sql_query)
 
                 cur = self.conn.cursor()
@@ -281,6 +1031,71 @@ class Recorder(threading.Thread):
                 "Error querying the database using: %s", sql_query)
             return []
 
+    def read_query(self, sql_query, data=None, return_value=None):
+        """ Run a query that does not modify the database. Uses a connection
+            from the read pool if one is available. """
+        read_pool, conn = self._get_read_connection()
+
+        if conn is None:
+            return self.query(sql_query, data, return_value)
+
+        try:
+            _LOGGER.debug("Running read query %s", sql_query)
+
+            cur = conn.cursor()
+
+            if data is not None:
+                cur.execute(sql_query, data)
+            else:
+                cur.execute(sql_query)
+
+            if return_value == RETURN_ONE_ROW:
+                return cur.fetchone()
+            else:
+                return cur.fetchall()
+
+        finally:
+            read_pool.put(conn)
+
+    def iter_query(self, sql_query, data=None):
+        """ Generator that yields the rows of a query that does not modify
+            the database. Without a read pool all rows are fetched at once
+            so the lock is not held while iterating. """
+        read_pool, conn = self._get_read_connection()
+
+        if conn is None:
+            yield from self.query(sql_query, data)
+            return
+
+        try:
+            _LOGGER.debug("Running read query %s", sql_query)
+
+            cur = conn.cursor()
+            cur.execute(sql_query, data if data is not None else ())
+
+            rows = cur.fetchmany(ITER_FETCH_SIZE)
+
+            while rows:
+                yield from rows
+                rows = cur.fetchmany(ITER_FETCH_SIZE)
+
+        finally:
+            read_pool.put(conn)
+
+    def _get_read_connection(self):
+        """ Returns the read pool and a connection taken from it. The
+            connection is None if there is no pool or all connections are
+            in use, for example by a query that is being iterated. """
+        read_pool = self._read_pool
+
+        if read_pool is None:
+            return None, None
+
+        try:
+            return read_pool, read_pool.get_nowait()
+        except queue.Empty:
+            return read_pool, None
+
     def block_till_done(self):
         """ Blocks till all events processed. """
         self.queue.join()
@@ -291,6 +1106,11 @@ class Recorder(threading.Thread):
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
 
+        if self.wal:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+
+        self._set_pragmas(self.conn, self.pragmas)
+
         # Make sure the database is closed whenever Python exits
         # without the STOP event being fired.
         atexit.register(self._close_connection)
@@ -319,92 +1139,61 @@ class Recorder(threading.Thread):
                         'migration_id integer primary key, performed integer)')
             migration_id = 0
 
-        if migration_id < 1:
-            self.query("""
-                CREATE TABLE recorder_runs (
-                    run_id integer primary key,
-                    start integer,
-                    end integer,
-                    closed_incorrect integer default 0,
-                    created integer)
-            """)
-
-            self.query("""
-                CREATE TABLE events (
-                    event_id integer primary key,
-                    event_type text,
-                    event_data text,
-                    origin text,
-                    created integer)
-            """)
-            self.query(
-                'CREATE INDEX events__event_type ON events(event_type)')
-
-            self.query("""
-                CREATE TABLE states (
-                    state_id integer primary key,
-                    entity_id text,
-                    state text,
-                    attributes text,
-                    last_changed integer,
-                    last_updated integer,
-                    created integer)
-            """)
-            self.query('CREATE INDEX states__entity_id ON states(entity_id)')
-
-            save_migration(1)
-
-        if migration_id < 2:
-            self.query("""
-                ALTER TABLE events
-                ADD COLUMN time_fired integer
-            """)
-
-            self.query('UPDATE events SET time_fired=created')
-
-            save_migration(2)
-
-        if migration_id < 3:
-            utc_offset = self.utc_offset
-
-            self.query("""
-                ALTER TABLE recorder_runs
-                ADD COLUMN utc_offset integer
-            """)
-
-            self.query("""
-                ALTER TABLE events
-                ADD COLUMN utc_offset integer
-            """)
-
-            self.query("""
-                ALTER TABLE states
-                ADD COLUMN utc_offset integer
-            """)
-
-            self.query("UPDATE recorder_runs SET utc_offset=?", [utc_offset])
-            self.query("UPDATE events SET utc_offset=?", [utc_offset])
-            self.query("UPDATE states SET utc_offset=?", [utc_offset])
-
-            save_migration(3)
-
-        if migration_id < 4:
-            # We had a bug where we did not save utc offset for recorder runs
-            self.query(
-                """UPDATE recorder_runs SET utc_offset=?
-                   WHERE utc_offset IS NULL""", [self.utc_offset])
-
-            self.query("""
-                ALTER TABLE states
-                ADD COLUMN event_id integer
-            """)
-
-            save_migration(4)
+        for version, migrate in enumerate(
+                _MIGRATIONS[migration_id:], migration_id + 1):
+            migrate(self)
+            save_migration(version)
+
+        self._last_event_id = self._fetch_last_event_id()
+        self._attributes_ids.clear()
+        self._statistics.clear()
+        _ATTRIBUTES.clear()
+
+        # auto_vacuum 2 is INCREMENTAL
+        if self.purge_vacuum and self.query(
+                'PRAGMA auto_vacuum', return_value=RETURN_ONE_ROW)[0] != 2:
+            _LOGGER.warning("Enabling incremental vacuum, this requires a "
+                            "one time vacuum of the database")
+            self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.conn.execute('VACUUM')
+
+        if self.wal and self.read_connections > 0:
+            self._setup_read_pool(db_path)
+
+        self._next_purge = date_util.utcnow()
+
+    def _setup_read_pool(self, db_path):
+        """ Open the read-only connections used by read_query. """
+        read_pool = queue.Queue()
+        uri = 'file:{}?mode=ro'.format(pathname2url(db_path))
+        # synchronous only affects writes
+        pragmas = {key: value for key, value in self.pragmas.items()
+                   if key != 'synchronous'}
+
+        for _ in range(self.read_connections):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._set_pragmas(conn, pragmas)
+            read_pool.put(conn)
+
+        self._read_pool = read_pool
+
+    @staticmethod
+    def _set_pragmas(conn, pragmas):
+        """ Apply pragmas to a connection. Values are validated in setup. """
+        for name, value in pragmas.items():
+            conn.execute('PRAGMA {}={}'.format(name, value))
 
     def _close_connection(self):
         """ Close connection to the database. """
         _LOGGER.info("Closing database")
         atexit.unregister(self._close_connection)
+
+        read_pool, self._read_pool = self._read_pool, None
+
+        while read_pool is not None and not read_pool.empty():
+            read_pool.get_nowait().close()
+
         self.conn.close()
 
     def _setup_run(self):
@@ -427,6 +1216,214 @@ class Recorder(threading.Thread):
             (date_util.utcnow(), self.recording_start))
 
 
+def _migration_1(instance):
+    """ Create the tables for runs, events and states. """
+    instance.query("""
+        CREATE TABLE recorder_runs (
+            run_id integer primary key,
+            start integer,
+            end integer,
+            closed_incorrect integer default 0,
+            created integer)
+    """)
+
+    instance.query("""
+        CREATE TABLE events (
+            event_id integer primary key,
+            event_type text,
+            event_data text,
+            origin text,
+            created integer)
+    """)
+    instance.query(
+        'CREATE INDEX events__event_type ON events(event_type)')
+
+    instance.query("""
+        CREATE TABLE states (
+            state_id integer primary key,
+            entity_id text,
+            state text,
+            attributes text,
+            last_changed integer,
+            last_updated integer,
+            created integer)
+    """)
+    instance.query('CREATE INDEX states__entity_id ON states(entity_id)')
+
+
+def _migration_2(instance):
+    """ Add the time events were fired. """
+    instance.query("""
+        ALTER TABLE events
+        ADD COLUMN time_fired integer
+    """)
+
+    instance.query('UPDATE events SET time_fired=created')
+
+
+def _migration_3(instance):
+    """ Add the UTC offset to runs, events and states. """
+    utc_offset = instance.utc_offset
+
+    instance.query("""
+        ALTER TABLE recorder_runs
+        ADD COLUMN utc_offset integer
+    """)
+
+    instance.query("""
+        ALTER TABLE events
+        ADD COLUMN utc_offset integer
+    """)
+
+    instance.query("""
+        ALTER TABLE states
+        ADD COLUMN utc_offset integer
+    """)
+
+    instance.query("UPDATE recorder_runs SET utc_offset=?", [utc_offset])
+    instance.query("UPDATE events SET utc_offset=?", [utc_offset])
+    instance.query("UPDATE states SET utc_offset=?", [utc_offset])
+
+
+def _migration_4(instance):
+    """ Fix the UTC offset of runs and add the event of states. """
+    # We had a bug where we did not save utc offset for recorder runs
+    instance.query(
+        """UPDATE recorder_runs SET utc_offset=?
+           WHERE utc_offset IS NULL""", [instance.utc_offset])
+
+    instance.query("""
+        ALTER TABLE states
+        ADD COLUMN event_id integer
+    """)
+
+
+def _migration_5(instance):
+    """ Add indexes for the history and logbook queries. """
+    instance.query("""
+        CREATE INDEX states__state_changes ON
+        states (last_changed, last_updated, entity_id)""")
+    instance.query("""
+        CREATE INDEX states__significant_changes ON
+        states (entity_id, last_changed)""")
+    instance.query("""
+        CREATE INDEX states__created ON
+        states (created, entity_id)""")
+    instance.query("""
+        CREATE INDEX events__time_fired ON
+        events (time_fired)""")
+
+
+def _migration_6(instance):
+    """ Store attributes once and share them by states. """
+    # AUTOINCREMENT prevents ids of purged attributes from being reused
+    instance.query("""
+        CREATE TABLE state_attributes (
+            attributes_id integer primary key autoincrement,
+            hash integer,
+            shared_attrs text)
+    """)
+    instance.query("""
+        CREATE INDEX state_attributes__hash ON
+        state_attributes (hash)""")
+
+    instance.query("""
+        ALTER TABLE states
+        ADD COLUMN attributes_id integer
+    """)
+    instance.query("""
+        CREATE INDEX states__attributes_id ON
+        states (attributes_id)""")
+
+
+def _migration_7(instance):
+    """ Add rollups of numeric states for history over long periods. """
+    instance.query("""
+        CREATE TABLE statistics (
+            statistic_id integer primary key,
+            entity_id text,
+            period integer,
+            start integer,
+            min real,
+            max real,
+            mean real,
+            last real,
+            count integer)
+    """)
+    instance.query("""
+        CREATE UNIQUE INDEX statistics__entity_period_start ON
+        statistics (entity_id, period, start)""")
+    instance.query("""
+        CREATE INDEX statistics__period_start ON
+        statistics (period, start)""")
+
+
+def _migration_8(instance):
+    """ Add the entries of the logbook, written by the logbook component
+        when the events are recorded. Grouped entries share a group key. """
+    instance.query("""
+        CREATE TABLE logbook_entries (
+            entry_id integer primary key,
+            event_id integer,
+            time_fired integer,
+            name text,
+            message text,
+            domain text,
+            entity_id text,
+            group_key text unique)
+    """)
+    instance.query("""
+        CREATE INDEX logbook_entries__time_fired ON
+        logbook_entries (time_fired)""")
+
+
+def _migration_9(instance):
+    """ Add indexes for the entity and domain filters of the logbook. """
+    instance.query("""
+        CREATE INDEX logbook_entries__entity_id ON
+        logbook_entries (entity_id, time_fired)""")
+    instance.query("""
+        CREATE INDEX logbook_entries__domain ON
+        logbook_entries (domain, time_fired)""")
+
+
+def _migration_10(instance):
+    """ Entries are ordered by time fired and event id, include the event
+        id in the indexes so reading entries in order needs no sort. """
+    instance.query("DROP INDEX logbook_entries__time_fired")
+    instance.query("DROP INDEX logbook_entries__entity_id")
+    instance.query("DROP INDEX logbook_entries__domain")
+    instance.query("""
+        CREATE INDEX logbook_entries__time_fired ON
+        logbook_entries (time_fired, event_id)""")
+    instance.query("""
+        CREATE INDEX logbook_entries__entity_id ON
+        logbook_entries (entity_id, time_fired, event_id)""")
+    instance.query("""
+        CREATE INDEX logbook_entries__domain ON
+        logbook_entries (domain, time_fired, event_id)""")
+
+
+# Migrations of the database schema, in order of their migration id
+_MIGRATIONS = [_migration_1, _migration_2, _migration_3, _migration_4,
+               _migration_5, _migration_6, _migration_7, _migration_8,
+               _migration_9, _migration_10]
+
+
+def _statistic_value(state):
+    """ Returns the value of a state to roll up into statistics, or None if
+        the state has no unit of measurement or is not a number. """
+    if state is None or ATTR_UNIT_OF_MEASUREMENT not in state.attributes:
+        return None
+
+    try:
+        value = float(state.state)
+    except ValueError:
+        return None
+
+    return value if math.isfinite(value) else None
+
+
 def _adapt_datetime(datetimestamp):
     """ Turn a datetime into an integer for in the DB. """
     return date_util.as_utc(datetimestamp.replace(microsecond=0)).timestamp()
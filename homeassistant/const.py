@@ -148,6 +148,7 @@ URL_API_SERVICES_SERVICE = "/api/services/{}/{}"
 URL_API_EVENT_FORWARD = "/api/event_forwarding"
 URL_API_COMPONENTS = "/api/components"
 URL_API_BOOTSTRAP = "/api/bootstrap"
+URL_API_METRICS = "/api/metrics"
 
 HTTP_OK = 200
 HTTP_CREATED = 201
@@ -169,4 +170,5 @@ HTTP_HEADER_CACHE_CONTROL = "Cache-Control"
 HTTP_HEADER_EXPIRES = "Expires"
 
 CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_TEXT_PLAIN = "text/plain"
 CONTENT_TYPE_MULTIPART = 'multipart/x-mixed-replace; boundary={}'
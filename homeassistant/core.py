@@ -1,3 +1,4 @@
+# pylint: disable=too-many-lines
 """
 homeassistant
 ~~~~~~~~~~~~~
@@ -8,25 +9,32 @@ of entities and react to changes.
 
 import os
 import time
+import json
 import logging
 import signal
 import threading
 import enum
 import re
 import functools as ft
-from collections import namedtuple
+import itertools
+import asyncio
+import concurrent.futures
+from collections import namedtuple, OrderedDict
+from datetime import timedelta
 
 from homeassistant.const import (
     __version__, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP,
     SERVICE_HOMEASSISTANT_STOP, EVENT_TIME_CHANGED, EVENT_STATE_CHANGED,
     EVENT_CALL_SERVICE, ATTR_NOW, ATTR_DOMAIN, ATTR_SERVICE, MATCH_ALL,
     EVENT_SERVICE_EXECUTED, ATTR_SERVICE_CALL_ID, EVENT_SERVICE_REGISTERED,
-    TEMP_CELCIUS, TEMP_FAHRENHEIT, ATTR_FRIENDLY_NAME)
+    TEMP_CELCIUS, TEMP_FAHRENHEIT, ATTR_FRIENDLY_NAME, ATTR_ENTITY_ID)
 from homeassistant.exceptions import (
     HomeAssistantError, InvalidEntityFormatError)
 import homeassistant.util as util
 import homeassistant.util.dt as date_util
 import homeassistant.util.location as location
+from homeassistant.util.async_pool import AsyncPool
+from homeassistant.util.scheduler import Scheduler
 import homeassistant.helpers.temperature as temp_helper
 from homeassistant.config import get_default_config_dir
 
@@ -39,10 +47,23 @@ TIMER_INTERVAL = 1  # seconds
 SERVICE_CALL_LIMIT = 10  # seconds
 
 # Define number of MINIMUM worker threads.
-# During bootstrap of HA (see bootstrap._setup_component()) worker threads
-# will be added for each component that polls devices.
 MIN_WORKER_THREAD = 2
 
+# The worker pool adds threads up to MAX_WORKER_THREAD when jobs have to
+# wait longer than WORKER_SCALE_UP_LATENCY seconds.
+MAX_WORKER_THREAD = 20
+WORKER_SCALE_UP_LATENCY = 1  # seconds
+
+# Default number of threads of the executor of an integration
+EXECUTOR_WORKER_THREAD = 2
+
+# File in the config dir the states are persisted to
+STATES_FILE = "home-assistant_states.json"
+STATES_FILE_VERSION = 1
+
+# Restored states that no entity has set this long after start are removed
+STATES_RESTORE_TIMEOUT = 300  # seconds
+
 # Pattern for validating entity IDs (format: <domain>.<entity>)
 ENTITY_ID_PATTERN = re.compile(r"^(?P<domain>\w+)\.(?P<entity>\w+)$")
 
@@ -51,16 +72,80 @@ _LOGGER = logging.getLogger(__name__)
 # Temporary to support deprecated methods
 _MockHA = namedtuple("MockHomeAssistant", ['bus'])
 
+# A listener on the EventBus, optionally only for events with one of values
+# as data_key in the event data and for which predicate returns True
+_Listener = namedtuple("Listener", ['func', 'data_key', 'values', 'predicate'])
+
+
+def callback(func):
+    """ Marks a listener or service as safe to run on the event loop of the
+    asyncio core: it does not block and does no I/O. """
+    func.hass_callback = True
+    return func
+
+
+def is_async_func(func):
+    """ Returns if func runs on the event loop of the asyncio core. """
+    return getattr(func, 'hass_callback', False) or \
+        asyncio.iscoroutinefunction(func)
+
+
+def _match_listeners(candidates, event_data):
+    """ Returns the listeners of (predicate, listener) pairs whose predicate
+    is None or returns True for the event data. """
+    listeners = []
+
+    for predicate, func in candidates:
+        if predicate is not None:
+            try:
+                if not predicate(event_data):
+                    continue
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Bus:Exception in predicate of %s", func)
+                continue
+
+        listeners.append(func)
+
+    return tuple(listeners)
+
+
+@asyncio.coroutine
+def _log_job_exception(coro):
+    """ Runs the coroutine of a job and logs the exception it raises. """
+    try:
+        yield from coro
+    except Exception:  # pylint: disable=broad-except
+        _LOGGER.exception("BusHandler:Exception doing job")
+
+
+def _run_coroutine(coro):
+    """ Runs a coroutine to completion on a new event loop. """
+    loop = asyncio.new_event_loop()
+
+    try:
+        loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
 
 class HomeAssistant(object):
-    """ Core class to route all communication to right components. """
+    """
+    Core class to route all communication to right components.
 
-    def __init__(self):
-        self.pool = pool = create_worker_pool()
+    With use_asyncio the bus, services and timer run on an asyncio event loop
+    in one thread. Coroutine listeners and functions marked with callback
+    run on the loop, other listeners run in an executor.
+    """
+
+    def __init__(self, use_asyncio=False):
+        self.pool = pool = create_worker_pool(
+            max_workers=MAX_WORKER_THREAD, use_asyncio=use_asyncio)
         self.bus = EventBus(pool)
         self.services = ServiceRegistry(self.bus, pool)
         self.states = StateMachine(self.bus)
         self.config = Config()
+        self.executors = {}
+        self._executors_lock = threading.Lock()
 
     def start(self):
         """ Start home assistant. """
@@ -97,6 +182,71 @@ class HomeAssistant(object):
 
         self.stop()
 
+    def persist_states(self):
+        """
+        Restores the states saved in the config dir and saves the states
+        every minute if they changed and when Home Assistant stops.
+
+        Call before components are set up so they start with the last known
+        states instead of unknown.
+        """
+        path = self.config.path(STATES_FILE)
+        count = self.states.restore(path)
+
+        if count:
+            _LOGGER.info("Restored %d states from %s", count, path)
+
+        saved_version = [self.states.version]
+
+        def save_states(event):
+            """ Saves the states if they changed since the last save. """
+            version = self.states.version
+
+            if version == saved_version[0]:
+                return
+
+            try:
+                self.states.save(path)
+                saved_version[0] = version
+            except OSError:
+                _LOGGER.exception("Unable to save states to %s", path)
+
+        def remove_restored(now):
+            """ Removes the restored states no entity has claimed. """
+            removed = self.states.remove_restored()
+
+            if removed:
+                _LOGGER.info("Removed %d restored states of entities that "
+                             "no longer exist", removed)
+
+        def schedule_remove_restored(event):
+            """ Gives the entities time to report their states. """
+            import homeassistant.helpers.event as helper
+            helper.track_point_in_utc_time(
+                self, remove_restored,
+                date_util.utcnow() +
+                timedelta(seconds=STATES_RESTORE_TIMEOUT))
+
+        self.bus.listen_time_pattern(save_states, (0,))
+        self.bus.listen(EVENT_HOMEASSISTANT_STOP, save_states)
+        self.bus.listen_once(EVENT_HOMEASSISTANT_START,
+                             schedule_remove_restored)
+
+    def get_executor(self, name, worker_count=EXECUTOR_WORKER_THREAD):
+        """
+        Returns the worker pool for blocking work of the integration name,
+        like polling devices. It has a bounded number of threads so a slow
+        integration cannot take the threads needed to handle events and
+        services. pool.block_till_done also waits for its jobs.
+        """
+        with self._executors_lock:
+            if name not in self.executors:
+                executor = create_worker_pool(worker_count)
+                self.pool.add_child(executor)
+                self.executors[name] = executor
+
+            return self.executors[name]
+
     def stop(self):
         """ Stops Home Assistant and shuts down all threads. """
         _LOGGER.info("Stopping")
@@ -186,10 +336,34 @@ class EventOrigin(enum.Enum):
 
 
 # pylint: disable=too-few-public-methods
+class JSONEncoder(json.JSONEncoder):
+    """ JSONEncoder that supports Home Assistant objects. """
+    # pylint: disable=too-few-public-methods,method-hidden
+
+    def default(self, obj):
+        """ Converts Home Assistant objects and hands
+            other objects to the original method. """
+        if hasattr(obj, 'as_dict'):
+            return obj.as_dict()
+
+        try:
+            return json.JSONEncoder.default(self, obj)
+        except TypeError:
+            # If the JSON serializer couldn't serialize it
+            # it might be a generator, convert it to a list
+            try:
+                return [self.default(child_obj)
+                        for child_obj in obj]
+            except TypeError:
+                # Ok, we're lost, cause the original error
+                return json.JSONEncoder.default(self, obj)
+
+
 class Event(object):
     """ Represents an event within the Bus. """
 
-    __slots__ = ['event_type', 'data', 'origin', 'time_fired']
+    __slots__ = ['event_type', 'data', 'origin', 'time_fired', '_json',
+                 '_data_json']
 
     def __init__(self, event_type, data=None, origin=EventOrigin.local,
                  time_fired=None):
@@ -198,6 +372,8 @@ class Event(object):
         self.origin = origin
         self.time_fired = date_util.strip_microseconds(
             time_fired or date_util.utcnow())
+        self._json = None
+        self._data_json = None
 
     def as_dict(self):
         """ Returns a dict representation of this Event. """
@@ -208,6 +384,32 @@ class Event(object):
             'time_fired': date_util.datetime_to_str(self.time_fired),
         }
 
+    def as_json(self):
+        """ Returns the JSON representation of this Event. It is serialized
+        once, events should not change after they have been fired. """
+        if self._json is None:
+            self._json = (
+                '{{"data":{},"event_type":{},"origin":{},"time_fired":{}}}'
+            ).format(
+                self.data_json(), json.dumps(self.event_type),
+                json.dumps(str(self.origin)),
+                json.dumps(date_util.datetime_to_str(self.time_fired)))
+
+        return self._json
+
+    def data_json(self):
+        """ Returns the JSON representation of the event data. States in
+        the data are included with their own cached JSON. """
+        if self._data_json is None:
+            self._data_json = '{{{}}}'.format(','.join(
+                '{}:{}'.format(
+                    json.dumps(str(key)),
+                    value.as_json() if hasattr(value, 'as_json')
+                    else json.dumps(value, cls=JSONEncoder))
+                for key, value in self.data.items()))
+
+        return self._data_json
+
     def __repr__(self):
         # pylint: disable=maybe-no-member
         if self.data:
@@ -233,6 +435,18 @@ class EventBus(object):
 
     def __init__(self, pool=None):
         self._listeners = {}
+        # Tables that fire uses to find the listeners of an event:
+        #  - event type to listeners, including the MATCH_ALL listeners
+        #  - the MATCH_ALL listeners, for event types without listeners
+        #  - event type to pairs of a data key and a dict from value to the
+        #    (predicate, listener) pairs that only want events with that
+        #    value for the data key
+        #  - event type to (predicate, listener) pairs of listeners that
+        #    only have a predicate
+        # Replaced as a whole when listeners change so fire can read them
+        # without the lock.
+        self._dispatch = ({}, (), {}, {})
+        self._scheduler = Scheduler()
         self._lock = threading.Lock()
         self._pool = pool or create_worker_pool()
 
@@ -242,45 +456,177 @@ class EventBus(object):
         of listeners.
         """
         with self._lock:
-            return {key: len(self._listeners[key])
-                    for key in self._listeners}
+            listeners = {key: len(self._listeners[key])
+                         for key in self._listeners}
+
+        scheduled = len(self._scheduler)
+
+        if scheduled:
+            listeners[EVENT_TIME_CHANGED] = \
+                listeners.get(EVENT_TIME_CHANGED, 0) + scheduled
+
+        return listeners
 
     def fire(self, event_type, event_data=None, origin=EventOrigin.local):
         """ Fire an event. """
         if not self._pool.running:
             raise HomeAssistantError('Home Assistant has shut down.')
 
-        with self._lock:
-            # Copy the list of the current listeners because some listeners
-            # remove themselves as a listener while being executed which
-            # causes the iterator to be confused.
-            get = self._listeners.get
-            listeners = get(MATCH_ALL, []) + get(event_type, [])
+        listeners = self._get_listeners(event_type, event_data)
 
-            event = Event(event_type, event_data, origin)
+        if not listeners:
+            if event_type != EVENT_TIME_CHANGED and \
+               _LOGGER.isEnabledFor(logging.INFO):
+                _LOGGER.info("Bus:Handling %s",
+                             Event(event_type, event_data, origin))
+            return
 
-            if event_type != EVENT_TIME_CHANGED:
-                _LOGGER.info("Bus:Handling %s", event)
+        event = Event(event_type, event_data, origin)
 
-            if not listeners:
-                return
+        if event_type != EVENT_TIME_CHANGED:
+            _LOGGER.info("Bus:Handling %s", event)
+
+        job_priority = JobPriority.from_event_type(event_type)
+
+        for func in listeners:
+            self._pool.add_job(job_priority, (func, event))
 
-            job_priority = JobPriority.from_event_type(event_type)
+    def fire_many(self, event_type, events_data, origin=EventOrigin.local):
+        """ Fire an event of event_type for each of the event data in
+        events_data.
+
+        The listeners are called in one job, in the order of the events,
+        instead of one job per listener and event.
+        """
+        if not self._pool.running:
+            raise HomeAssistantError('Home Assistant has shut down.')
+
+        job_priority = JobPriority.from_event_type(event_type)
+        calls = []
+
+        for event_data in events_data:
+            listeners = self._get_listeners(event_type, event_data)
+
+            if not listeners and not _LOGGER.isEnabledFor(logging.INFO):
+                continue
+
+            event = Event(event_type, event_data, origin)
+            _LOGGER.info("Bus:Handling %s", event)
 
             for func in listeners:
-                self._pool.add_job(job_priority, (func, event))
+                # Coroutines and callbacks run on the loop of the asyncio
+                # core, so they are not part of the batch
+                if is_async_func(func):
+                    self._pool.add_job(job_priority, (func, event))
+                else:
+                    calls.append((func, event))
+
+        if calls:
+            self._pool.add_job(job_priority, (self._call_listeners, calls))
+
+    def _get_listeners(self, event_type, event_data):
+        """ Returns the listeners to call for an event. """
+        dispatch, match_all, keyed_dispatch, filtered = self._dispatch
+        listeners = dispatch.get(event_type, match_all)
+
+        if event_data and event_type in keyed_dispatch:
+            for data_key, by_value in keyed_dispatch[event_type]:
+                try:
+                    candidates = by_value.get(event_data.get(data_key))
+                except TypeError:
+                    # Value is not hashable so no listener wants it
+                    continue
+
+                if candidates:
+                    listeners += _match_listeners(candidates, event_data)
+
+        if event_type in filtered:
+            listeners += _match_listeners(
+                filtered[event_type], event_data or {})
+
+        if event_type == EVENT_TIME_CHANGED and event_data:
+            listeners += self._scheduler.due(event_data.get(ATTR_NOW))
+
+        return listeners
 
-    def listen(self, event_type, listener):
+    def _call_listeners(self, calls):
+        """ Calls a list of listeners with their events. """
+        job_stats = self._pool.job_stats
+
+        for func, event in calls:
+            start = time.monotonic()
+
+            try:
+                func(event)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Bus:Exception calling %s", func)
+
+            job_stats.add(util.callable_name(func), time.monotonic() - start)
+
+    # pylint: disable=too-many-arguments
+    def listen(self, event_type, listener, entity_ids=None, data_key=None,
+               values=None, predicate=None):
         """ Listen for all events or events of a specific type.
 
         To listen to all events specify the constant ``MATCH_ALL``
         as event_type.
+
+        The listener can be limited to some events of the type. These
+        filters are applied when the event is fired, so no job is queued
+        for other events:
+
+        Pass data_key and a list of values to only be called for events
+        with one of those values for data_key in the event data. The events
+        are looked up by value so other events cost nothing. entity_ids is
+        short for data_key entity_id with the entity ids as values.
+
+        Pass predicate to only be called for events for which
+        predicate(event_data) returns True. It runs in the thread that fires
+        the event so it should be fast.
         """
+        if entity_ids is not None:
+            data_key, values = ATTR_ENTITY_ID, entity_ids
+
+        if (data_key is None) != (values is None):
+            raise HomeAssistantError(
+                'Pass both data_key and values to filter listeners.')
+
+        if event_type == MATCH_ALL and \
+           (values is not None or predicate is not None):
+            raise HomeAssistantError('Cannot filter MATCH_ALL listeners.')
+
+        if values is not None:
+            values = frozenset(values)
+
+        entry = _Listener(listener, data_key, values, predicate)
+
         with self._lock:
             if event_type in self._listeners:
-                self._listeners[event_type].append(listener)
+                self._listeners[event_type].append(entry)
             else:
-                self._listeners[event_type] = [listener]
+                self._listeners[event_type] = [entry]
+
+            self._update_dispatch(event_type)
+
+    def listen_point_in_time(self, listener, point_in_time):
+        """ Listen once for the first EVENT_TIME_CHANGED event at or after
+        point_in_time.
+
+        The listener can be removed with remove_listener for
+        EVENT_TIME_CHANGED.
+        """
+        self._scheduler.add_point_in_time(listener, point_in_time)
+
+    def listen_time_pattern(self, listener, seconds=MATCH_ALL, matches=None):
+        """ Listen for EVENT_TIME_CHANGED events on the given seconds.
+
+        seconds is a list of seconds or ``MATCH_ALL``. If given, matches is
+        called with the time of the event before the listener is queued and
+        has to return True for the listener to be called. It runs in the
+        thread that fires the event so it should be fast. The listener can
+        be removed with remove_listener for EVENT_TIME_CHANGED.
+        """
+        self._scheduler.add_time_pattern(listener, seconds, matches)
 
     def listen_once(self, event_type, listener):
         """ Listen once for event of a specific type.
@@ -304,7 +650,12 @@ class EventBus(object):
 
             self.remove_listener(event_type, onetime_listener)
 
-            listener(event)
+            return listener(event)
+
+        if asyncio.iscoroutinefunction(listener):
+            onetime_listener = asyncio.coroutine(onetime_listener)
+        elif getattr(listener, 'hass_callback', False):
+            callback(onetime_listener)
 
         self.listen(event_type, onetime_listener)
 
@@ -314,21 +665,80 @@ class EventBus(object):
         """ Removes a listener of a specific event_type. """
         with self._lock:
             try:
-                self._listeners[event_type].remove(listener)
+                entries = self._listeners[event_type]
+                entries.remove(next(entry for entry in entries
+                                    if entry.func == listener))
 
                 # delete event_type list if empty
-                if not self._listeners[event_type]:
+                if not entries:
                     self._listeners.pop(event_type)
 
-            except (KeyError, ValueError):
+            except (KeyError, StopIteration):
                 # KeyError is key event_type listener did not exist
-                # ValueError if listener did not exist within event_type
-                pass
+                # StopIteration if listener did not exist within event_type
+                if event_type == EVENT_TIME_CHANGED:
+                    self._scheduler.remove(listener)
+                return
+
+            self._update_dispatch(event_type)
+
+    def _update_dispatch(self, event_type):
+        """ Build new dispatch tables after the listeners of event_type
+            changed. Call with the lock held. """
+        old_dispatch, _, keyed_dispatch, filtered = self._dispatch
+        match_all = tuple(entry.func for entry
+                          in self._listeners.get(MATCH_ALL, ()))
+
+        def unfiltered(key):
+            """ Return listeners to call for every event of type key. """
+            return match_all + tuple(
+                entry.func for entry in self._listeners[key]
+                if entry.values is None and entry.predicate is None)
+
+        if event_type == MATCH_ALL:
+            dispatch = {key: unfiltered(key) for key in self._listeners
+                        if key != MATCH_ALL}
+            self._dispatch = (dispatch, match_all, keyed_dispatch, filtered)
+            return
+
+        dispatch = dict(old_dispatch)
+        keyed_dispatch = dict(keyed_dispatch)
+        filtered = dict(filtered)
+        dispatch.pop(event_type, None)
+        keyed_dispatch.pop(event_type, None)
+        filtered.pop(event_type, None)
+
+        if event_type in self._listeners:
+            dispatch[event_type] = unfiltered(event_type)
+
+            by_key = {}
+            predicate_only = []
+
+            for entry in self._listeners[event_type]:
+                pair = ((entry.predicate, entry.func),)
+
+                if entry.values is not None:
+                    by_value = by_key.setdefault(entry.data_key, {})
+
+                    for value in entry.values:
+                        by_value[value] = by_value.get(value, ()) + pair
+
+                elif entry.predicate is not None:
+                    predicate_only.extend(pair)
+
+            if by_key:
+                keyed_dispatch[event_type] = tuple(by_key.items())
+
+            if predicate_only:
+                filtered[event_type] = tuple(predicate_only)
+
+        self._dispatch = (dispatch, match_all, keyed_dispatch, filtered)
 
 
 class State(object):
     """
-    Object to represent a state within the state machine.
+    Object to represent a state within the state machine. States are
+    read-only so they can be shared without copying them.
 
     entity_id: the entity that is represented.
     state: the state of the entity
@@ -338,7 +748,7 @@ class State(object):
     """
 
     __slots__ = ['entity_id', 'state', 'attributes',
-                 'last_changed', 'last_updated']
+                 'last_changed', 'last_updated', '_json', '_attributes_json']
 
     # pylint: disable=too-many-arguments
     def __init__(self, entity_id, state, attributes=None, last_changed=None,
@@ -348,18 +758,35 @@ class State(object):
                 "Invalid entity id encountered: {}. "
                 "Format should be <domain>.<object_id>").format(entity_id))
 
+        if not isinstance(attributes, util.ReadOnlyDict):
+            attributes = util.ReadOnlyDict(attributes or {})
+
+        last_updated = date_util.strip_microseconds(
+            last_updated or date_util.utcnow())
+
         self.entity_id = entity_id.lower()
         self.state = state
-        self.attributes = attributes or {}
-        self.last_updated = date_util.strip_microseconds(
-            last_updated or date_util.utcnow())
+        self.attributes = attributes
+        self.last_updated = last_updated
 
         # Strip microsecond from last_changed else we cannot guarantee
         # state == State.from_dict(state.as_dict())
         # This behavior occurs because to_dict uses datetime_to_str
         # which does not preserve microseconds
         self.last_changed = date_util.strip_microseconds(
-            last_changed or self.last_updated)
+            last_changed or last_updated)
+        self._json = None
+        self._attributes_json = None
+
+    def __setattr__(self, name, value):
+        # Every attribute is set once by __init__
+        if hasattr(self, name):
+            raise AttributeError('State objects are read-only')
+
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError('State objects are read-only')
 
     @property
     def domain(self):
@@ -379,9 +806,8 @@ class State(object):
             self.object_id.replace('_', ' '))
 
     def copy(self):
-        """ Creates a copy of itself. """
-        return State(self.entity_id, self.state,
-                     dict(self.attributes), self.last_changed)
+        """ Returns itself, states are read-only. """
+        return self
 
     def as_dict(self):
         """ Converts State to a dict to be used within JSON.
@@ -393,6 +819,30 @@ class State(object):
                 'last_changed': date_util.datetime_to_str(self.last_changed),
                 'last_updated': date_util.datetime_to_str(self.last_updated)}
 
+    def as_json(self):
+        """ Returns the JSON representation of as_dict. It is serialized once
+        because states are read-only. """
+        if self._json is None:
+            super().__setattr__('_json', (
+                '{{"attributes":{},"entity_id":{},"last_changed":{},'
+                '"last_updated":{},"state":{}}}'
+            ).format(
+                self.attributes_json(), json.dumps(self.entity_id),
+                json.dumps(date_util.datetime_to_str(self.last_changed)),
+                json.dumps(date_util.datetime_to_str(self.last_updated)),
+                json.dumps(self.state, cls=JSONEncoder)))
+
+        return self._json
+
+    def attributes_json(self):
+        """ Returns the JSON representation of the attributes, with sorted
+        keys. """
+        if self._attributes_json is None:
+            super().__setattr__('_attributes_json', json.dumps(
+                self.attributes, sort_keys=True, cls=JSONEncoder))
+
+        return self._attributes_json
+
     @classmethod
     def from_dict(cls, json_dict):
         """ Static method to create a state from a dict.
@@ -433,33 +883,141 @@ class State(object):
 
 class StateMachine(object):
     """ Helper class that tracks the state of different entities. """
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self, bus):
         self._states = {}
         self._bus = bus
         self._lock = threading.Lock()
+        # Domain -> entity ids of that domain, a dict to keep the order
+        self._domains = {}
+        # Version that is increased with every change, and the entity ids in
+        # order of their last change to the version of that change.
+        self._version = 0
+        self._changes = OrderedDict()
+        self._removed = set()
+        # Entity ids whose state has been restored and not changed since
+        self._restored = set()
+
+    @property
+    def version(self):
+        """ Version of the state machine. Increases with every change. """
+        return self._version
 
     def entity_ids(self, domain_filter=None):
         """ List of entity ids that are being tracked. """
         if domain_filter is None:
             return list(self._states.keys())
 
-        domain_filter = domain_filter.lower()
-
-        return [state.entity_id for state in self._states.values()
-                if state.domain == domain_filter]
+        with self._lock:
+            return list(self._domains.get(domain_filter.lower(), ()))
 
     def all(self):
         """ Returns a list of all states. """
         with self._lock:
-            return [state.copy() for state in self._states.values()]
+            return list(self._states.values())
+
+    def snapshot(self):
+        """ Returns the current version and a list of all states. Pass the
+        version to changed_since to get the changes after the snapshot. """
+        with self._lock:
+            return self._version, list(self._states.values())
+
+    def changed_since(self, version):
+        """ Returns the changes after version as a tuple of the current
+        version, a list of the changed states and a list of the entity ids
+        that have been removed. """
+        changed = []
+        removed = []
+
+        with self._lock:
+            for entity_id in reversed(self._changes):
+                if self._changes[entity_id] <= version:
+                    break
+
+                if entity_id in self._removed:
+                    removed.append(entity_id)
+                else:
+                    changed.append(self._states[entity_id])
+
+            version = self._version
+
+        # Oldest change first
+        changed.reverse()
+        removed.reverse()
+
+        return version, changed, removed
+
+    def is_restored(self, entity_id):
+        """ Returns True if the state of entity_id has been restored with
+        restore and has not been set since. """
+        return entity_id.lower() in self._restored
+
+    def remove_restored(self):
+        """ Removes the restored states that have not been set since they
+        were restored. Returns the number of removed states. """
+        with self._lock:
+            entity_ids = list(self._restored)
+
+        return sum(self.remove(entity_id) for entity_id in entity_ids)
+
+    def save(self, path):
+        """ Saves all states as JSON to path. The file is written next to
+        path and then renamed, so path always holds a complete file. """
+        with self._lock:
+            states = list(self._states.values())
+
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'w') as fil:
+            fil.write('{{"states":[{}],"version":{}}}'.format(
+                ','.join(state.as_json() for state in states),
+                STATES_FILE_VERSION))
+            fil.flush()
+            os.fsync(fil.fileno())
+
+        os.replace(tmp_path, path)
+
+    def restore(self, path):
+        """ Restores the states saved with save to path. Entities that
+        already have a state are skipped. No state changed events are fired
+        because the states did not change. Returns the number of restored
+        states. """
+        try:
+            with open(path) as fil:
+                data = json.load(fil)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError):
+            _LOGGER.exception("Unable to read states from %s", path)
+            return 0
+
+        if not isinstance(data, dict) or \
+           data.get('version') != STATES_FILE_VERSION:
+            _LOGGER.warning("Ignoring states in %s of unknown version", path)
+            return 0
+
+        count = 0
+
+        with self._lock:
+            for json_state in data.get('states', ()):
+                try:
+                    state = State.from_dict(json_state)
+                except (HomeAssistantError, AttributeError, TypeError):
+                    state = None
+
+                if state is None or state.entity_id in self._states:
+                    continue
+
+                self._store(state)
+                self._restored.add(state.entity_id)
+                count += 1
+
+        return count
 
     def get(self, entity_id):
         """ Returns the state of the specified entity. """
-        state = self._states.get(entity_id.lower())
-
-        # Make a copy so people won't mutate the state
-        return state.copy() if state else None
+        return self._states.get(entity_id.lower())
 
     def is_state(self, entity_id, state):
         """ Returns True if entity exists and is specified state. """
@@ -475,7 +1033,22 @@ class StateMachine(object):
         entity_id = entity_id.lower()
 
         with self._lock:
-            return self._states.pop(entity_id, None) is not None
+            state = self._states.pop(entity_id, None)
+
+            if state is None:
+                return False
+
+            domain_ids = self._domains[state.domain]
+            del domain_ids[entity_id]
+
+            if not domain_ids:
+                del self._domains[state.domain]
+
+            self._removed.add(entity_id)
+            self._restored.discard(entity_id)
+            self._changed(entity_id)
+
+            return True
 
     def set(self, entity_id, new_state, attributes=None):
         """ Set the state of an entity, add entity if it does not exist.
@@ -485,32 +1058,84 @@ class StateMachine(object):
         If you just update the attributes and not the state, last changed will
         not be affected.
         """
+        with self._lock:
+            event_data = self._set(entity_id, new_state, attributes)
+
+            if event_data is not None:
+                self._bus.fire(EVENT_STATE_CHANGED, event_data)
+
+    def set_many(self, states):
+        """ Set the states of many entities at once.
+
+        states is an iterable of (entity_id, new_state, attributes) tuples.
+        A state changed event is fired for each changed entity but their
+        listeners are called in one job.
+        """
+        events_data = []
+
+        with self._lock:
+            try:
+                for entity_id, new_state, attributes in states:
+                    event_data = self._set(entity_id, new_state, attributes)
+
+                    if event_data is not None:
+                        events_data.append(event_data)
+
+            finally:
+                if events_data:
+                    self._bus.fire_many(EVENT_STATE_CHANGED, events_data)
+
+    def _set(self, entity_id, new_state, attributes):
+        """ Set the state of an entity. Returns the data for the state
+            changed event or None if nothing changed. Call with the lock
+            held. """
         entity_id = entity_id.lower()
         new_state = str(new_state)
         attributes = attributes or {}
 
-        with self._lock:
-            old_state = self._states.get(entity_id)
+        old_state = self._states.get(entity_id)
 
-            is_existing = old_state is not None
-            same_state = is_existing and old_state.state == new_state
-            same_attr = is_existing and old_state.attributes == attributes
+        is_existing = old_state is not None
+        same_state = is_existing and old_state.state == new_state
+        same_attr = is_existing and old_state.attributes == attributes
 
-            if same_state and same_attr:
-                return
+        # The first set of a restored state is reported even if it did not
+        # change so listeners learn the entity exists in this run
+        if same_state and same_attr and entity_id not in self._restored:
+            return None
+
+        # If state did not exist or is different, set it
+        last_changed = old_state.last_changed if same_state else None
+
+        state = State(entity_id, new_state, attributes, last_changed)
+        self._store(state)
+
+        event_data = {'entity_id': entity_id, 'new_state': state}
+
+        if old_state:
+            event_data['old_state'] = old_state
 
-            # If state did not exist or is different, set it
-            last_changed = old_state.last_changed if same_state else None
+        return event_data
 
-            state = State(entity_id, new_state, attributes, last_changed)
-            self._states[entity_id] = state
+    def _store(self, state):
+        """ Store a state and update the indexes. Call with the lock
+            held. """
+        entity_id = state.entity_id
 
-            event_data = {'entity_id': entity_id, 'new_state': state}
+        if entity_id not in self._states:
+            self._domains.setdefault(state.domain, {})[entity_id] = None
+            self._removed.discard(entity_id)
 
-            if old_state:
-                event_data['old_state'] = old_state
+        self._states[entity_id] = state
+        self._restored.discard(entity_id)
+        self._changed(entity_id)
 
-            self._bus.fire(EVENT_STATE_CHANGED, event_data)
+    def _changed(self, entity_id):
+        """ Record a change of entity_id in a new version. Call with the
+            lock held. """
+        self._version += 1
+        self._changes[entity_id] = self._version
+        self._changes.move_to_end(entity_id)
 
     def track_change(self, entity_ids, action, from_state=None, to_state=None):
         """
@@ -543,7 +1168,7 @@ class Service(object):
         }
 
     def __call__(self, call):
-        self.func(call)
+        return self.func(call)
 
 
 # pylint: disable=too-few-public-methods
@@ -567,13 +1192,18 @@ class ServiceCall(object):
 
 class ServiceRegistry(object):
     """ Offers services over the eventbus. """
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self, bus, pool=None):
         self._services = {}
         self._lock = threading.Lock()
         self._pool = pool or create_worker_pool()
         self._bus = bus
-        self._cur_id = 0
+        self._call_ids = itertools.count(1)
+        # Futures of blocking calls by call id
+        self._pending = {}
+        self._listening_executed = False
+        self.stats = util.RuntimeStats()
         bus.listen(EVENT_CALL_SERVICE, self._event_to_service_call)
 
     @property
@@ -615,7 +1245,8 @@ class ServiceRegistry(object):
         Waits a maximum of SERVICE_CALL_LIMIT.
 
         If blocking = True, will return boolean if service executed
-        succesfully within SERVICE_CALL_LIMIT.
+        succesfully within SERVICE_CALL_LIMIT. Exceptions raised by the
+        service are raised again.
 
         This method will fire an event to call the service.
         This event will be picked up by this ServiceRegistry and any
@@ -624,33 +1255,61 @@ class ServiceRegistry(object):
         Because the service is sent as an event you are not allowed to use
         the keys ATTR_DOMAIN and ATTR_SERVICE in your service_data.
         """
+        if not blocking:
+            self._fire_call(domain, service, service_data)
+            return
+
+        future = self.call_future(domain, service, service_data)
+
+        try:
+            future.result(SERVICE_CALL_LIMIT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return False
+
+        return True
+
+    def call_future(self, domain, service, service_data=None):
+        """
+        Calls specified service and returns a concurrent.futures.Future.
+
+        The future gets the return value of the service or the exception it
+        raised. Services executed by a remote instance result in None. The
+        future is not resolved if no instance executes the service, cancel
+        it when giving up on it.
+        """
+        future = concurrent.futures.Future()
+        self._fire_call(domain, service, service_data, future)
+        return future
+
+    def _fire_call(self, domain, service, service_data, future=None):
+        """ Fires the event to call a service, with future to resolve when
+            it has been executed. """
         call_id = self._generate_unique_id()
         event_data = service_data or {}
         event_data[ATTR_DOMAIN] = domain
         event_data[ATTR_SERVICE] = service
         event_data[ATTR_SERVICE_CALL_ID] = call_id
 
-        if blocking:
-            executed_event = threading.Event()
+        if future is not None:
+            with self._lock:
+                self._pending[call_id] = future
 
-            def service_executed(call):
-                """
-                Called when a service is executed.
-                Will set the event if matches our service call.
-                """
-                if call.data[ATTR_SERVICE_CALL_ID] == call_id:
-                    executed_event.set()
+                # Only services of remote instances resolve calls through
+                # events, so only listen for those once they are called.
+                if not self._listening_executed and \
+                   not self.has_service(domain, service):
+                    self._listening_executed = True
+                    self._bus.listen(
+                        EVENT_SERVICE_EXECUTED, self._service_executed,
+                        predicate=self._is_pending)
 
-            self._bus.listen(EVENT_SERVICE_EXECUTED, service_executed)
+            future.add_done_callback(
+                lambda _: self._pop_pending(call_id))
 
         self._bus.fire(EVENT_CALL_SERVICE, event_data)
 
-        if blocking:
-            success = executed_event.wait(SERVICE_CALL_LIMIT)
-            self._bus.remove_listener(
-                EVENT_SERVICE_EXECUTED, service_executed)
-            return success
-
+    @callback
     def _event_to_service_call(self, event):
         """ Calls a service from an event. """
         service_data = dict(event.data)
@@ -669,19 +1328,60 @@ class ServiceRegistry(object):
                             (service_handler, service_call)))
 
     def _execute_service(self, service_and_call):
-        """ Executes a service and fires a SERVICE_EXECUTED event. """
+        """ Executes a service, resolves the future of the call and fires a
+            SERVICE_EXECUTED event. """
         service, call = service_and_call
-        service(call)
+        call_id = call.data.get(ATTR_SERVICE_CALL_ID)
+        future = self._start_pending(call_id)
+        start = time.monotonic()
 
-        if ATTR_SERVICE_CALL_ID in call.data:
+        try:
+            result = service(call)
+        except Exception as err:
+            if future is not None:
+                future.set_exception(err)
+            raise
+        finally:
+            self.stats.add('{}.{}'.format(call.domain, call.service),
+                           time.monotonic() - start)
+
+        if future is not None:
+            future.set_result(result)
+
+        if call_id is not None:
             self._bus.fire(
-                EVENT_SERVICE_EXECUTED,
-                {ATTR_SERVICE_CALL_ID: call.data[ATTR_SERVICE_CALL_ID]})
+                EVENT_SERVICE_EXECUTED, {ATTR_SERVICE_CALL_ID: call_id})
+
+    @callback
+    def _service_executed(self, event):
+        """ Resolves the future of a call executed by another instance. """
+        future = self._start_pending(event.data.get(ATTR_SERVICE_CALL_ID))
+
+        if future is not None:
+            future.set_result(None)
+
+    def _is_pending(self, event_data):
+        """ Returns if the call of a service executed event is waited for. """
+        return event_data.get(ATTR_SERVICE_CALL_ID) in self._pending
+
+    def _pop_pending(self, call_id):
+        """ Removes the future of a call and returns it. """
+        with self._lock:
+            return self._pending.pop(call_id, None)
+
+    def _start_pending(self, call_id):
+        """ Returns the future of a call to resolve, if it is still
+            waited for. """
+        future = self._pop_pending(call_id)
+
+        if future is not None and future.set_running_or_notify_cancel():
+            return future
+
+        return None
 
     def _generate_unique_id(self):
         """ Generates a unique service call id. """
-        self._cur_id += 1
-        return "{}-{}".format(id(self), self._cur_id)
+        return "{}-{}".format(id(self), next(self._call_ids))
 
 
 class Config(object):
@@ -799,8 +1499,14 @@ def create_timer(hass, interval=TIMER_INTERVAL):
                     # HA raises error if firing event after it has shut down
                     break
 
+    loop = getattr(hass.pool, 'loop', None)
+
     def start_timer(event):
         """Start the timer."""
+        if loop is not None:
+            loop.call_soon_threadsafe(_create_loop_timer, hass, loop, interval)
+            return
+
         thread = threading.Thread(target=timer)
         thread.daemon = True
         thread.start()
@@ -808,8 +1514,55 @@ def create_timer(hass, interval=TIMER_INTERVAL):
     hass.bus.listen_once(EVENT_HOMEASSISTANT_START, start_timer)
 
 
-def create_worker_pool(worker_count=None):
-    """ Creates a worker pool to be used. """
+def _create_loop_timer(hass, loop, interval):
+    """ Fires EVENT_TIME_CHANGED on interval from the event loop of the
+    asyncio core, halfway through the seconds that fit the interval. """
+    stopped = False
+    last_fired_on_second = -1
+
+    @callback
+    def stop_timer(event):
+        """Stop the timer."""
+        nonlocal stopped
+        stopped = True
+
+    def fire_time_event():
+        """Fire the time changed event when due and schedule the next."""
+        nonlocal last_fired_on_second
+
+        if stopped:
+            return
+
+        now = date_util.utcnow()
+
+        if not (now.second % interval or
+                now.second == last_fired_on_second):
+            last_fired_on_second = now.second
+
+            try:
+                hass.bus.fire(EVENT_TIME_CHANGED, {ATTR_NOW: now})
+            except HomeAssistantError:
+                # HA raises error if firing event after it has shut down
+                return
+
+        loop.call_later(
+            interval - now.second % interval + .5 - now.microsecond/1000000.0,
+            fire_time_event)
+
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, stop_timer)
+
+    _LOGGER.info("Timer:starting")
+
+    fire_time_event()
+
+
+def create_worker_pool(worker_count=None, max_workers=None,
+                       use_asyncio=False):
+    """ Creates a worker pool to be used. If max_workers is given the pool
+    grows up to max_workers threads when jobs have to wait.
+
+    With use_asyncio it creates a pool that runs an event loop and runs
+    blocking jobs in a thread pool that grows the same way. """
     if worker_count is None:
         worker_count = MIN_WORKER_THREAD
 
@@ -817,11 +1570,19 @@ def create_worker_pool(worker_count=None):
         """ Called whenever a job is available to do. """
         try:
             func, arg = job
-            func(arg)
+            result = func(arg)
         except Exception:  # pylint: disable=broad-except
             # Catch any exception our service/event_listener might throw
             # We do not want to crash our ThreadPool
             _LOGGER.exception("BusHandler:Exception doing job")
+            return
+
+        if asyncio.iscoroutine(result):
+            # The asyncio pool runs the coroutine on its event loop
+            if use_asyncio:
+                return _log_job_exception(result)
+
+            _run_coroutine(_log_job_exception(result))
 
     def busy_callback(worker_count, current_jobs, pending_jobs_count):
         """ Callback to be called when the pool queue gets too big. """
@@ -834,4 +1595,25 @@ def create_worker_pool(worker_count=None):
             _LOGGER.warning("WorkerPool:Current job from %s: %s",
                             date_util.datetime_to_local_str(start), job)
 
-    return util.ThreadPool(job_handler, worker_count, busy_callback)
+    def job_name(job):
+        """ Returns the name to keep the runtime of a job under. """
+        try:
+            return util.callable_name(job[0])
+        except (TypeError, IndexError):
+            return type(job).__name__
+
+    def is_async(job):
+        """ Returns if a job is handled on the event loop. """
+        try:
+            return is_async_func(job[0])
+        except (TypeError, IndexError):
+            return False
+
+    if use_asyncio:
+        return AsyncPool(job_handler, worker_count, busy_callback,
+                         max_workers, is_async, job_name,
+                         WORKER_SCALE_UP_LATENCY)
+
+    return util.ThreadPool(job_handler, worker_count, busy_callback,
+                           max_workers, WORKER_SCALE_UP_LATENCY,
+                           job_name=job_name)
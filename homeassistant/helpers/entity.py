@@ -5,6 +5,7 @@ homeassistant.helpers.entity
 Provides ABC for entities in HA.
 """
 
+import logging
 from collections import defaultdict
 
 from homeassistant.exceptions import NoEntitySpecifiedError
@@ -17,6 +18,8 @@ from homeassistant.const import (
 # Dict mapping entity_id to a boolean that overwrites the hidden property
 _OVERWRITE = defaultdict(dict)
 
+_LOGGER = logging.getLogger(__name__)
+
 
 class Entity(object):
     """ ABC for Home Assistant entities. """
@@ -83,6 +86,14 @@ class Entity(object):
         Updates Home Assistant with current state of entity.
         If force_refresh == True will update entity before setting state.
         """
+        return self.hass.states.set(*self.ha_state(force_refresh))
+
+    def ha_state(self, force_refresh=False):
+        """
+        Returns the entity id, state and attributes to store in Home
+        Assistant for the current state of entity.
+        If force_refresh == True will update entity before.
+        """
         if self.hass is None:
             raise RuntimeError("Attribute hass is None for {}".format(self))
 
@@ -121,7 +132,7 @@ class Entity(object):
                     state, attr[ATTR_UNIT_OF_MEASUREMENT])
             state = str(state)
 
-        return self.hass.states.set(self.entity_id, state, attr)
+        return self.entity_id, state, attr
 
     def __eq__(self, other):
         return (isinstance(other, Entity) and
@@ -166,3 +177,20 @@ class ToggleEntity(Entity):
     def turn_off(self, **kwargs):
         """ Turn the entity off. """
         pass
+
+
+def update_ha_states(hass, entities, force_refresh=False):
+    """
+    Updates Home Assistant with the current state of entities at once.
+    If force_refresh == True will update the entities before setting states.
+    """
+    states = []
+
+    for entity in entities:
+        try:
+            states.append(entity.ha_state(force_refresh))
+        except Exception:  # pylint: disable=broad-except
+            # Do not lose the states of the other entities
+            _LOGGER.exception("Error updating state of %s", entity.entity_id)
+
+    hass.states.set_many(states)
@@ -4,9 +4,13 @@ homeassistant.helpers.entity_component
 
 Provides helpers for components that manage entities.
 """
+import zlib
+
+from homeassistant.core import JobPriority
 from homeassistant.bootstrap import prepare_setup_platform
 from homeassistant.helpers import (
     generate_entity_id, config_per_platform, extract_entity_ids)
+from homeassistant.helpers.entity import update_ha_states
 from homeassistant.helpers.event import track_utc_time_change
 from homeassistant.components import group, discovery
 from homeassistant.const import ATTR_ENTITY_ID
@@ -35,6 +39,7 @@ class EntityComponent(object):
         self.entities = {}
         self.group = None
         self.is_polling = False
+        self._update_pending = False
 
         self.config = None
 
@@ -61,6 +66,8 @@ class EntityComponent(object):
         Takes in a list of new entities. For each entity will see if it already
         exists. If not, will add it, set it up and push the first state.
         """
+        added = []
+
         for entity in new_entities:
             if entity is not None and entity not in self.entities.values():
                 entity.hass = self.hass
@@ -71,8 +78,14 @@ class EntityComponent(object):
                         self.entities.keys())
 
                 self.entities[entity.entity_id] = entity
+                added.append(entity)
 
-                entity.update_ha_state()
+        # Polled entities keep their restored state till they are polled
+        update_ha_states(
+            self.hass,
+            [entity for entity in added
+             if not (entity.should_poll and
+                     self.hass.states.is_restored(entity.entity_id))])
 
         if self.group is None and self.group_name is not None:
             self.group = group.Group(self.hass, self.group_name,
@@ -96,12 +109,31 @@ class EntityComponent(object):
                     if entity_id in self.entities]
 
     def _update_entity_states(self, now):
-        """ Update the states of all the entities. """
+        """ Update the states of all the entities on the executor of the
+            domain so slow devices do not block the worker pool. """
+        if self._update_pending:
+            self.logger.warning(
+                "Skipping update of %s entities, previous update is still "
+                "running", self.domain)
+            return
+
+        self._update_pending = True
+
+        self.hass.get_executor(self.domain).add_job(
+            JobPriority.EVENT_DEFAULT, (self._poll_entities, now))
+
+    def _poll_entities(self, now):
+        """ Poll the entities and update their states. """
         self.logger.info("Updating %s entities", self.domain)
 
-        for entity in self.entities.values():
-            if entity.should_poll:
-                entity.update_ha_state(True)
+        try:
+            update_ha_states(
+                self.hass,
+                [entity for entity in self.entities.values()
+                 if entity.should_poll],
+                True)
+        finally:
+            self._update_pending = False
 
     def _entity_discovered(self, service, info):
         """ Called when a entity is discovered. """
@@ -118,9 +150,14 @@ class EntityComponent(object):
 
         self.is_polling = True
 
+        # Offset the seconds per domain so the domains do not all poll
+        # their devices at the same time
+        offset = zlib.crc32(self.domain.encode()) % \
+            min(self.scan_interval, 60)
+
         track_utc_time_change(
             self.hass, self._update_entity_states,
-            second=range(0, 60, self.scan_interval))
+            second=range(offset, 60, self.scan_interval))
 
     def _setup_platform(self, platform_type, platform_config,
                         discovery_info=None):
@@ -27,25 +27,27 @@ def track_state_change(hass, entity_ids, action, from_state=None,
     else:
         entity_ids = tuple(entity_id.lower() for entity_id in entity_ids)
 
-    @ft.wraps(action)
-    def state_change_listener(event):
-        """ The listener that listens for specific state changes. """
-        if event.data['entity_id'] not in entity_ids:
-            return
-
-        if 'old_state' in event.data:
-            old_state = event.data['old_state'].state
+    def state_matches(event_data):
+        """ Returns if a state change matches from_state and to_state. """
+        if 'old_state' in event_data:
+            old_state = event_data['old_state'].state
         else:
             old_state = None
 
-        if _matcher(old_state, from_state) and \
-           _matcher(event.data['new_state'].state, to_state):
+        return _matcher(old_state, from_state) and \
+            _matcher(event_data['new_state'].state, to_state)
 
-            action(event.data['entity_id'],
-                   event.data.get('old_state'),
-                   event.data['new_state'])
+    @ft.wraps(action)
+    def state_change_listener(event):
+        """ The listener that listens for specific state changes. """
+        action(event.data['entity_id'],
+               event.data.get('old_state'),
+               event.data['new_state'])
 
-    hass.bus.listen(EVENT_STATE_CHANGED, state_change_listener)
+    # The bus only calls the listener for matching state changes of
+    # entity_ids
+    hass.bus.listen(EVENT_STATE_CHANGED, state_change_listener, entity_ids,
+                    predicate=state_matches)
 
     return state_change_listener
 
@@ -73,25 +75,11 @@ def track_point_in_utc_time(hass, action, point_in_time):
 
     @ft.wraps(action)
     def point_in_time_listener(event):
-        """ Listens for matching time_changed events. """
-        now = event.data[ATTR_NOW]
-
-        if now >= point_in_time and \
-           not hasattr(point_in_time_listener, 'run'):
-
-            # Set variable so that we will never run twice.
-            # Because the event bus might have to wait till a thread comes
-            # available to execute this listener it might occur that the
-            # listener gets lined up twice to be executed. This will make
-            # sure the second time it does nothing.
-            point_in_time_listener.run = True
+        """ Listens for the time_changed event at point_in_time. """
+        action(event.data[ATTR_NOW])
 
-            hass.bus.remove_listener(EVENT_TIME_CHANGED,
-                                     point_in_time_listener)
-
-            action(now)
-
-    hass.bus.listen(EVENT_TIME_CHANGED, point_in_time_listener)
+    # The bus only calls the listener once, when point_in_time has come
+    hass.bus.listen_point_in_time(point_in_time_listener, point_in_time)
     return point_in_time_listener
 
 
@@ -114,6 +102,20 @@ def track_utc_time_change(hass, action, year=None, month=None, day=None,
     year, month, day = pmp(year), pmp(month), pmp(day)
     hour, minute, second = pmp(hour), pmp(minute), pmp(second)
 
+    def pattern_matches(now):
+        """ Returns True if now matches the pattern. """
+        if local:
+            now = dt_util.as_local(now)
+
+        mat = _matcher
+
+        return mat(now.year, year) and \
+            mat(now.month, month) and \
+            mat(now.day, day) and \
+            mat(now.hour, hour) and \
+            mat(now.minute, minute) and \
+            mat(now.second, second)
+
     @ft.wraps(action)
     def pattern_time_change_listener(event):
         """ Listens for matching time_changed events. """
@@ -122,18 +124,11 @@ def track_utc_time_change(hass, action, year=None, month=None, day=None,
         if local:
             now = dt_util.as_local(now)
 
-        mat = _matcher
-
-        if mat(now.year, year) and \
-           mat(now.month, month) and \
-           mat(now.day, day) and \
-           mat(now.hour, hour) and \
-           mat(now.minute, minute) and \
-           mat(now.second, second):
-
-            action(now)
+        action(now)
 
-    hass.bus.listen(EVENT_TIME_CHANGED, pattern_time_change_listener)
+    # The bus checks the pattern and only calls the listener on a match
+    hass.bus.listen_time_pattern(
+        pattern_time_change_listener, second, pattern_matches)
     return pattern_time_change_listener
 
 
@@ -21,20 +21,21 @@ _LOGGER = logging.getLogger(__name__)
 # pylint: disable=too-few-public-methods, attribute-defined-outside-init
 class TrackStates(object):
     """
-    Records the time when the with-block is entered. Will add all states
-    that have changed since the start time to the return list when with-block
-    is exited.
+    Records the version of the state machine when the with-block is entered.
+    Will add all states that have changed since then to the return list when
+    with-block is exited.
     """
     def __init__(self, hass):
         self.hass = hass
         self.states = []
 
     def __enter__(self):
-        self.now = dt_util.utcnow()
+        self.version = self.hass.states.version
         return self.states
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.states.extend(get_changed_since(self.hass.states.all(), self.now))
+        self.states.extend(
+            self.hass.states.changed_since(self.version)[1])
 
 
 def get_changed_since(states, utc_point_in_time):
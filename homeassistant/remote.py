@@ -69,8 +69,9 @@ class API(object):
         return self.status == APIStatus.OK
 
     def __call__(self, method, path, data=None):
-        """ Makes a call to the Home Assistant api. """
-        if data is not None:
+        """ Makes a call to the Home Assistant api. Data can be passed
+            serialized to JSON already. """
+        if data is not None and not isinstance(data, str):
             data = json.dumps(data, cls=JSONEncoder)
 
         url = urllib.parse.urljoin(self.base_url, path)
@@ -225,7 +226,7 @@ class EventForwarder(object):
                 return
 
             for api in self._targets.values():
-                fire_event(api, event.event_type, event.data)
+                fire_event(api, event.event_type, event.data_json())
 
 
 class StateMachine(ha.StateMachine):
@@ -247,37 +248,37 @@ class StateMachine(ha.StateMachine):
         """ Calls set_state on remote API . """
         set_state(self._api, entity_id, new_state, attributes)
 
+    def set_many(self, states):
+        """ Calls set_state on remote API for each state. """
+        for entity_id, new_state, attributes in states:
+            set_state(self._api, entity_id, new_state, attributes)
+
     def mirror(self):
         """ Discards current data and mirrors the remote state machine. """
-        self._states = {state.entity_id: state for state
-                        in get_states(self._api)}
+        states = get_states(self._api)
+
+        for entity_id in self.entity_ids():
+            self.remove(entity_id)
+
+        with self._lock:
+            for state in states:
+                self._store(state)
 
     def _state_changed_listener(self, event):
-        """ Listens for state changed events and applies them. """
-        self._states[event.data['entity_id']] = event.data['new_state']
+        """ Listens for state changed events and applies them. An event
+            without new state means the entity was removed. """
+        new_state = event.data.get('new_state')
 
+        if new_state is None:
+            self.remove(event.data['entity_id'])
+            return
 
-class JSONEncoder(json.JSONEncoder):
-    """ JSONEncoder that supports Home Assistant objects. """
-    # pylint: disable=too-few-public-methods,method-hidden
+        with self._lock:
+            self._store(new_state)
 
-    def default(self, obj):
-        """ Converts Home Assistant objects and hands
-            other objects to the original method. """
-        if hasattr(obj, 'as_dict'):
-            return obj.as_dict()
 
-        try:
-            return json.JSONEncoder.default(self, obj)
-        except TypeError:
-            # If the JSON serializer couldn't serialize it
-            # it might be a generator, convert it to a list
-            try:
-                return [self.default(child_obj)
-                        for child_obj in obj]
-            except TypeError:
-                # Ok, we're lost, cause the original error
-                return json.JSONEncoder.default(self, obj)
+# The encoder moved to core, it is used to serialize states and events
+JSONEncoder = ha.JSONEncoder  # pylint: disable=invalid-name
 
 
 def validate_api(api):
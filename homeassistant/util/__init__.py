@@ -8,13 +8,14 @@ import collections
 from itertools import chain
 import threading
 import queue
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 import re
 import enum
 import socket
 import random
 import string
-from functools import wraps
+from functools import wraps, partial
 
 from .dt import datetime_to_local_str, utcnow
 
@@ -107,6 +108,18 @@ def get_random_string(length=10):
     return ''.join(generator.choice(source_chars) for _ in range(length))
 
 
+def callable_name(func):
+    """ Returns the module and qualified name of a callable. """
+    while isinstance(func, partial):
+        func = func.func
+
+    name = getattr(func, '__qualname__', None) or \
+        getattr(func, '__name__', None) or type(func).__qualname__
+    module = getattr(func, '__module__', None)
+
+    return '{}.{}'.format(module, name) if module else name
+
+
 class OrderedEnum(enum.Enum):
     """ Taken from Python 3.4.0 docs. """
     # pylint: disable=no-init, too-few-public-methods
@@ -132,6 +145,17 @@ class OrderedEnum(enum.Enum):
         return NotImplemented
 
 
+class ReadOnlyDict(dict):
+    """ A dict that cannot be changed after it has been created. """
+
+    def _readonly(self, *args, **kwargs):
+        """ Raises a TypeError because the dict is read only. """
+        raise TypeError('{} is read-only'.format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
 class OrderedSet(collections.MutableSet):
     """ Ordered set taken from http://code.activestate.com/recipes/576694/ """
 
@@ -286,45 +310,96 @@ class Throttle(object):
         return wrapper
 
 
+class RuntimeStats(object):
+    """ Thread-safe call count, total and maximum duration per key. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, key, duration):
+        """ Records a call for key that took duration seconds. """
+        with self._lock:
+            stats = self._stats.get(key)
+
+            if stats is None:
+                self._stats[key] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+
+    def as_dict(self):
+        """ Returns per key a dict with count, total and max. """
+        with self._lock:
+            return {key: {'count': count, 'total': total, 'max': maximum}
+                    for key, (count, total, maximum) in self._stats.items()}
+
+
 class ThreadPool(object):
-    """ A priority queue-based thread pool. """
-    # pylint: disable=too-many-instance-attributes
+    """
+    A priority queue-based thread pool.
+
+    If max_workers is given, the pool adds workers up to max_workers when
+    jobs have to wait longer than scale_up_latency seconds and removes
+    workers that are idle for idle_timeout seconds. It will not go below
+    the number of workers that were added with add_worker.
 
-    def __init__(self, job_handler, worker_count=0, busy_callback=None):
+    The time jobs wait in the queue is kept per priority in wait_stats. If
+    job_name is given, the runtime of jobs is kept per name in job_stats.
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(self, job_handler, worker_count=0, busy_callback=None,
+                 max_workers=None, scale_up_latency=1, idle_timeout=60,
+                 job_name=None):
         """
         job_handler: method to be called from worker thread to handle job
         worker_count: number of threads to run that handle jobs
         busy_callback: method to be called when queue gets too big.
                        Parameters: worker_count, list of current_jobs,
                                    pending_jobs_count
+        max_workers: maximum number of threads when scaling up
+        scale_up_latency: seconds a job can wait before adding a thread
+        idle_timeout: seconds a thread above worker_count can be idle
+        job_name: method returning the name to keep the runtime of a job
+                  under
         """
         self._job_handler = job_handler
+        self._job_name = job_name
         self._busy_callback = busy_callback
 
         self.worker_count = 0
+        self.min_workers = 0
+        self.max_workers = max_workers
+        self.scale_up_latency = scale_up_latency
+        self.idle_timeout = idle_timeout
         self.busy_warning_limit = 0
         self._work_queue = queue.PriorityQueue()
+        self._children = []
         self.current_jobs = []
+        self.wait_stats = RuntimeStats()
+        self.job_stats = RuntimeStats()
         self._lock = threading.RLock()
         self._quit_task = object()
+        self._idle_task = object()
 
         self.running = True
 
         for _ in range(worker_count):
             self.add_worker()
 
+    @property
+    def queue_size(self):
+        """ Number of jobs waiting for a worker. """
+        return self._work_queue.qsize()
+
     def add_worker(self):
         """ Adds a worker to the thread pool. Resets warning limit. """
         with self._lock:
-            if not self.running:
-                raise RuntimeError("ThreadPool not running")
-
-            worker = threading.Thread(target=self._worker)
-            worker.daemon = True
-            worker.start()
-
-            self.worker_count += 1
-            self.busy_warning_limit = self.worker_count * 3
+            self.min_workers += 1
+            self._start_worker()
 
     def remove_worker(self):
         """ Removes a worker from the thread pool. Resets warning limit. """
@@ -334,9 +409,16 @@ class ThreadPool(object):
 
             self._work_queue.put(PriorityQueueItem(0, self._quit_task))
 
+            self.min_workers = max(0, self.min_workers - 1)
             self.worker_count -= 1
             self.busy_warning_limit = self.worker_count * 3
 
+    def add_child(self, pool):
+        """ Adds a pool whose jobs block_till_done also waits for and that is
+            stopped together with this pool. """
+        with self._lock:
+            self._children.append(pool)
+
     def add_job(self, priority, job):
         """ Add a job to the queue. """
         with self._lock:
@@ -345,6 +427,13 @@ class ThreadPool(object):
 
             self._work_queue.put(PriorityQueueItem(priority, job))
 
+            # Jobs are waiting and all workers are stuck in long jobs
+            if self._can_scale_up() and self.current_jobs and \
+               len(self.current_jobs) >= self.worker_count and \
+               self.current_jobs[0][0] < \
+               utcnow() - timedelta(seconds=self.scale_up_latency):
+                self._start_worker()
+
             # check if our queue is getting too big
             if self._work_queue.qsize() > self.busy_warning_limit \
                and self._busy_callback is not None:
@@ -357,32 +446,104 @@ class ThreadPool(object):
                     self._work_queue.qsize())
 
     def block_till_done(self):
-        """ Blocks till all work is done. """
-        self._work_queue.join()
+        """ Blocks till all work is done, including the work of child
+            pools. """
+        while True:
+            self._work_queue.join()
 
-    def stop(self):
-        """ Stops all the threads. """
-        with self._lock:
-            if not self.running:
+            for child in list(self._children):
+                child.block_till_done()
+
+            # Jobs of children can add jobs to this pool
+            if not self._work_queue.unfinished_tasks:
                 return
 
-            # Ensure all current jobs finish
+    def stop(self):
+        """ Stops all the threads. """
+        while True:
+            # Ensure all current jobs finish. Workers take the lock to scale
+            # up or quit when idle, so do not wait while holding it.
             self.block_till_done()
 
-            # Tell the workers to quit
-            for _ in range(self.worker_count):
-                self.remove_worker()
+            for child in list(self._children):
+                child.stop()
 
-            self.running = False
+            with self._lock:
+                if not self.running:
+                    return
 
-            # Wait till all workers have quit
-            self.block_till_done()
+                # Jobs were added while waiting
+                if self._work_queue.unfinished_tasks:
+                    continue
+
+                self.running = False
+
+                # Tell the workers to quit
+                for _ in range(self.worker_count):
+                    self._work_queue.put(
+                        PriorityQueueItem(0, self._quit_task))
+
+                self.min_workers = self.worker_count = 0
+                self.busy_warning_limit = 0
+                break
+
+        # Wait till all workers have quit
+        self.block_till_done()
+
+    def _can_scale_up(self):
+        """ Returns if a worker can be added to handle the load. """
+        return self.running and self.max_workers is not None and \
+            self.worker_count < self.max_workers
+
+    def _start_worker(self):
+        """ Starts a worker thread. Call with the lock held. """
+        if not self.running:
+            raise RuntimeError("ThreadPool not running")
+
+        worker = threading.Thread(target=self._worker)
+        worker.daemon = True
+        worker.start()
+
+        self.worker_count += 1
+        self.busy_warning_limit = self.worker_count * 3
+
+    def _get_job(self):
+        """ Returns the next queue item for a worker or the idle task if the
+            worker has been idle for too long and is not needed. """
+        while True:
+            timeout = self.idle_timeout if self.max_workers else None
+
+            try:
+                item = self._work_queue.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self.running and \
+                       self.worker_count > self.min_workers:
+                        self.worker_count -= 1
+                        self.busy_warning_limit = self.worker_count * 3
+                        return self._idle_task
+                continue
+
+            # Add a worker if jobs wait too long
+            if time.monotonic() - item.queued > self.scale_up_latency and \
+               self._can_scale_up():
+                with self._lock:
+                    if self._can_scale_up():
+                        self._start_worker()
+
+            return item
 
     def _worker(self):
         """ Handles jobs for the thread pool. """
         while True:
             # Get new item from work_queue
-            job = self._work_queue.get().item
+            item = self._get_job()
+
+            # Idle worker that is no longer needed
+            if item is self._idle_task:
+                return
+
+            job = item.item
 
             if job == self._quit_task:
                 self._work_queue.task_done()
@@ -392,9 +553,16 @@ class ThreadPool(object):
             job_log = (utcnow(), job)
             self.current_jobs.append(job_log)
 
+            start = time.monotonic()
+            self.wait_stats.add(item.priority, start - item.queued)
+
             # Do the job
             self._job_handler(job)
 
+            if self._job_name is not None:
+                self.job_stats.add(
+                    self._job_name(job), time.monotonic() - start)
+
             # Remove from current running job
             self.current_jobs.remove(job_log)
 
@@ -409,6 +577,7 @@ class PriorityQueueItem(object):
     def __init__(self, priority, item):
         self.priority = priority
         self.item = item
+        self.queued = time.monotonic()
 
     def __lt__(self, other):
         return self.priority < other.priority
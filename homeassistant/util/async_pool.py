@@ -0,0 +1,207 @@
+"""
+homeassistant.util.async_pool
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Pool that runs an asyncio event loop next to a ThreadPool.
+
+"""
+import asyncio
+import threading
+import time
+
+from . import RuntimeStats, ThreadPool
+
+
+class AsyncPool(object):
+    """
+    A pool with the interface of ThreadPool that runs an asyncio event loop
+    in a single thread.
+
+    Jobs for which is_async returns True are handled on the event loop. The
+    other jobs are handed to a ThreadPool that starts with worker_count
+    threads and, like the thread pool, grows up to max_workers threads when
+    jobs wait longer than scale_up_latency seconds. If the job handler
+    returns a coroutine, it is run on the event loop and the job is done when
+    the coroutine is. Do not call block_till_done or stop from the event
+    loop.
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(self, job_handler, worker_count, busy_callback=None,
+                 max_workers=None, is_async=None, job_name=None,
+                 scale_up_latency=1, idle_timeout=60):
+        """
+        job_handler: method to be called to handle job
+        worker_count: number of threads that handle blocking jobs
+        busy_callback: method to be called when queue gets too big.
+                       Parameters: worker_count, list of current_jobs,
+                                   pending_jobs_count
+        max_workers: maximum number of threads when scaling up
+        is_async: method returning if a job is handled on the event loop
+        job_name: method returning the name to keep the runtime of a job
+                  under
+        scale_up_latency: seconds a job can wait before adding a thread
+        idle_timeout: seconds a thread above worker_count can be idle
+        """
+        self._job_handler = job_handler
+        self._is_async = is_async
+        self._job_name = job_name
+
+        self._executor = ThreadPool(
+            self._execute, worker_count, busy_callback, max_workers,
+            scale_up_latency, idle_timeout)
+        self.wait_stats = self._executor.wait_stats
+        self.job_stats = RuntimeStats()
+        self.running = True
+
+        self._children = []
+        self._lock = threading.RLock()
+        self._done = threading.Condition(self._lock)
+        self._unfinished = 0
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def worker_count(self):
+        """ Number of threads that handle blocking jobs. """
+        return self._executor.worker_count
+
+    @property
+    def max_workers(self):
+        """ Maximum number of threads that handle blocking jobs. """
+        return self._executor.max_workers
+
+    @property
+    def current_jobs(self):
+        """ Blocking jobs that are running with their start time. """
+        return self._executor.current_jobs
+
+    @property
+    def queue_size(self):
+        """ Number of jobs waiting for a thread. """
+        return self._executor.queue_size
+
+    def add_worker(self):
+        """ Adds a thread that handles blocking jobs. """
+        self._executor.add_worker()
+
+    def remove_worker(self):
+        """ Removes a thread that handles blocking jobs. """
+        self._executor.remove_worker()
+
+    def add_child(self, pool):
+        """ Adds a pool whose jobs block_till_done also waits for and that is
+            stopped together with this pool. """
+        with self._lock:
+            self._children.append(pool)
+
+    def add_job(self, priority, job):
+        """ Add a job to the pool. Blocking jobs are handed to the thread
+            pool right away, only the other jobs go through the event loop.
+        """
+        with self._lock:
+            if not self.running:
+                raise RuntimeError("AsyncPool not running")
+
+            self._unfinished += 1
+
+            if self._is_async is None or not self._is_async(job):
+                self._executor.add_job(priority, job)
+                return
+
+        self.loop.call_soon_threadsafe(
+            self._schedule, priority, job, time.monotonic())
+
+    def block_till_done(self):
+        """ Blocks till all work is done, including the work of child
+            pools. """
+        while True:
+            with self._done:
+                while self._unfinished:
+                    self._done.wait()
+
+            for child in list(self._children):
+                child.block_till_done()
+
+            # Jobs of children can add jobs to this pool
+            with self._done:
+                if not self._unfinished:
+                    return
+
+    def stop(self):
+        """ Stops the event loop and the threads. """
+        while True:
+            # Ensure all current jobs finish. Jobs take the lock to add
+            # jobs, so do not wait while holding it.
+            self.block_till_done()
+
+            for child in list(self._children):
+                child.stop()
+
+            with self._lock:
+                if not self.running:
+                    return
+
+                # Jobs were added while waiting
+                if self._unfinished:
+                    continue
+
+                self.running = False
+                break
+
+        self._executor.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def _run_loop(self):
+        """ Runs the event loop until the pool is stopped. """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _schedule(self, priority, job, queued):
+        """ Runs a job on the event loop. Runs on the event loop. """
+        start = time.monotonic()
+        self.wait_stats.add(priority, start - queued)
+        result = None
+
+        try:
+            result = self._job_handler(job)
+        finally:
+            self._finish(job, start, result)
+
+    def _execute(self, job):
+        """ Handles a blocking job in a thread of the thread pool. """
+        start = time.monotonic()
+
+        try:
+            result = self._job_handler(job)
+        except Exception as err:  # pylint: disable=broad-except
+            self.loop.call_soon_threadsafe(self.loop.call_exception_handler, {
+                'message': 'Exception handling job {}'.format(job),
+                'exception': err,
+            })
+            start, result = None, None
+
+        self.loop.call_soon_threadsafe(self._finish, job, start, result)
+
+    def _finish(self, job, start, result):
+        """ Marks a job as done or, if the job handler returned a coroutine,
+            runs it and marks the job as done when it is. """
+        if asyncio.iscoroutine(result):
+            task = self.loop.create_task(result)
+            task.add_done_callback(
+                lambda _: self._finish(job, start, None))
+            return
+
+        if self._job_name is not None and start is not None:
+            self.job_stats.add(self._job_name(job), time.monotonic() - start)
+
+        with self._done:
+            self._unfinished -= 1
+
+            if not self._unfinished:
+                self._done.notify_all()
@@ -0,0 +1,147 @@
+"""
+homeassistant.util.scheduler
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Keeps the time listeners of the event bus by when they are due.
+
+"""
+import heapq
+import itertools
+import logging
+import threading
+
+from homeassistant.const import MATCH_ALL
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Keeps listeners for EVENT_TIME_CHANGED that only want the event at a
+    point in time or when the time matches a pattern. Point in time
+    listeners are kept in a heap by time and removed when due. Time pattern
+    listeners are kept in a wheel by second and their pattern is checked
+    before they are called. A time changed event only queues listeners that
+    are due instead of every listener to compare times.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # Heap of [point_in_time, seq, listener], listener is None if removed
+        self._heap = []
+        self._points = {}
+        self._removed = 0
+        # Time pattern registrations as (listener, seconds, matches)
+        self._patterns = []
+        # Patterns for every second, and a dict second -> patterns
+        self._wheel = ((), {})
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap) - self._removed + len(self._patterns)
+
+    def add_point_in_time(self, listener, point_in_time):
+        """ Call listener once with the first event at point_in_time or
+            later. """
+        with self._lock:
+            entry = [point_in_time, next(self._seq), listener]
+            heapq.heappush(self._heap, entry)
+            self._points.setdefault(listener, []).append(entry)
+
+    def add_time_pattern(self, listener, seconds=MATCH_ALL, matches=None):
+        """ Call listener with every event with a second in seconds for
+            which matches(now) is True. """
+        with self._lock:
+            self._patterns.append((listener, seconds, matches))
+            self._update_wheel((listener, matches), seconds, True)
+
+    def remove(self, listener):
+        """ Remove a listener. Returns if the listener was found. """
+        with self._lock:
+            entries = self._points.get(listener)
+
+            if entries:
+                entries.pop(0)[2] = None
+                self._removed += 1
+
+                if not entries:
+                    del self._points[listener]
+
+                # Drop removed entries when they take up half the heap
+                if self._removed > len(self._heap) // 2:
+                    self._heap = [entry for entry in self._heap
+                                  if entry[2] is not None]
+                    heapq.heapify(self._heap)
+                    self._removed = 0
+
+                return True
+
+            for index, (func, seconds, matches) in enumerate(self._patterns):
+                if func == listener:
+                    del self._patterns[index]
+                    self._update_wheel((func, matches), seconds, False)
+                    return True
+
+            return False
+
+    def due(self, now):
+        """ Return the listeners that are due at now. Point in time
+            listeners are removed. """
+        every_second, wheel = self._wheel
+        listeners = tuple(
+            listener for listener, matches
+            in every_second + wheel.get(getattr(now, 'second', None), ())
+            if matches is None or matches(now))
+        if not self._heap:
+            return listeners
+
+        with self._lock:
+            heap = self._heap
+
+            try:
+                while heap and heap[0][0] <= now:
+                    _, _, listener = heapq.heappop(heap)
+
+                    if listener is None:
+                        self._removed -= 1
+                        continue
+
+                    entries = self._points[listener]
+                    entries.pop(0)
+
+                    if not entries:
+                        del self._points[listener]
+
+                    listeners += (listener,)
+
+            except TypeError:
+                _LOGGER.error("Cannot compare %s with scheduled times", now)
+
+        return listeners
+
+    def _update_wheel(self, pattern, seconds, add):
+        """ Build a new wheel after adding or removing a pattern. Call with
+            the lock held. """
+        def update(patterns):
+            """ Returns patterns with pattern added or removed. """
+            if add:
+                return patterns + (pattern,)
+
+            index = patterns.index(pattern)
+            return patterns[:index] + patterns[index+1:]
+
+        every_second, wheel = self._wheel
+
+        if seconds == MATCH_ALL:
+            every_second = update(every_second)
+        else:
+            wheel = dict(wheel)
+
+            for second in set(seconds):
+                wheel[second] = update(wheel.get(second, ()))
+
+                if not wheel[second]:
+                    del wheel[second]
+
+        self._wheel = (every_second, wheel)
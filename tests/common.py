@@ -5,6 +5,7 @@ tests.helper
 Helper method for writing tests.
 """
 import os
+import re
 from datetime import timedelta
 from unittest import mock
 
@@ -15,7 +16,11 @@ from homeassistant.const import (
     STATE_ON, STATE_OFF, DEVICE_DEFAULT_NAME, EVENT_TIME_CHANGED,
     EVENT_STATE_CHANGED, EVENT_PLATFORM_DISCOVERED, ATTR_SERVICE,
     ATTR_DISCOVERED)
-from homeassistant.components import sun, mqtt
+from homeassistant.components import sun, mqtt, recorder
+
+# Scans of a whole table or index, covering or not, but not of subqueries
+RE_FULL_SCAN = re.compile(r'SCAN (TABLE )?(?!SUBQUERY\b|CONSTANT ROW)\w')
+RE_TEMP_SORT = re.compile(r'USE TEMP B-TREE')
 
 
 def get_test_config_dir():
@@ -119,6 +124,19 @@ def mock_state_change_event(hass, new_state, old_state=None):
     hass.bus.fire(EVENT_STATE_CHANGED, event_data)
 
 
+def query_uses_index(sql_query, arguments=None, allow_temp_sort=False):
+    """ Returns if SQLite answers a recorder query without scanning a whole
+        table or index and, unless allow_temp_sort, without sorting the rows
+        in a temporary b-tree, according to EXPLAIN QUERY PLAN. """
+    plan = [row[3] for row in recorder.query(
+        'EXPLAIN QUERY PLAN ' + sql_query, arguments)]
+
+    return bool(plan) and not any(
+        RE_FULL_SCAN.match(detail) or
+        not allow_temp_sort and RE_TEMP_SORT.match(detail)
+        for detail in plan)
+
+
 def mock_http_component(hass):
     hass.http = MockHTTP()
     hass.config.components.append('http')
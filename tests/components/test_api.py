@@ -15,6 +15,7 @@ import homeassistant.core as ha
 import homeassistant.bootstrap as bootstrap
 import homeassistant.remote as remote
 import homeassistant.components.http as http
+import homeassistant.const as const
 from homeassistant.const import HTTP_HEADER_HA_AUTH
 
 API_PASSWORD = "test1234"
@@ -292,6 +293,55 @@ class TestAPI(unittest.TestCase):
 
         self.assertEqual(1, len(test_value))
 
+    def test_api_get_metrics(self):
+        """ Test getting the runtime statistics as JSON and Prometheus. """
+        hass.services.register("test_domain", "metrics_service", lambda _: _)
+        hass.services.call("test_domain", "metrics_service", blocking=True)
+        hass.pool.block_till_done()
+
+        req = requests.get(_url(const.URL_API_METRICS), headers=HA_HEADERS)
+
+        data = req.json()
+        core = data['pools']['core']
+
+        self.assertEqual(
+            1, data['services']['test_domain.metrics_service']['count'])
+        self.assertLessEqual(1, core['queue_wait']['EVENT_SERVICE']['count'])
+        self.assertIn('homeassistant.core.ServiceRegistry._execute_service',
+                      core['jobs'])
+
+        req = requests.get(_url(const.URL_API_METRICS),
+                           params={'format': 'prometheus'},
+                           headers=HA_HEADERS)
+
+        self.assertTrue(
+            req.headers['content-type'].startswith('text/plain'))
+        self.assertIn('homeassistant_service_calls_total'
+                      '{service="test_domain.metrics_service"} 1.0',
+                      req.text.split('\n'))
+        self.assertIsNone(data['history_cache'])
+
+    def test_api_get_metrics_history_cache(self):
+        """ Test the history cache statistics are in the metrics. """
+        stats = {'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'entities': 2,
+                 'states': 5}
+
+        with patch('homeassistant.components.history.cache_stats',
+                   return_value=stats), \
+                patch.object(hass.config, 'components',
+                             hass.config.components + ['history']):
+            data = requests.get(
+                _url(const.URL_API_METRICS), headers=HA_HEADERS).json()
+            text = requests.get(
+                _url(const.URL_API_METRICS), params={'format': 'prometheus'},
+                headers=HA_HEADERS).text
+
+        self.assertEqual(stats, data['history_cache'])
+        self.assertIn('homeassistant_history_cache_hits_total{} 3.0',
+                      text.split('\n'))
+        self.assertIn('homeassistant_history_cache_states{} 5.0',
+                      text.split('\n'))
+
     def test_api_event_forward(self):
         """ Test setting up event forwarding. """
 
@@ -367,3 +417,17 @@ class TestAPI(unittest.TestCase):
                 }),
             headers=HA_HEADERS)
         self.assertEqual(200, req.status_code)
+
+    def test_iter_json(self):
+        """ Test streaming JSON with generators. """
+        state = hass.states.get('test.test')
+
+        self.assertEqual(
+            [[state.as_dict()], [], [0], [0, 1]],
+            json.loads(''.join(http.iter_json(
+                (state for state in [state]) if n < 0 else
+                (i for i in range(n)) for n in range(-1, 3)))))
+
+        self.assertEqual('[]', ''.join(http.iter_json(iter([]))))
+        self.assertEqual('{"a":[1,2],"b":null}',
+                         ''.join(http.iter_json({'b': None, 'a': [1, 2]})))
@@ -16,7 +16,8 @@ import homeassistant.util.dt as dt_util
 from homeassistant.components import history, recorder
 
 from tests.common import (
-    mock_http_component, mock_state_change_event, get_test_home_assistant)
+    mock_http_component, mock_state_change_event, get_test_home_assistant,
+    query_uses_index)
 
 
 class TestComponentHistory(unittest.TestCase):
@@ -30,13 +31,14 @@ class TestComponentHistory(unittest.TestCase):
     def tearDown(self):  # pylint: disable=invalid-name
         """ Stop down stuff we started. """
         self.hass.stop()
+        history._CACHE = None
 
         if self.init_rec:
             recorder._INSTANCE.block_till_done()
             os.remove(self.hass.config.path(recorder.DB_FILE))
 
-    def init_recorder(self):
-        recorder.setup(self.hass, {})
+    def init_recorder(self, config=None):
+        recorder.setup(self.hass, config or {})
         self.hass.start()
         recorder._INSTANCE.block_till_done()
         self.init_rec = True
@@ -104,6 +106,29 @@ class TestComponentHistory(unittest.TestCase):
         self.assertEqual(
             states[0], history.get_state(point, states[0].entity_id))
 
+    def test_get_states_after_restart(self):
+        """ Test a restored state set to the same value is in history. """
+        path = self.hass.config.path('test_states.json')
+        states = ha.StateMachine(self.hass.bus)
+        states.set('sensor.temperature', '20')
+        states.save(path)
+
+        try:
+            self.assertEqual(1, self.hass.states.restore(path))
+        finally:
+            os.remove(path)
+
+        self.init_recorder()
+        self.hass.states.set('sensor.temperature', '20')
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        self.assertEqual(
+            ['20'],
+            [state.state for state in history.get_states(
+                dt_util.utcnow() + timedelta(seconds=1),
+                ['sensor.temperature'])])
+
     def test_state_changes_during_period(self):
         self.init_recorder()
         entity_id = 'media_player.test'
@@ -137,3 +162,280 @@ class TestComponentHistory(unittest.TestCase):
         self.assertEqual(
             {entity_id: states},
             history.state_changes_during_period(start, end, entity_id))
+
+    def test_queries_use_index(self):
+        """ Test that the history queries do not scan the states table. """
+        self.init_recorder()
+        self.hass.states.set('media_player.test', 'idle')
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        start = dt_util.utcnow()
+        end = start + timedelta(seconds=1)
+
+        with patch('homeassistant.components.recorder.query_states',
+                   wraps=recorder.query_states) as query_states, \
+                patch('homeassistant.components.recorder.iter_states',
+                      wraps=recorder.iter_states) as iter_states:
+            history.last_5_states('media_player.test')
+            history.state_changes_during_period(start, end)
+            history.state_changes_during_period(
+                start, end, 'media_player.test')
+            history.get_states(end)
+
+        self.assertEqual(4, query_states.call_count)
+        self.assertEqual(2, iter_states.call_count)
+
+        # Grouping or ordering the states of a period by entity has to sort
+        for call in query_states.call_args_list + iter_states.call_args_list:
+            self.assertTrue(
+                query_uses_index(*call[0], allow_temp_sort=True), call[0][0])
+
+    def test_iter_state_changes_during_period(self):
+        """ Test streaming state changes ordered by entity. """
+        self.init_recorder()
+
+        def set_state(entity_id, state):
+            self.hass.states.set(entity_id, state)
+            self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+            return self.hass.states.get(entity_id)
+
+        before = dt_util.utcnow() + timedelta(seconds=1)
+        start = before + timedelta(seconds=1)
+        point = start + timedelta(seconds=1)
+        end = point + timedelta(seconds=1)
+
+        with patch('homeassistant.util.dt.utcnow', return_value=before):
+            set_state('test.a', 'on')
+            set_state('test.c', 'on')
+
+        with patch('homeassistant.util.dt.utcnow', return_value=point):
+            changes = [
+                set_state('test.b', 'on'),
+                set_state('test.c', 'off'),
+                set_state('test.b', 'off'),
+            ]
+
+        result = [(entity_id, [state.state for state in states])
+                  for entity_id, states
+                  in history.iter_state_changes_during_period(start, end)]
+
+        self.assertEqual([
+            ('test.a', ['on']),
+            ('test.b', ['on', 'off']),
+            ('test.c', ['on', 'off']),
+        ], result)
+
+        self.assertEqual(
+            changes[1],
+            history.state_changes_during_period(start, end)['test.c'][1])
+
+    def test_recent_state_cache(self):
+        """ Test answering history queries from memory. """
+        self.init_recorder()
+        mock_http_component(self.hass)
+
+        self.assertTrue(history.setup(self.hass, {
+            history.DOMAIN: {history.CONF_CACHE_HOURS: 24}}))
+
+        before = dt_util.utcnow() + timedelta(seconds=1)
+        start = before + timedelta(seconds=1)
+        point = start + timedelta(seconds=1)
+        end = point + timedelta(seconds=1)
+
+        with patch('homeassistant.util.dt.utcnow', return_value=before):
+            self.hass.states.set('test.existing', 'on')
+            self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+        with patch('homeassistant.util.dt.utcnow', return_value=point):
+            for i in range(6):
+                self.hass.states.set('media_player.test', 'State {}'.format(i))
+                self.hass.pool.block_till_done()
+            self.hass.states.set('test.existing', 'off')
+            self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+        def get_history():
+            """ Run all history queries. """
+            return (
+                history.state_changes_during_period(start, end),
+                history.state_changes_during_period(
+                    start, end, 'media_player.test'),
+                sorted(history.get_states(end),
+                       key=lambda state: state.entity_id),
+                history.last_5_states('media_player.test'),
+            )
+
+        cached = get_history()
+        self.assertEqual(4, history.cache_stats()['hits'])
+
+        # Before the cache was created
+        history.get_states(start - timedelta(hours=1))
+        self.assertEqual(1, history.cache_stats()['misses'])
+
+        history._CACHE = None
+        self.assertEqual(get_history(), cached)
+        self.assertEqual(2, len(cached[0]['test.existing']))
+        self.assertEqual(6, len(cached[1]['media_player.test']))
+
+    def test_recent_state_cache_filter(self):
+        """ Test the cache keeps only the entities that are recorded. """
+        self.init_recorder({recorder.DOMAIN: {recorder.CONF_EXCLUDE: {
+            recorder.CONF_DOMAINS: ['sun']}}})
+        mock_http_component(self.hass)
+        self.hass.states.set('sun.sun', 'above_horizon')
+        self.hass.pool.block_till_done()
+
+        self.assertTrue(history.setup(self.hass, {
+            history.DOMAIN: {history.CONF_CACHE_HOURS: 24}}))
+
+        self.hass.states.set('sun.sun', 'below_horizon')
+        self.hass.states.set('light.bowl', 'on')
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        self.assertEqual(
+            ['light.bowl'],
+            [state.entity_id for state in history.get_states(
+                dt_util.utcnow() + timedelta(seconds=1))])
+        self.assertEqual(1, history.cache_stats()['hits'])
+        self.assertEqual(1, history.cache_stats()['entities'])
+
+    def test_recent_state_cache_throttled(self):
+        """ Test the cache leaves entities the recorder throttles to the
+            recorder and looks up entity ids in any case. """
+        self.init_recorder({recorder.DOMAIN: {recorder.CONF_DEADBAND: {
+            'sensor.power': 5}}})
+        mock_http_component(self.hass)
+
+        self.assertTrue(history.setup(self.hass, {
+            history.DOMAIN: {history.CONF_CACHE_HOURS: 24}}))
+
+        start = dt_util.utcnow()
+        point = start + timedelta(seconds=1)
+        end = point + timedelta(seconds=1)
+
+        with patch('homeassistant.util.dt.utcnow', return_value=point):
+            for state in ('100', '101', 'on'):
+                self.hass.states.set('sensor.power', state)
+                self.hass.states.set('light.bowl', state)
+                self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+        self.assertEqual(
+            ['100', 'on'],
+            [state.state for state in history.state_changes_during_period(
+                start, end, 'sensor.power')['sensor.power']])
+        self.assertEqual(
+            3, len(history.state_changes_during_period(start, end)
+                   ['light.bowl']))
+        self.assertEqual(0, history.cache_stats()['hits'])
+
+        self.assertEqual(
+            3, len(history.state_changes_during_period(
+                start, end, 'Light.Bowl')['light.bowl']))
+        self.assertEqual(
+            ['on'],
+            [state.state for state in history._CACHE.get_states(
+                end, ['LIGHT.BOWL'])])
+        self.assertEqual(2, history.cache_stats()['hits'])
+
+    def test_statistics_during_period(self):
+        """ Test rolling up numeric states into statistics. """
+        self.init_recorder()
+        start = dt_util.utcnow().replace(
+            minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+        def set_state(minutes, entity_id, state, attributes=None):
+            with patch('homeassistant.util.dt.utcnow',
+                       return_value=start + timedelta(minutes=minutes)):
+                self.hass.states.set(entity_id, state, attributes or {
+                    'unit_of_measurement': '°C'})
+                self.hass.pool.block_till_done()
+                recorder._INSTANCE.block_till_done()
+
+        set_state(1, 'sensor.temp', 10)
+        set_state(2, 'sensor.temp', 20)
+        set_state(7, 'sensor.temp', 30)
+        set_state(61, 'sensor.temp', 40)
+        set_state(62, 'sensor.temp', 'unknown')
+        set_state(62, 'test.count', 5, {'count': 5})
+
+        # The current periods are continued from the database
+        recorder._INSTANCE._statistics.clear()
+        set_state(63, 'sensor.temp', 0)
+
+        def stats(start_minutes, min_value, max_value, mean, last):
+            """ Return the expected statistics of a period. """
+            return {'start': start + timedelta(minutes=start_minutes),
+                    'min': min_value, 'max': max_value, 'mean': mean,
+                    'last': last}
+
+        end = start + timedelta(hours=2)
+
+        with patch('homeassistant.components.recorder.query',
+                   wraps=recorder.query) as query:
+            self.assertEqual(
+                {'sensor.temp': [stats(0, 10, 30, 20, 30),
+                                 stats(60, 0, 40, 20, 0)]},
+                history.statistics_during_period(
+                    start + timedelta(minutes=30), end))
+
+            self.assertEqual(
+                {'sensor.temp': [stats(0, 10, 20, 15, 20),
+                                 stats(5, 30, 30, 30, 30),
+                                 stats(60, 0, 40, 20, 0)]},
+                history.statistics_during_period(
+                    start, end, 'sensor.temp', recorder.STATISTICS_5MINUTE))
+
+        # Ordering the statistics of all entities by entity has to sort
+        for call in query.call_args_list:
+            self.assertTrue(
+                query_uses_index(*call[0], allow_temp_sort=True), call[0][0])
+
+    def test_downsample_states(self):
+        """ Test thinning out state changes for a graph. """
+        start = dt_util.utcnow().replace(microsecond=0)
+
+        def state(seconds, value):
+            """ Return a state changed seconds after start. """
+            point = start + timedelta(seconds=seconds)
+            return ha.State('sensor.power', value, last_changed=point,
+                            last_updated=point)
+
+        states = [state(0, '5'), state(1, '3'), state(2, '9'), state(3, '4'),
+                  state(10, '7'), state(20, 'unavailable'),
+                  state(21, 'unavailable'), state(22, '2'), state(25, '8'),
+                  state(26, '1'), state(30, '6')]
+
+        # The first, lowest, highest and last state per 10 seconds, in order
+        self.assertEqual(
+            [(0, '5'), (1, '3'), (2, '9'), (3, '4'), (10, '7'),
+             (20, 'unavailable'), (25, '8'), (26, '1'), (30, '6')],
+            [((state.last_changed - start).total_seconds(), state.state)
+             for state in history.downsample_states(states, start, 10)])
+
+        # The state a period ends with is kept
+        self.assertEqual(
+            ['5', '10', '7'],
+            [state.state for state in history.downsample_states(
+                [state(0, '5'), state(1, '10'), state(2, '7')], start, 10)])
+
+        # Flapping non-numeric states are reduced per period as well
+        self.assertEqual(
+            [(0, 'on'), (9, 'off'), (10, 'on'), (19, 'off')],
+            [((state.last_changed - start).total_seconds(), state.state)
+             for state in history.downsample_states(
+                 [state(seconds, 'off' if seconds % 2 else 'on')
+                  for seconds in range(20)], start, 10)])
+
+        # Without repeating the state kept before
+        self.assertEqual(
+            [(0, 'on'), (15, 'off')],
+            [((state.last_changed - start).total_seconds(), state.state)
+             for state in history.downsample_states(
+                 [state(0, 'on'), state(5, 'off'), state(9, 'on'),
+                  state(15, 'off')], start, 10)])
@@ -5,16 +5,19 @@ tests.test_component_logbook
 Tests the logbook component.
 """
 # pylint: disable=protected-access,too-many-public-methods
+import os
 import unittest
+from unittest.mock import patch
 from datetime import timedelta
 
 import homeassistant.core as ha
 from homeassistant.const import (
     EVENT_STATE_CHANGED, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP)
 import homeassistant.util.dt as dt_util
-from homeassistant.components import logbook
+from homeassistant.components import logbook, recorder
 
-from tests.common import get_test_home_assistant, mock_http_component
+from tests.common import (
+    get_test_home_assistant, mock_http_component, query_uses_index)
 
 
 class TestComponentHistory(unittest.TestCase):
@@ -29,11 +32,130 @@ class TestComponentHistory(unittest.TestCase):
         finally:
             hass.stop()
 
-    def test_humanify_filter_sensor(self):
-        """ Test humanify filter too frequent sensor values. """
+    def test_query_uses_index(self):
+        """ Test that the logbook query does not scan the events table. """
+        hass = get_test_home_assistant()
+
+        try:
+            recorder.setup(hass, {})
+            hass.start()
+            hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+            start = dt_util.utcnow()
+
+            self.assertTrue(query_uses_index(
+                logbook.QUERY_ENTRIES_BETWEEN,
+                (start, start + timedelta(days=1))))
+        finally:
+            hass.stop()
+            recorder._INSTANCE.block_till_done()
+            os.remove(hass.config.path(recorder.DB_FILE))
+
+    def test_entries_written_when_recorded(self):
+        """ Test writing the entries while the events are recorded, starting
+            with the events recorded before the logbook was set up, and
+            reading them filtered and in pages. """
+        hass = get_test_home_assistant()
+
+        try:
+            mock_http_component(hass)
+            recorder.setup(hass, {})
+            hass.start()
+            hass.pool.block_till_done()
+            hass.states.set('light.kitchen', 'off')
+            hass.states.set('light.kitchen', 'on')
+            hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+            # The events recorded before are caught up with in chunks
+            with patch('homeassistant.components.logbook.'
+                       'CATCH_UP_FETCH_SIZE', 1), \
+                    patch('homeassistant.components.recorder.'
+                          'run_in_transaction',
+                          wraps=recorder.run_in_transaction) as transaction:
+                self.assertTrue(logbook.setup(hass, {}))
+                hass.states.set('light.kitchen', 'off')
+                hass.pool.block_till_done()
+                recorder._INSTANCE.block_till_done()
+                hass.pool.block_till_done()
+
+            self.assertEqual(4, transaction.call_count)
+
+            start = dt_util.utcnow() - timedelta(minutes=1)
+            base = dt_util.strip_microseconds(
+                dt_util.utcnow().replace(minute=0) + timedelta(hours=1))
+
+            def fire_at(minutes, func, *args):
+                """ Call func with utcnow at base + minutes. """
+                point = base + timedelta(minutes=minutes)
+
+                with patch('homeassistant.util.dt.utcnow',
+                           return_value=point):
+                    func(*args)
+                    hass.pool.block_till_done()
+                    recorder._INSTANCE.block_till_done()
+
+                return point
+
+            for minutes, value in ((0, 5), (1, 10), (5, 20), (16, 30)):
+                fire_at(minutes, hass.states.set, 'sensor.temp', value)
+
+            fire_at(20, logbook.log_entry, hass, 'Nice name',
+                    'has a custom entry', None, 'sun.sun')
+
+            point = base + timedelta(minutes=30)
+            recorder._INSTANCE.record_events([
+                ha.Event(EVENT_HOMEASSISTANT_STOP, time_fired=point),
+                ha.Event(EVENT_HOMEASSISTANT_START, time_fired=point)])
+
+            period = (start, point + timedelta(minutes=1))
+            expected = [
+                ('Home Assistant', 'started'), ('kitchen', 'turned on'),
+                ('kitchen', 'turned off'),
+                ('temp', 'changed to 20'), ('temp', 'changed to 30'),
+                ('Nice name', 'has a custom entry'),
+                ('Home Assistant', 'restarted')]
+
+            self.assertEqual(expected, [
+                (row[1], row[2]) for row in recorder.iter_query(
+                    logbook.QUERY_ENTRIES_BETWEEN, period)])
+
+            with patch('homeassistant.components.recorder.iter_query',
+                       wraps=recorder.iter_query) as iter_query:
+                self.assertEqual(
+                    ['changed to 20', 'changed to 30'],
+                    [entry.message for _, entry in logbook.iter_entries(
+                        *period, entity_id='sensor.Temp')])
+                self.assertEqual(
+                    ['kitchen', 'kitchen'],
+                    [entry.name for _, entry in logbook.iter_entries(
+                        *period, domain='light')])
+
+                # Entries of the same second are paged by event id
+                pages = [list(logbook.iter_entries(*period, limit=1))]
+
+                while pages[-1]:
+                    pages.append(list(logbook.iter_entries(
+                        *period, after=pages[-1][-1][0], limit=4)))
+
+            self.assertEqual([1, 4, 2, 0], [len(page) for page in pages])
+            self.assertEqual(expected, [
+                (entry.name, entry.message) for page in pages
+                for _, entry in page])
+
+            for call in iter_query.call_args_list:
+                self.assertTrue(query_uses_index(*call[0]), call[0][0])
+        finally:
+            hass.stop()
+            recorder._INSTANCE.block_till_done()
+            os.remove(hass.config.path(recorder.DB_FILE))
+
+    def test_filter_sensor(self):
+        """ Test too frequent sensor values are filtered. """
         entity_id = 'sensor.bla'
 
-        pointA = dt_util.strip_microseconds(dt_util.utcnow().replace(minute=2))
+        pointA = self.base.replace(minute=2)
         pointB = pointA.replace(minute=5)
         pointC = pointA + timedelta(minutes=logbook.GROUP_BY_MINUTES)
 
@@ -41,7 +163,9 @@ class TestComponentHistory(unittest.TestCase):
         eventB = self.create_state_changed_event(pointB, entity_id, 20)
         eventC = self.create_state_changed_event(pointC, entity_id, 30)
 
-        entries = list(logbook.humanify((eventA, eventB, eventC)))
+        # Writing the entry of an older event later, like when catching up,
+        # does not replace the newer one
+        entries = self.write_entries([(2, eventB), (3, eventC)], [(1, eventA)])
 
         self.assertEqual(2, len(entries))
         self.assert_entry(
@@ -53,10 +177,10 @@ class TestComponentHistory(unittest.TestCase):
     def test_home_assistant_start_stop_grouped(self):
         """ Tests if home assistant start and stop events are grouped if
             occuring in the same minute. """
-        entries = list(logbook.humanify((
-            ha.Event(EVENT_HOMEASSISTANT_STOP),
-            ha.Event(EVENT_HOMEASSISTANT_START),
-            )))
+        entries = self.write_entries([
+            (1, ha.Event(EVENT_HOMEASSISTANT_STOP, time_fired=self.base)),
+            (2, ha.Event(EVENT_HOMEASSISTANT_START, time_fired=self.base)),
+            ])
 
         self.assertEqual(1, len(entries))
         self.assert_entry(
@@ -69,19 +193,49 @@ class TestComponentHistory(unittest.TestCase):
         message = 'has a custom entry'
         entity_id = 'sun.sun'
 
-        entries = list(logbook.humanify((
-            ha.Event(logbook.EVENT_LOGBOOK_ENTRY, {
+        entries = self.write_entries([
+            (1, ha.Event(logbook.EVENT_LOGBOOK_ENTRY, {
                 logbook.ATTR_NAME: name,
                 logbook.ATTR_MESSAGE: message,
                 logbook.ATTR_ENTITY_ID: entity_id,
-                }),
-            )))
+                }, time_fired=self.base)),
+            ])
 
         self.assertEqual(1, len(entries))
         self.assert_entry(
             entries[0], name=name, message=message,
             domain='sun', entity_id=entity_id)
 
+    @property
+    def base(self):
+        """ Start of the next hour, after the events of starting. """
+        return dt_util.utcnow().replace(
+            minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+    def write_entries(self, *batches):
+        """ Writes the entries of batches of (event_id, event) tuples and
+            returns them. """
+        hass = get_test_home_assistant()
+
+        try:
+            recorder.setup(hass, {})
+            hass.start()
+            hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+            for events in batches:
+                recorder.run_in_transaction(
+                    lambda cur, events=events: logbook._write_entries(
+                        cur, events))
+
+            return [entry for _, entry in logbook.iter_entries(
+                self.base - timedelta(seconds=1),
+                self.base + timedelta(hours=1))]
+        finally:
+            hass.stop()
+            recorder._INSTANCE.block_till_done()
+            os.remove(hass.config.path(recorder.DB_FILE))
+
     def assert_entry(self, entry, when=None, name=None, message=None,
                      domain=None, entity_id=None):
         """ Asserts an entry is what is expected """
@@ -105,7 +259,8 @@ class TestComponentHistory(unittest.TestCase):
 
         # Logbook only cares about state change events that
         # contain an old state but will not actually act on it.
-        state = ha.State(entity_id, state).as_dict()
+        state = ha.State(entity_id, state, last_changed=event_time_fired,
+                         last_updated=event_time_fired)
 
         return ha.Event(EVENT_STATE_CHANGED, {
             'entity_id': entity_id,
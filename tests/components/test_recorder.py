@@ -6,10 +6,17 @@ Tests Recorder component.
 """
 # pylint: disable=too-many-public-methods,protected-access
 import unittest
+from unittest import mock
 import os
+import sqlite3
+from datetime import timedelta
 
-from homeassistant.const import MATCH_ALL
+import homeassistant.core as ha
+from homeassistant.const import (
+    MATCH_ALL, EVENT_STATE_CHANGED, EVENT_TIME_CHANGED, ATTR_NOW,
+    ATTR_UNIT_OF_MEASUREMENT)
 from homeassistant.components import recorder
+import homeassistant.util.dt as dt_util
 
 from tests.common import get_test_home_assistant
 
@@ -21,6 +28,7 @@ class TestRecorder(unittest.TestCase):
         self.hass = get_test_home_assistant()
         recorder.setup(self.hass, {})
         self.hass.start()
+        self.hass.pool.block_till_done()
         recorder._INSTANCE.block_till_done()
 
     def tearDown(self):  # pylint: disable=invalid-name
@@ -68,3 +76,340 @@ class TestRecorder(unittest.TestCase):
             'SELECT * FROM events WHERE event_type = ?', (event_type, ))
 
         self.assertEqual(events, db_events)
+
+    def test_saving_batch(self):
+        """ Tests that a batch of events is stored in one go. """
+        for idx in range(10):
+            self.hass.states.set('test.recorder_{}'.format(idx), idx)
+
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        states = recorder.query(
+            'SELECT states.entity_id, events.event_type FROM states '
+            'INNER JOIN events ON states.event_id = events.event_id')
+
+        self.assertEqual(10, len(states))
+        self.assertTrue(all(row[1] == 'state_changed' for row in states))
+
+    def test_saving_batch_with_bad_event(self):
+        """ Tests an event that cannot be saved does not lose its batch. """
+        recorder._INSTANCE.query("""
+            CREATE TRIGGER reject_bad_event BEFORE INSERT ON events
+            WHEN NEW.event_type = 'bad_event'
+            BEGIN SELECT RAISE(ABORT, 'bad event'); END""")
+
+        with mock.patch('homeassistant.components.recorder._LOGGER'):
+            recorder._INSTANCE.record_events([
+                ha.Event('good_event', {'index': 0}),
+                ha.Event('bad_event'),
+                ha.Event('good_event', {'index': 2}),
+            ])
+
+        self.assertEqual(
+            [('good_event', '{"index":0}'), ('good_event', '{"index":2}')],
+            [tuple(row) for row in recorder.query(
+                "SELECT event_type, event_data FROM events WHERE event_type "
+                "IN ('good_event', 'bad_event') ORDER BY event_id")])
+
+    def test_get_batch(self):
+        """ Tests collecting a batch from the queue. """
+        # Not started, so no recorder thread is consuming the queue
+        instance = recorder.Recorder(mock.MagicMock(), commit_max_events=3)
+
+        for idx in range(4):
+            instance.queue.put(idx)
+        instance.queue.put(instance.quit_object)
+        instance.queue.put('after quit')
+
+        self.assertEqual([0, 1, 2], instance._get_batch())
+        self.assertEqual([3, instance.quit_object], instance._get_batch())
+
+    def test_purge(self):
+        """ Tests purging old rows in chunks. """
+        old = dt_util.utcnow() - timedelta(days=5)
+
+        with mock.patch('homeassistant.util.dt.utcnow', return_value=old):
+            for idx in range(5):
+                self.hass.states.set(
+                    'test.old', idx, {ATTR_UNIT_OF_MEASUREMENT: 'W'})
+                self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+        self.hass.states.set('test.new', 'new')
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        with mock.patch.object(recorder, 'PURGE_CHUNK_SIZE', 2):
+            self.hass.services.call(
+                recorder.DOMAIN, recorder.SERVICE_PURGE,
+                {recorder.ATTR_KEEP_DAYS: 1})
+            self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+        states = recorder.query_states('SELECT * FROM states')
+        self.assertEqual(['test.new'], [state.entity_id for state in states])
+
+        self.assertEqual(0, recorder.query(
+            'SELECT count(*) FROM events WHERE time_fired < ?',
+            (old + timedelta(days=1),))[0][0])
+
+        # The event of the remaining state is kept
+        self.assertEqual(1, recorder.query(
+            'SELECT count(*) FROM states INNER JOIN events '
+            'ON states.event_id = events.event_id')[0][0])
+
+        # Statistics are kept for purge_statistics_days
+        statistics_query = \
+            "SELECT count(*) FROM statistics WHERE entity_id = 'test.old'"
+        self.assertEqual(2, recorder.query(statistics_query)[0][0])
+
+        recorder._INSTANCE.purge_statistics_days = 2
+
+        with mock.patch.object(recorder, 'PURGE_CHUNK_SIZE', 1):
+            self.hass.services.call(
+                recorder.DOMAIN, recorder.SERVICE_PURGE,
+                {recorder.ATTR_KEEP_DAYS: 1})
+            self.hass.pool.block_till_done()
+            recorder._INSTANCE.block_till_done()
+
+        self.assertEqual(0, recorder.query(statistics_query)[0][0])
+
+    def test_shared_attributes(self):
+        """ Tests that identical attributes are stored once. """
+        attributes = {'unit_of_measurement': 'W', 'friendly_name': 'Power'}
+
+        for idx in range(3):
+            self.hass.states.set('sensor.power', idx, attributes)
+            self.hass.pool.block_till_done()
+        self.hass.states.set('sensor.other', 'on', {'unit': 'W'})
+
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        self.assertEqual(2, recorder.query(
+            'SELECT count(*) FROM state_attributes')[0][0])
+
+        states = recorder.query_states(
+            'SELECT * FROM states WHERE entity_id = ?', ('sensor.power',))
+
+        self.assertEqual(3, len(states))
+        self.assertTrue(all(state.attributes == attributes
+                            for state in states))
+
+        # Joined attributes are parsed without querying them per state
+        recorder._ATTRIBUTES.clear()
+
+        with mock.patch.object(recorder._INSTANCE, 'read_query',
+                               wraps=recorder._INSTANCE.read_query) as read:
+            states = recorder.query_states(
+                recorder.STATES_QUERY +
+                'WHERE entity_id IN (?, ?) ORDER BY state_id',
+                ('sensor.power', 'sensor.other'))
+
+        self.assertEqual(1, read.call_count)
+        self.assertEqual(4, len(states))
+        self.assertEqual({'unit': 'W'}, states[3].attributes)
+        self.assertTrue(all(state.attributes == attributes
+                            for state in states[:3]))
+
+    def test_legacy_attributes(self):
+        """ Tests restoring states stored before attributes were shared. """
+        recorder._INSTANCE.query(
+            "INSERT INTO states (entity_id, state, attributes, last_changed,"
+            "last_updated) VALUES ('test.legacy', 'on', '{\"a\": 1}', 0, 0)")
+
+        states = recorder.query_states('SELECT * FROM states')
+
+        self.assertEqual(1, len(states))
+        self.assertEqual({'a': 1}, states[0].attributes)
+
+
+class TestRecorderWAL(TestRecorder):
+    """ Runs the recorder tests with write-ahead logging and a read pool. """
+
+    def setUp(self):  # pylint: disable=invalid-name
+        self.hass = get_test_home_assistant()
+        recorder.setup(self.hass, {recorder.DOMAIN: {
+            recorder.CONF_WAL: True,
+            recorder.CONF_SYNCHRONOUS: 'normal',
+            recorder.CONF_CACHE_SIZE: -4000,
+            recorder.CONF_PURGE_VACUUM: True,
+        }})
+        self.hass.start()
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+    def test_pragmas(self):
+        """ Tests the database is configured for WAL. """
+        self.assertEqual(
+            'wal', recorder._INSTANCE.query('PRAGMA journal_mode')[0][0])
+        # 1 = NORMAL
+        self.assertEqual(
+            1, recorder._INSTANCE.query('PRAGMA synchronous')[0][0])
+        # 2 = INCREMENTAL
+        self.assertEqual(
+            2, recorder._INSTANCE.query('PRAGMA auto_vacuum')[0][0])
+
+    def test_read_pool_is_read_only(self):
+        """ Tests that recorder.query uses a read-only connection. """
+        self.assertEqual(-4000, recorder.query('PRAGMA cache_size')[0][0])
+
+        with self.assertRaises(sqlite3.OperationalError):
+            recorder.query('DELETE FROM events')
+
+    def test_invalid_synchronous(self):
+        """ Tests setup fails for an invalid synchronous setting. """
+        self.assertFalse(recorder.setup(self.hass, {recorder.DOMAIN: {
+            recorder.CONF_SYNCHRONOUS: 'sometimes'}}))
+
+
+class TestRecorderFilters(unittest.TestCase):
+    """ Test the recording filters. """
+
+    def setUp(self):  # pylint: disable=invalid-name
+        self.hass = get_test_home_assistant()
+        self.assertTrue(recorder.setup(self.hass, {recorder.DOMAIN: {
+            recorder.CONF_EXCLUDE: {
+                recorder.CONF_DOMAINS: ['sun'],
+                recorder.CONF_ENTITIES: 'sensor.clock, sensor.uptime',
+                recorder.CONF_EVENT_TYPES: ['noisy_event'],
+            },
+            recorder.CONF_MIN_INTERVAL: {'sensor.Power': 10},
+            recorder.CONF_DEADBAND: {'sensor.power': 5,
+                                     'sensor.temperature': 0.5},
+        }}))
+        self.hass.start()
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+    def tearDown(self):  # pylint: disable=invalid-name
+        """ Stop down stuff we started. """
+        self.hass.stop()
+        recorder._INSTANCE.block_till_done()
+        os.remove(self.hass.config.path(recorder.DB_FILE))
+
+    def recorded_states(self, entity_id):
+        """ Return the recorded states of entity_id. """
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        return [state.state for state in recorder.query_states(
+            'SELECT * FROM states WHERE entity_id = ? ORDER BY state_id',
+            (entity_id,))]
+
+    def test_exclude(self):
+        """ Tests excluded domains, entities and event types. """
+        self.hass.states.set('sun.sun', 'above_horizon')
+        self.hass.states.set('sensor.clock', '12:00')
+        self.hass.states.set('sensor.other', '1')
+        self.hass.bus.fire('noisy_event')
+        self.hass.bus.fire('other_event')
+        self.hass.pool.block_till_done()
+        recorder._INSTANCE.block_till_done()
+
+        self.assertEqual(0, len(recorder.query(
+            "SELECT * FROM events WHERE event_type = ?", ('noisy_event',))))
+        self.assertEqual(1, len(recorder.query(
+            "SELECT * FROM events WHERE event_type = ?", ('other_event',))))
+        self.assertEqual([], self.recorded_states('sun.sun'))
+        self.assertEqual([], self.recorded_states('sensor.clock'))
+        self.assertEqual(['1'], self.recorded_states('sensor.other'))
+
+    def test_min_interval_and_deadband(self):
+        """ Tests states that are too soon or too close are skipped. """
+        start = dt_util.utcnow()
+
+        for seconds, value in ((0, 100), (5, 200), (15, 202), (30, 204),
+                               (45, 'unavailable'), (50, 220)):
+            with mock.patch('homeassistant.util.dt.utcnow',
+                            return_value=start + timedelta(seconds=seconds)):
+                self.hass.states.set('sensor.power', value)
+                self.hass.states.set('sensor.temperature', value)
+                self.hass.pool.block_till_done()
+
+        # 200 is too soon, 204 too close and 220 is held back because it is
+        # too soon after unavailable
+        self.assertEqual(['100', '202', 'unavailable'],
+                         self.recorded_states('sensor.power'))
+        self.assertEqual(['100', '200', '202', '204', 'unavailable', '220'],
+                         self.recorded_states('sensor.temperature'))
+
+    def test_min_interval_records_last_state(self):
+        """ Tests the last state that is too soon is recorded once the
+            interval has passed and on shutdown. """
+        instance = recorder.Recorder(
+            self.hass, min_intervals={'sensor.power': 10})
+        start = dt_util.utcnow()
+
+        self.set_power(instance, start, 0, '1')
+        self.set_power(instance, start, 2, '2')
+        self.set_power(instance, start, 4, '3')
+        self.time_changed(instance, start, 9)
+        self.assertEqual(['1'], self.queued(instance))
+
+        self.time_changed(instance, start, 10)
+        self.assertEqual(['1', '3'], self.queued(instance))
+
+        self.set_power(instance, start, 12, '4')
+        instance.shutdown(None)
+        self.assertEqual(['1', '3', '4'], self.queued(instance))
+
+    def test_deadband_drops_held_back_state(self):
+        """ Tests a held back state is not recorded after a newer state is
+            dropped because it is within the deadband. """
+        instance = recorder.Recorder(
+            self.hass, min_intervals={'sensor.power': 10},
+            deadbands={'sensor.power': 5})
+        start = dt_util.utcnow()
+
+        self.set_power(instance, start, 0, '100')
+        self.set_power(instance, start, 2, '200')
+        self.set_power(instance, start, 4, '101')
+        self.time_changed(instance, start, 10)
+        instance.shutdown(None)
+        self.assertEqual(['100'], self.queued(instance))
+
+    @staticmethod
+    def set_power(instance, start, seconds, value):
+        """ Have the recorder handle a state seconds after start. """
+        point = start + timedelta(seconds=seconds)
+        instance.event_listener(ha.Event(EVENT_STATE_CHANGED, {
+            'entity_id': 'sensor.power',
+            'new_state': ha.State('sensor.power', value,
+                                  last_updated=point)}))
+
+    @staticmethod
+    def time_changed(instance, start, seconds):
+        """ Have the recorder handle a time changed event. """
+        instance.event_listener(ha.Event(EVENT_TIME_CHANGED, {
+            ATTR_NOW: start + timedelta(seconds=seconds)}))
+
+    @staticmethod
+    def queued(instance):
+        """ Return the queued states. """
+        return [item.data['new_state'].state
+                for item in instance.queue.queue
+                if isinstance(item, ha.Event)]
+
+    def test_include(self):
+        """ Tests only included entities and event types are recorded. """
+        instance = recorder.Recorder(self.hass, include=recorder.RecordFilter(
+            {'light'}, {'switch.ac'}, {'state_changed'}))
+
+        for entity_id in ('light.bowl', 'switch.ac', 'switch.tv'):
+            instance.event_listener(ha.Event('state_changed', {
+                'entity_id': entity_id,
+                'new_state': ha.State(entity_id, 'on')}))
+        instance.event_listener(ha.Event('other_event'))
+
+        self.assertEqual(['light.bowl', 'switch.ac'],
+                         [event.data['entity_id']
+                          for event in instance.queue.queue])
+
+    def test_invalid_throttle(self):
+        """ Tests setup fails for an invalid min_interval or deadband. """
+        self.assertFalse(recorder.setup(self.hass, {recorder.DOMAIN: {
+            recorder.CONF_DEADBAND: {'sensor.power': 'a lot'}}}))
+        self.assertFalse(recorder.setup(self.hass, {recorder.DOMAIN: {
+            recorder.CONF_MIN_INTERVAL: 10}}))
@@ -42,3 +42,26 @@ class TestHelpersEntity(unittest.TestCase):
 
         state = self.hass.states.get(self.entity.entity_id)
         self.assertTrue(state.attributes.get(ATTR_HIDDEN))
+
+    def test_update_ha_states(self):
+        """ Test updating the states of many entities at once. """
+        entities = []
+
+        for name in ('one', 'two'):
+            ent = entity.Entity()
+            ent.hass = self.hass
+            ent.entity_id = 'test.{}'.format(name)
+            entities.append(ent)
+
+        broken = entity.Entity()
+        broken.hass = self.hass
+
+        calls = []
+        self.hass.bus.listen(ha.EVENT_STATE_CHANGED, calls.append)
+
+        entity.update_ha_states(self.hass, entities + [broken])
+        self.hass.pool.block_till_done()
+
+        self.assertEqual(['test.one', 'test.two'],
+                         [event.data['entity_id'] for event in calls])
+        self.assertIsNotNone(self.hass.states.get('test.one'))
@@ -7,10 +7,13 @@ Provides tests to verify that Home Assistant core works.
 # pylint: disable=protected-access,too-many-public-methods
 # pylint: disable=too-few-public-methods
 import os
+import json
+import tempfile
 import unittest
 from unittest.mock import patch
 import time
 import threading
+import asyncio
 from datetime import datetime, timedelta
 
 import pytz
@@ -22,7 +25,7 @@ import homeassistant.util.dt as dt_util
 from homeassistant.helpers.event import track_state_change
 from homeassistant.const import (
     __version__, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP,
-    ATTR_FRIENDLY_NAME, TEMP_CELCIUS,
+    EVENT_STATE_CHANGED, ATTR_FRIENDLY_NAME, TEMP_CELCIUS, MATCH_ALL,
     TEMP_FAHRENHEIT)
 
 PST = pytz.timezone('America/Los_Angeles')
@@ -147,6 +150,52 @@ class TestHomeAssistant(unittest.TestCase):
         self.assertEqual(2, len(specific_runs))
         self.assertEqual(3, len(wildcard_runs))
 
+    def test_get_executor(self):
+        """ Test getting the executor of an integration. """
+        executor = self.hass.get_executor('test')
+        self.assertIs(executor, self.hass.get_executor('test'))
+        self.assertIsNot(executor, self.hass.get_executor('other'))
+
+        calls = []
+        executor.add_job(ha.JobPriority.EVENT_DEFAULT, (calls.append, 1))
+        self.hass.pool.block_till_done()
+        self.assertEqual([1], calls)
+
+        self.hass.stop()
+        self.assertFalse(executor.running)
+
+    def test_persist_states(self):
+        """ Test restoring and saving the states in the config dir. """
+        with tempfile.TemporaryDirectory() as config_dir:
+            self.hass.config.config_dir = config_dir
+            path = self.hass.config.path(ha.STATES_FILE)
+            self.hass.states.save(path)
+
+            hass = ha.HomeAssistant()
+            hass.config.config_dir = config_dir
+            hass.persist_states()
+
+            self.assertEqual(sorted(self.hass.states.all(),
+                                    key=lambda state: state.entity_id),
+                             sorted(hass.states.all(),
+                                    key=lambda state: state.entity_id))
+
+            hass.states.set('light.Bowl', 'off')
+            hass.bus.fire(ha.EVENT_TIME_CHANGED,
+                          {ha.ATTR_NOW: datetime(2015, 1, 1, 12, 1, 0)})
+            hass.pool.block_till_done()
+
+            with open(path) as fil:
+                self.assertIn(hass.states.get('light.Bowl').as_json(),
+                              fil.read())
+
+            hass.states.set('switch.AC', 'on')
+            hass.stop()
+
+            states = ha.StateMachine(self.hass.bus)
+            self.assertEqual(2, states.restore(path))
+            self.assertEqual('on', states.get('switch.AC').state)
+
     def _send_time_changed(self, now):
         """ Send a time changed event. """
         self.hass.bus.fire(ha.EVENT_TIME_CHANGED, {ha.ATTR_NOW: now})
@@ -190,6 +239,17 @@ class TestEvent(unittest.TestCase):
         }
         self.assertEqual(expected, event.as_dict())
 
+    def test_as_json(self):
+        """ Test the cached JSON of an event with a state in its data. """
+        state = ha.State('light.kitchen', 'on', {'brightness': 100})
+        event = ha.Event(EVENT_STATE_CHANGED, {
+            'entity_id': state.entity_id, 'new_state': state})
+
+        self.assertEqual(json.loads(json.dumps(event, cls=ha.JSONEncoder)),
+                         json.loads(event.as_json()))
+        self.assertIs(event.as_json(), event.as_json())
+        self.assertIn(state.as_json(), event.data_json())
+
 
 class TestEventBus(unittest.TestCase):
     """ Test EventBus methods. """
@@ -238,6 +298,172 @@ class TestEventBus(unittest.TestCase):
         self.bus._pool.block_till_done()
         self.assertEqual(1, len(runs))
 
+    def test_coroutine_listener(self):
+        """ Test coroutine listeners run without the asyncio core. """
+        runs = []
+
+        @asyncio.coroutine
+        def listener(event):
+            """ Coroutine listener. """
+            yield from asyncio.sleep(0)
+            runs.append(event)
+
+        self.bus.listen('test_event', listener)
+        self.bus.listen_once('test_event', listener)
+        self.bus.fire('test_event')
+
+        self.bus._pool.add_worker()
+        self.bus._pool.block_till_done()
+        self.assertEqual(2, len(runs))
+
+    def test_dispatch_match_all(self):
+        """ Test MATCH_ALL listeners get events of every type. """
+        self.bus._pool.add_worker()
+        calls = []
+
+        def match_all_listener(event):
+            """ Record events received by the MATCH_ALL listener. """
+            calls.append(('all', event.event_type))
+
+        self.bus.listen('test_event', lambda e: calls.append(('test', 0)))
+        self.bus.listen(MATCH_ALL, match_all_listener)
+
+        self.bus.fire('test_event')
+        self.bus.fire('other_event')
+        self.bus._pool.block_till_done()
+
+        self.assertEqual(
+            sorted([('all', 'test_event'), ('all', 'other_event'),
+                    ('test', 0)]),
+            sorted(calls))
+
+        self.bus.remove_listener(MATCH_ALL, match_all_listener)
+        calls.clear()
+
+        self.bus.fire('test_event')
+        self.bus.fire('other_event')
+        self.bus._pool.block_till_done()
+
+        self.assertEqual([('test', 0)], calls)
+
+    def test_listen_entity_ids(self):
+        """ Test listeners that only want events for some entity ids. """
+        self.bus._pool.add_worker()
+        calls = []
+
+        def listener(event):
+            """ Record the entity id of the event. """
+            calls.append(event.data['entity_id'])
+
+        self.bus.listen(EVENT_STATE_CHANGED, listener,
+                        ['light.kitchen', 'light.bowl'])
+        self.bus.listen(EVENT_STATE_CHANGED, listener, ['light.kitchen'])
+
+        for entity_id in ('light.kitchen', 'light.bowl', 'light.other'):
+            self.bus.fire(EVENT_STATE_CHANGED, {'entity_id': entity_id})
+        self.bus.fire(EVENT_STATE_CHANGED)
+        self.bus._pool.block_till_done()
+
+        self.assertEqual(['light.bowl', 'light.kitchen', 'light.kitchen'],
+                         sorted(calls))
+        self.assertEqual(2, self.bus.listeners[EVENT_STATE_CHANGED])
+
+        self.bus.remove_listener(EVENT_STATE_CHANGED, listener)
+        self.bus.remove_listener(EVENT_STATE_CHANGED, listener)
+        calls.clear()
+
+        self.bus.fire(EVENT_STATE_CHANGED, {'entity_id': 'light.kitchen'})
+        self.bus._pool.block_till_done()
+
+        self.assertEqual([], calls)
+        self.assertNotIn(EVENT_STATE_CHANGED, self.bus.listeners)
+
+        self.assertRaises(HomeAssistantError, self.bus.listen,
+                          MATCH_ALL, listener, ['light.kitchen'])
+
+    def test_listen_data_key_and_predicate(self):
+        """ Test listeners filtered on event data before they are queued. """
+        calls = []
+
+        self.bus.listen('filtered', lambda event: calls.append('values'),
+                        data_key='topic', values=['a', 'b'])
+        self.bus.listen('filtered', lambda event: calls.append('both'),
+                        data_key='topic', values=['a'],
+                        predicate=lambda data: data.get('qos') == 1)
+        self.bus.listen('filtered', lambda event: calls.append('predicate'),
+                        predicate=lambda data: data['qos'] > 0)
+
+        with patch('homeassistant.core._LOGGER.exception') as log:
+            for data in ({'topic': 'a', 'qos': 1}, {'topic': 'b', 'qos': 0},
+                         {'topic': ['a'], 'qos': 2}, {'topic': 'a'}):
+                self.bus.fire('filtered', data)
+
+        # Predicate raised KeyError for the event without qos
+        self.assertEqual(1, log.call_count)
+        # Nothing was queued for events without matching listeners
+        self.assertEqual(6, self.bus._pool.queue_size)
+
+        self.bus._pool.add_worker()
+        self.bus._pool.block_till_done()
+
+        self.assertEqual(['both', 'predicate', 'predicate', 'values',
+                          'values', 'values'], sorted(calls))
+
+        self.assertRaises(HomeAssistantError, self.bus.listen,
+                          'filtered', len, data_key='topic')
+        self.assertRaises(HomeAssistantError, self.bus.listen,
+                          MATCH_ALL, len, predicate=bool)
+
+    def test_scheduled_listeners(self):
+        """ Test point in time and time pattern listeners. """
+        self.bus._pool.add_worker()
+        calls = []
+        point = datetime(2015, 1, 1, 12, 0, 0, tzinfo=dt_util.UTC)
+
+        def point_listener(event):
+            """ Record point in time calls. """
+            calls.append(('point', event.data[ha.ATTR_NOW]))
+
+        def pattern_listener(event):
+            """ Record time pattern calls. """
+            calls.append(('pattern', event.data[ha.ATTR_NOW]))
+
+        self.bus.listen_point_in_time(point_listener, point)
+        self.bus.listen_time_pattern(pattern_listener, (0, 30),
+                                     lambda now: now.minute == 0)
+        self.assertEqual(2, self.bus.listeners[ha.EVENT_TIME_CHANGED])
+
+        times = [point - timedelta(seconds=30), point,
+                 point + timedelta(seconds=30), point + timedelta(minutes=1)]
+
+        for now in times:
+            self.bus.fire(ha.EVENT_TIME_CHANGED, {ha.ATTR_NOW: now})
+        self.bus._pool.block_till_done()
+
+        self.assertEqual([('pattern', times[1]), ('pattern', times[2]),
+                          ('point', times[1])], sorted(calls))
+        self.assertEqual(1, self.bus.listeners[ha.EVENT_TIME_CHANGED])
+
+        # Removing works for both kinds of listeners
+        self.bus.listen_point_in_time(point_listener, point)
+        self.bus.remove_listener(ha.EVENT_TIME_CHANGED, point_listener)
+        self.bus.remove_listener(ha.EVENT_TIME_CHANGED, pattern_listener)
+        self.assertNotIn(ha.EVENT_TIME_CHANGED, self.bus.listeners)
+
+        calls.clear()
+        self.bus.fire(ha.EVENT_TIME_CHANGED, {ha.ATTR_NOW: point})
+        self.bus._pool.block_till_done()
+        self.assertEqual([], calls)
+
+    def test_fire_without_listeners(self):
+        """ Test no Event is created if nobody listens. """
+        with patch('homeassistant.core.Event') as mock_event, \
+                patch('homeassistant.core._LOGGER') as mock_logger:
+            mock_logger.isEnabledFor.return_value = False
+            self.bus.fire('unknown_event')
+
+        self.assertFalse(mock_event.called)
+
 
 class TestState(unittest.TestCase):
     """ Test EventBus methods. """
@@ -270,10 +496,36 @@ class TestState(unittest.TestCase):
         state = ha.State('domain.hello', 'world', {'some': 'attr'})
         self.assertEqual(state, state.copy())
 
+    def test_read_only(self):
+        """ Test that states cannot be changed. """
+        attributes = {'some': 'attr'}
+        state = ha.State('domain.hello', 'world', attributes)
+
+        with self.assertRaises(AttributeError):
+            state.state = 'changed'
+
+        with self.assertRaises(AttributeError):
+            del state.state
+
+        with self.assertRaises(TypeError):
+            state.attributes['some'] = 'changed'
+
+        # Changing the passed in dict does not change the state
+        attributes['some'] = 'changed'
+        self.assertEqual({'some': 'attr'}, state.attributes)
+
     def test_dict_conversion(self):
         state = ha.State('domain.hello', 'world', {'some': 'attr'})
         self.assertEqual(state, ha.State.from_dict(state.as_dict()))
 
+    def test_as_json(self):
+        """ Test the cached JSON of a state. """
+        state = ha.State('domain.hello', 'world', {'b': 1, 'a': [2]})
+
+        self.assertEqual(state.as_dict(), json.loads(state.as_json()))
+        self.assertIs(state.as_json(), state.as_json())
+        self.assertEqual('{"a": [2], "b": 1}', state.attributes_json())
+
     def test_dict_conversion_with_wrong_data(self):
         self.assertIsNone(ha.State.from_dict(None))
         self.assertIsNone(ha.State.from_dict({'state': 'yes'}))
@@ -328,6 +580,126 @@ class TestStateMachine(unittest.TestCase):
         states = sorted(state.entity_id for state in self.states.all())
         self.assertEqual(['light.bowl', 'switch.ac'], states)
 
+    def test_changed_since(self):
+        """ Test getting the changes after a version. """
+        version, states = self.states.snapshot()
+        self.assertEqual(2, len(states))
+
+        self.states.set('light.Bowl', 'off')
+        self.states.set('light.kitchen', 'on')
+        self.states.set('light.Bowl', 'off')
+        self.states.remove('switch.ac')
+
+        new_version, changed, removed = self.states.changed_since(version)
+
+        self.assertEqual(self.states.version, new_version)
+        self.assertEqual(['light.bowl', 'light.kitchen'],
+                         [state.entity_id for state in changed])
+        self.assertEqual(['switch.ac'], removed)
+        self.assertEqual(['light.bowl', 'light.kitchen'],
+                         sorted(self.states.entity_ids('light')))
+        self.assertEqual([], self.states.entity_ids('switch'))
+
+        self.assertEqual((new_version, [], []),
+                         self.states.changed_since(new_version))
+
+        self.states.set('switch.AC', 'on')
+        self.assertEqual(['switch.ac'], self.states.entity_ids('Switch'))
+        self.assertEqual(
+            (new_version + 1, [self.states.get('switch.ac')], []),
+            self.states.changed_since(new_version))
+
+    def test_set_many(self):
+        """ Test setting many states at once. """
+        calls = []
+        self.bus.listen(EVENT_STATE_CHANGED, calls.append)
+
+        with patch.object(self.pool, 'add_job') as mock_add_job:
+            self.states.set_many([
+                ('light.Bowl', 'off', None),
+                ('light.Bowl', 'off', None),
+                ('light.kitchen', 'on', {'brightness': 100}),
+            ])
+
+        # The listeners of all events are called in one job
+        self.assertEqual(1, mock_add_job.call_count)
+        func, arg = mock_add_job.call_args[0][1]
+        func(arg)
+
+        self.assertEqual(
+            [('light.bowl', 'on', 'off'), ('light.kitchen', None, 'on')],
+            [(event.data['entity_id'],
+              getattr(event.data.get('old_state'), 'state', None),
+              event.data['new_state'].state) for event in calls])
+        self.assertEqual({'brightness': 100},
+                         self.states.get('light.kitchen').attributes)
+
+    def test_save_and_restore(self):
+        """ Test saving the states and restoring them. """
+        self.pool.add_worker()
+        calls = []
+        self.bus.listen(EVENT_STATE_CHANGED, calls.append)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'states.json')
+            self.assertEqual(0, self.states.restore(path))
+
+            self.states.set('light.Bowl', 'off', {'brightness': 10})
+            self.states.save(path)
+            self.assertEqual([path], [os.path.join(tmp_dir, name) for name
+                                      in os.listdir(tmp_dir)])
+
+            states = ha.StateMachine(self.bus)
+            states.set('switch.AC', 'on')
+            self.assertEqual(1, states.restore(path))
+
+            # Existing states are kept
+            self.assertEqual('on', states.get('switch.AC').state)
+            self.assertEqual(self.states.get('light.Bowl'),
+                             states.get('light.Bowl'))
+            self.assertEqual(self.states.get('light.Bowl').last_changed,
+                             states.get('light.Bowl').last_changed)
+            self.assertTrue(states.is_restored('light.bowl'))
+            self.assertFalse(states.is_restored('switch.AC'))
+
+            # The first set of a restored state fires even if it is the same
+            states.set('light.Bowl', 'off', {'brightness': 10})
+            self.assertFalse(states.is_restored('light.bowl'))
+            states.set('light.Bowl', 'off', {'brightness': 10})
+
+            # Restoring does not fire state changed events
+            self.pool.block_till_done()
+            self.assertEqual(3, len(calls))
+            self.assertEqual('off', calls[-1].data['new_state'].state)
+            self.assertEqual('off', calls[-1].data['old_state'].state)
+
+            # Restored states nothing claimed are removed
+            states = ha.StateMachine(self.bus)
+            states.set('light.Bowl', 'on')
+            self.assertEqual(1, states.restore(path))
+            self.assertEqual(1, states.remove_restored())
+            self.assertEqual(['light.bowl'], states.entity_ids())
+            self.assertEqual(0, states.remove_restored())
+
+            with open(path, 'w') as fil:
+                fil.write('{"states": [], "version": 0}')
+
+            self.assertEqual(0, ha.StateMachine(self.bus).restore(path))
+
+            with open(path, 'w') as fil:
+                fil.write('{"states": [')
+
+            with patch('homeassistant.core._LOGGER.exception') as log:
+                self.assertEqual(0, ha.StateMachine(self.bus).restore(path))
+                self.assertEqual(1, log.call_count)
+
+    def test_get_shares_state(self):
+        """ Test that get and all return the stored state. """
+        state = self.states.get('light.bowl')
+
+        self.assertIs(state, self.states.get('light.Bowl'))
+        self.assertIn(state, self.states.all())
+
     def test_remove(self):
         """ Test remove method. """
         self.assertTrue('light.bowl' in self.states.entity_ids())
@@ -477,6 +849,126 @@ class TestServiceRegistry(unittest.TestCase):
             self.services.call('test_domain', 'i_do_not_exist', blocking=True))
         ha.SERVICE_CALL_LIMIT = orig_limit
 
+    def test_call_future(self):
+        """ Test getting return values and exceptions of services. """
+        self.pool.add_worker()
+
+        def raise_error(call):
+            """ Service that fails. """
+            raise ValueError(call.data['message'])
+
+        self.services.register("test_domain", "return_value",
+                               lambda call: call.data['value'] * 2)
+        self.services.register("test_domain", "raise_error", raise_error)
+
+        future = self.services.call_future(
+            'test_domain', 'return_value', {'value': 21})
+        self.assertEqual(42, future.result(1))
+
+        with patch('homeassistant.core._LOGGER'):
+            future = self.services.call_future(
+                'test_domain', 'raise_error', {'message': 'Failed'})
+            self.assertRaises(ValueError, future.result, 1)
+
+            self.assertRaises(
+                ValueError, self.services.call, 'test_domain', 'raise_error',
+                {'message': 'Failed'}, True)
+
+        self.pool.block_till_done()
+        self.assertEqual({}, self.services._pending)
+
+    def test_call_executed_by_other_instance(self):
+        """ Test resolving calls from service executed events. """
+        self.pool.add_worker()
+        other = ha.ServiceRegistry(self.bus, self.pool)
+        calls = []
+
+        # Only known to the other registry
+        other.register("other_domain", "other_service", calls.append)
+
+        future = self.services.call_future('other_domain', 'other_service')
+        self.assertIsNone(future.result(1))
+        self.assertEqual(1, len(calls))
+
+        self.pool.block_till_done()
+        self.assertEqual({}, self.services._pending)
+        self.assertEqual({}, other._pending)
+
+
+class TestAsyncioCore(unittest.TestCase):
+    """ Test Home Assistant running on an asyncio event loop. """
+
+    def setUp(self):     # pylint: disable=invalid-name
+        """ things to be run when tests are started. """
+        self.hass = ha.HomeAssistant(use_asyncio=True)
+
+    def tearDown(self):  # pylint: disable=invalid-name
+        """ Stop down stuff we started. """
+        self.hass.stop()
+
+    def test_listeners(self):
+        """ Test where coroutine, callback and blocking listeners run. """
+        threads = {}
+
+        @asyncio.coroutine
+        def coroutine_listener(event):
+            """ Listener that runs on the loop. """
+            yield from asyncio.sleep(0)
+            threads['coroutine'] = threading.current_thread()
+
+        @ha.callback
+        def callback_listener(event):
+            """ Listener that runs on the loop. """
+            threads['callback'] = threading.current_thread()
+
+        def blocking_listener(event):
+            """ Listener that runs in the executor. """
+            threads['blocking'] = threading.current_thread()
+
+        self.hass.bus.listen('test_event', coroutine_listener)
+        self.hass.bus.listen('test_event', callback_listener)
+        self.hass.bus.listen_once('test_event', blocking_listener)
+        self.hass.bus.fire('test_event')
+        self.hass.pool.block_till_done()
+
+        self.assertIs(self.hass.pool._thread, threads['coroutine'])
+        self.assertIs(self.hass.pool._thread, threads['callback'])
+        self.assertIsNot(self.hass.pool._thread, threads['blocking'])
+        self.assertEqual(2, self.hass.bus.listeners['test_event'])
+
+    def test_blocking_jobs_skip_loop(self):
+        """ Test blocking jobs start while the event loop is busy. """
+        started = threading.Event()
+        waited = []
+
+        self.hass.pool.loop.call_soon_threadsafe(
+            lambda: waited.append(started.wait(3)))
+        self.hass.pool.add_job(
+            ha.JobPriority.EVENT_DEFAULT, (lambda arg: started.set(), None))
+        self.hass.pool.block_till_done()
+
+        self.assertEqual([True], waited)
+
+    def test_pool_starts_small(self):
+        """ Test the threads for blocking jobs start at the minimum. """
+        self.assertEqual(ha.MIN_WORKER_THREAD, self.hass.pool.worker_count)
+        self.assertEqual(ha.MAX_WORKER_THREAD, self.hass.pool.max_workers)
+
+    def test_services_and_timer(self):
+        """ Test calling services and firing time changed events. """
+        time_changed = threading.Event()
+
+        self.hass.services.register(
+            'test_domain', 'test_service', lambda call: None)
+        self.hass.bus.listen(
+            ha.EVENT_TIME_CHANGED,
+            ha.callback(lambda event: time_changed.set()))
+        self.hass.start()
+
+        self.assertTrue(self.hass.services.call(
+            'test_domain', 'test_service', blocking=True))
+        self.assertTrue(time_changed.wait(3))
+
 
 class TestConfig(unittest.TestCase):
     def setUp(self):     # pylint: disable=invalid-name
@@ -225,6 +225,23 @@ class TestRemoteClasses(unittest.TestCase):
         self.assertEqual("remote.statemachine test",
                          slave.states.get("remote.test").state)
 
+    def test_statemachine_removed_entity(self):
+        """ Tests a state changed event without new state removes the
+            entity. """
+        state = ha.State('remote.removed', 'on')
+
+        slave.states._state_changed_listener(ha.Event(
+            ha.EVENT_STATE_CHANGED,
+            {'entity_id': 'remote.removed', 'new_state': state}))
+        self.assertEqual(state, slave.states.get('remote.removed'))
+
+        slave.states._state_changed_listener(ha.Event(
+            ha.EVENT_STATE_CHANGED,
+            {'entity_id': 'remote.removed', 'old_state': state,
+             'new_state': None}))
+        self.assertIsNone(slave.states.get('remote.removed'))
+        self.assertNotIn('remote.removed', slave.states.entity_ids('remote'))
+
     def test_eventbus_fire(self):
         """ Test if events fired from the eventbus get fired. """
         test_value = []
@@ -5,6 +5,8 @@ tests.test_util
 Tests Home Assistant util methods.
 """
 # pylint: disable=too-many-public-methods
+import threading
+import time
 import unittest
 from unittest.mock import patch
 from datetime import datetime, timedelta
@@ -107,6 +109,22 @@ class TestUtil(unittest.TestCase):
         self.assertRaises(TypeError,
                           lambda x, y: x >= y, TestEnum.FIRST, 1)
 
+    def test_read_only_dict(self):
+        """ Test ReadOnlyDict cannot be changed. """
+        data = util.ReadOnlyDict({'hello': 'world'})
+
+        self.assertEqual({'hello': 'world'}, data)
+
+        for func in (lambda: data.__setitem__('hello', 'you'),
+                     lambda: data.__delitem__('hello'),
+                     lambda: data.update(hello='you'),
+                     lambda: data.pop('hello'),
+                     data.popitem, data.clear,
+                     lambda: data.setdefault('new', 1)):
+            self.assertRaises(TypeError, func)
+
+        self.assertEqual({'hello': 'world'}, data)
+
     def test_ordered_set(self):
         set1 = util.OrderedSet([1, 2, 3, 4])
         set2 = util.OrderedSet([3, 4, 5])
@@ -242,3 +260,93 @@ class TestUtil(unittest.TestCase):
 
         self.assertTrue(throttled())
         self.assertIsNone(throttled())
+
+    def test_thread_pool_scaling(self):
+        """ Test the thread pool adds and removes workers with the load. """
+        release = threading.Event()
+
+        pool = util.ThreadPool(lambda job: release.wait(), 1, max_workers=3,
+                               scale_up_latency=0.01, idle_timeout=0.1)
+
+        try:
+            for _ in range(5):
+                pool.add_job(0, None)
+                time.sleep(0.05)
+
+            self.assertEqual(3, pool.worker_count)
+
+            release.set()
+            pool.block_till_done()
+
+            for _ in range(50):
+                if pool.worker_count == 1:
+                    break
+                time.sleep(0.05)
+
+            self.assertEqual(1, pool.worker_count)
+        finally:
+            release.set()
+            pool.stop()
+
+    def test_thread_pool_stop_while_scaling(self):
+        """ Test stopping while a worker scales up after a long job. """
+        pool = util.ThreadPool(lambda job: time.sleep(job), 1, max_workers=2,
+                               scale_up_latency=0.05)
+
+        pool.add_job(0, 0.2)
+        pool.add_job(0, 0)
+
+        stopper = threading.Thread(target=pool.stop)
+        stopper.daemon = True
+        stopper.start()
+        stopper.join(5)
+
+        self.assertFalse(stopper.is_alive())
+        self.assertFalse(pool.running)
+        self.assertEqual(0, pool.worker_count)
+
+    def test_thread_pool_children(self):
+        """ Test block_till_done waits for the jobs of child pools. """
+        calls = []
+        pool = util.ThreadPool(lambda job: job(), 1)
+        child = util.ThreadPool(lambda job: job(), 1)
+        pool.add_child(child)
+
+        def child_job():
+            """ Slow job in the child pool that adds a job to the parent. """
+            time.sleep(0.05)
+            pool.add_job(0, lambda: calls.append('parent'))
+
+        pool.add_job(0, lambda: child.add_job(0, child_job))
+        pool.block_till_done()
+
+        self.assertEqual(['parent'], calls)
+
+        pool.stop()
+        self.assertFalse(child.running)
+
+    def test_thread_pool_stats(self):
+        """ Test keeping runtime and queue wait statistics of jobs. """
+        pool = util.ThreadPool(lambda job: job(), 1,
+                               job_name=util.callable_name)
+
+        try:
+            pool.add_job(1, dt_util.utcnow)
+            pool.add_job(2, lambda: time.sleep(.01))
+            pool.add_job(2, lambda: time.sleep(.01))
+            pool.block_till_done()
+        finally:
+            pool.stop()
+
+        jobs = pool.job_stats.as_dict()
+        self.assertEqual(1, jobs['homeassistant.util.dt.utcnow']['count'])
+
+        lambda_stats = jobs['tests.util.test_init.TestUtil.'
+                            'test_thread_pool_stats.<locals>.<lambda>']
+
+        self.assertEqual(2, lambda_stats['count'])
+        self.assertLessEqual(.02, lambda_stats['total'])
+        self.assertLessEqual(.01, lambda_stats['max'])
+        self.assertEqual({1: 1, 2: 2}, {
+            priority: stats['count']
+            for priority, stats in pool.wait_stats.as_dict().items()})